@@ -0,0 +1,140 @@
+import os
+from datetime import date, datetime
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import delete, func, select, text
+from config import get_exchange_archive_dir
+from database import unit_of_work
+from instrumentation import track_service
+from ledger import replay_ledger
+from migrations import EXCHANGE_PARTITION_PREFIX, exchange_partition_years
+from models import Exchange, ExchangeArchive
+from services import STATUS_UPDATE_ACTION, now, refresh_rollups
+
+# Keeps the exchanges table to recent activity. Every closed year older than
+# the last keep_years is written to a zstd-compressed Parquet file in
+# EXCHANGE_ARCHIVE_DIR (exchanges_2023.parquet), recorded in
+# exchange_archives, and only then removed from the table: on Postgres by
+# dropping the year's partition, on SQLite with a DELETE.
+#
+# The report rollups and the ledger replay are brought up to date first, so
+# they have counted every archived exchange; rebuild_rollups() keeps the days
+# of archived years and rebuild_ledger_state() replays the files. History
+# reads take include_archive=True to read them (see services.py).
+#
+#   python cli.py archive-exchanges [--keep-years 2]
+
+ARCHIVE_KEEP_YEARS = 2
+ARCHIVE_CHUNK_SIZE = 100000
+
+ARCHIVE_SCHEMA = pa.schema([
+    ("id", pa.int64()),
+    ("date", pa.timestamp("us")),
+    ("old_battery_serial", pa.string()),
+    ("new_battery_serial", pa.string()),
+    ("customer_phone", pa.string()),
+    ("action_taken", pa.string()),
+    ("ticket_id", pa.string()),
+    ("notes", pa.string()),
+    ("status", pa.string()),
+])
+
+
+def archive_file_name(year):
+    return f"exchanges_{year}.parquet"
+
+def _in_year(year):
+    return (Exchange.date >= datetime(year, 1, 1)) & (Exchange.date < datetime(year + 1, 1, 1))
+
+def _write_year(session, year, path, chunk_size):
+    """
+    Streams the year's exchanges into a Parquet file in id order. Returns
+    (rows, STATUS_UPDATED rows, first id, last id).
+    """
+    query = (
+        select(*[Exchange.__table__.c[field.name] for field in ARCHIVE_SCHEMA])
+        .where(_in_year(year))
+        .order_by(Exchange.id)
+        .execution_options(stream_results=True)
+    )
+    rows, status_updates, first_id, last_id = 0, 0, None, None
+    with pq.ParquetWriter(path, ARCHIVE_SCHEMA, compression="zstd") as writer:
+        for chunk in pd.read_sql(query, session.connection(), chunksize=chunk_size):
+            # One row group per chunk; their id ranges let reads skip them
+            writer.write_table(pa.Table.from_pandas(chunk, schema=ARCHIVE_SCHEMA, preserve_index=False))
+            first_id = int(chunk["id"].iloc[0]) if first_id is None else first_id
+            last_id = int(chunk["id"].iloc[-1])
+            rows += len(chunk)
+            status_updates += int((chunk["action_taken"] == STATUS_UPDATE_ACTION).sum())
+    return rows, status_updates, first_id, last_id
+
+def _remove_year(session, year, rows, last_id):
+    """
+    Removes the archived exchanges from the table, checking that they are
+    exactly the ones written to the file.
+    """
+    if year in exchange_partition_years(session.connection()):
+        partition = f"{EXCHANGE_PARTITION_PREFIX}{year}"
+        session.execute(text(f"LOCK TABLE {partition} IN ACCESS EXCLUSIVE MODE"))
+        removed = session.scalar(text(f"SELECT count(*) FROM {partition}"))
+        if removed == rows:
+            session.execute(text(f"DROP TABLE {partition}"))
+    else:
+        removed = session.execute(delete(Exchange).where(_in_year(year), Exchange.id <= last_id)).rowcount
+    if removed != rows:
+        raise RuntimeError(f"Exchanges of {year} changed while they were archived; nothing was removed. Run it again.")
+
+@track_service
+def archive_exchange_year(year, chunk_size=ARCHIVE_CHUNK_SIZE):
+    """
+    Moves the exchanges dated in `year` into the archive. Returns the number of
+    exchanges archived.
+    """
+    directory = get_exchange_archive_dir()
+    os.makedirs(directory, exist_ok=True)
+    path = os.path.join(directory, archive_file_name(year))
+    partial = f"{path}.partial"
+    with unit_of_work() as session:
+        if session.get(ExchangeArchive, year) is not None:
+            raise RuntimeError(f"Exchanges of {year} are already archived in {path}")
+        rows, status_updates, first_id, last_id = _write_year(session, year, partial, chunk_size)
+    if not rows:
+        os.remove(partial)
+        return 0
+    try:
+        with unit_of_work() as session:
+            _remove_year(session, year, rows, last_id)
+            session.add(ExchangeArchive(year=year, file_name=archive_file_name(year), rows=rows, status_updates=status_updates,
+                                        first_exchange_id=first_id, last_exchange_id=last_id, archived_at=now()))
+            session.flush()
+            # In place before the commit: a committed manifest row always has its file
+            os.replace(partial, path)
+    finally:
+        if os.path.exists(partial):
+            os.remove(partial)
+    return rows
+
+@track_service
+def archive_closed_years(keep_years=ARCHIVE_KEEP_YEARS, today=None, on_progress=None):
+    """
+    Archives every year of exchanges before the last `keep_years` (counting
+    the current one), oldest first. Returns {year: exchanges archived}.
+    """
+    refresh_rollups()
+    replay_ledger()
+    first_kept = (today or date.today()).year - keep_years + 1
+    exchange_year = func.extract("year", Exchange.date)
+    with unit_of_work() as session:
+        archived_years = session.scalars(select(ExchangeArchive.year)).all()
+        years = session.scalars(
+            select(exchange_year).distinct()
+            .where(Exchange.date < datetime(first_kept, 1, 1), exchange_year.notin_(archived_years))
+            .order_by(exchange_year)
+        ).all()
+    archived = {}
+    for year in map(int, years):
+        archived[year] = archive_exchange_year(year)
+        if on_progress:
+            on_progress(year, archived[year])
+    return archived
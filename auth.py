@@ -3,3 +3,7 @@ from config import get_admin_credentials
 def check_login(username, password):
     admin_user, admin_pw = get_admin_credentials()
     return username == admin_user and password == admin_pw
+
+def is_admin(username):
+    admin_user, _ = get_admin_credentials()
+    return username is not None and username == admin_user
@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+from datetime import date, timedelta
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from services import calculate_age, calculate_ages
+
+# Row-by-row calculate_age (what the pages used to do through .apply) against
+# the vectorised calculate_ages on the same purchase-date column.
+#
+#   python benchmarks/bench_age.py [rows ...]
+
+DEFAULT_SIZES = [10_000, 100_000]
+REPEATS = 3
+
+def make_purchase_dates(rows, seed=23):
+    rng = np.random.default_rng(seed)
+    offsets = rng.integers(0, 5 * 365, size=rows)
+    dates = pd.Series([date.today() - timedelta(days=int(d)) for d in offsets], dtype=object)
+    # Roughly one battery in ten has no purchase date on record
+    dates[rng.random(rows) < 0.1] = None
+    return dates
+
+def best_of(func, repeats=REPEATS):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def run(sizes):
+    print(f"{'rows':>8}  {'apply (s)':>10}  {'vectorised (s)':>14}  {'speedup':>8}")
+    for rows in sizes:
+        dates = make_purchase_dates(rows)
+        per_row, expected = best_of(lambda: dates.apply(calculate_age))
+        vectorised, ages = best_of(lambda: calculate_ages(dates))
+        if not (ages["Age"] == expected).all():
+            raise SystemExit(f"calculate_ages disagrees with calculate_age at {rows} rows")
+        print(f"{rows:>8}  {per_row:>10.4f}  {vectorised:>14.4f}  {per_row / vectorised:>7.1f}x")
+
+if __name__ == "__main__":
+    run([int(arg) for arg in sys.argv[1:]] or DEFAULT_SIZES)
@@ -0,0 +1,86 @@
+import os
+import sys
+import time
+import numpy as np
+from sqlalchemy import create_engine, insert
+from sqlalchemy.orm import Session
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from models import Base, Battery, Customer
+from migrations import run_migrations
+from services import search_records
+
+# Type-ahead latency of search_records on a seeded database. Builds its own
+# engine so it never touches the shop database; point it at a scratch file or
+# an empty Postgres database.
+#
+#   python benchmarks/bench_search.py [db_url] [batteries]
+
+DEFAULT_URL = "sqlite:///bench_search.db"
+DEFAULT_BATTERIES = 1_000_000
+TARGET_MS = 50
+REPEATS = 5
+BATCH = 50_000
+NAMES = ["Ramesh", "Suresh", "Anita", "Priya", "Vikram", "Sunita", "Arjun", "Kavita", "Rahul", "Meena"]
+SURNAMES = ["Kumar", "Sharma", "Patil", "Singh", "Reddy", "Iyer", "Desai", "Joshi"]
+STATES = ["MH", "KA", "GJ", "DL", "TN"]
+TERMS = ["BT00123", "0012345", "98765", "Ramesh", "shar", "MH10", "KA01AB", "XYZ9"]
+
+def seed(engine, batteries, seed=7):
+    rng = np.random.default_rng(seed)
+    customers = max(batteries // 2, 1)
+    phones = [f"9{n:09d}" for n in rng.choice(10**9, size=customers, replace=False)]
+    with Session(engine) as session:
+        for start in range(0, customers, BATCH):
+            session.execute(insert(Customer), [
+                {"phone": phone, "name": f"{NAMES[i % len(NAMES)]} {SURNAMES[i % len(SURNAMES)]}"}
+                for i, phone in enumerate(phones[start:start + BATCH], start)
+            ])
+        for start in range(0, batteries, BATCH):
+            session.execute(insert(Battery), [
+                {
+                    "serial_no": f"BT{i:08d}",
+                    "model_type": "Bench",
+                    "status": "sold",
+                    "current_owner_phone": phones[i % customers],
+                    "vehicle_no": f"{STATES[i % len(STATES)]}{i % 50:02d}AB{i % 10000:04d}",
+                }
+                for i in range(start, min(start + BATCH, batteries))
+            ])
+            session.commit()
+
+def best_of(func, repeats=REPEATS):
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = func()
+        timings.append(time.perf_counter() - start)
+    return min(timings), result
+
+def run(db_url, batteries):
+    engine = create_engine(db_url)
+    Base.metadata.create_all(engine)
+    run_migrations(engine)
+    with Session(engine) as session:
+        existing = session.query(Battery).count()
+    if existing == 0:
+        start = time.perf_counter()
+        seed(engine, batteries)
+        print(f"Seeded {batteries} batteries in {time.perf_counter() - start:.1f}s")
+    else:
+        print(f"Using the {existing} batteries already in {db_url}")
+
+    slow = 0
+    print(f"{'term':>10}  {'matches':>7}  {'ms':>8}")
+    with Session(engine) as session:
+        for term in TERMS:
+            elapsed, matches = best_of(lambda: search_records(term, session=session))
+            ms = elapsed * 1000
+            slow += ms > TARGET_MS
+            print(f"{term:>10}  {len(matches):>7}  {ms:>8.1f}{'  (over target)' if ms > TARGET_MS else ''}")
+    if slow:
+        raise SystemExit(f"{slow} term(s) took longer than {TARGET_MS} ms")
+
+if __name__ == "__main__":
+    run(sys.argv[1] if len(sys.argv) > 1 else DEFAULT_URL,
+        int(sys.argv[2]) if len(sys.argv) > 2 else DEFAULT_BATTERIES)
@@ -0,0 +1,321 @@
+import argparse
+import io
+import json
+import os
+import platform
+import shutil
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timezone
+from sqlalchemy import create_engine, delete, select, text
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from generate import PRESETS, DEFAULT_SEED, END_DATE, generate, ticket_of
+from models import Base, Battery, ScrapBattery
+from migrations import run_migrations
+import archive
+import database
+import ledger
+import receipts
+import services
+
+# Times every read and write service against generated SQLite databases of
+# several sizes and writes the timings to a JSON file, so runs on different
+# commits can be compared. Runs headless: the services are called directly,
+# no Streamlit server involved.
+#
+#   python benchmarks/bench_services.py [--sizes small medium large] [--compare old.json]
+#
+# Databases are generated once per preset and seed under benchmarks/data/ and
+# reused. Write services run in a transaction that is rolled back after each
+# timing, so every repeat sees the same data. The rollups, the ledger replay and
+# the archive commit on their own; they are timed on a scratch copy.
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(HERE, "data")
+RESULTS_DIR = os.path.join(HERE, "results")
+DEFAULT_SIZES = ["small", "medium"]
+REPEATS = 5
+PAGE = 25
+# A service that got this much slower than the baseline is reported as a
+# regression. Calls of a millisecond or two jitter by more than that between
+# runs, so small absolute differences are ignored.
+REGRESSION_RATIO = 1.5
+REGRESSION_MIN_MS = 2.0
+
+def sample_keys(engine):
+    """Real keys from the generated data for the services to look up."""
+    with engine.connect() as conn:
+        def first(status, limit=1):
+            return conn.execute(
+                select(Battery.serial_no, Battery.current_owner_phone)
+                .where(Battery.status == status).order_by(Battery.serial_no).limit(limit)
+            ).all()
+        pending = first("pending")[0]
+        ready = first("ready_for_pickup")[0]
+        sold = first("sold")[0]
+        return {
+            "pending_serial": pending.serial_no,
+            "ready_serial": ready.serial_no,
+            "ready_phone": ready.current_owner_phone,
+            "sold_serial": sold.serial_no,
+            "phone": sold.current_owner_phone,
+            "factory_serials": [row.serial_no for row in first("factory_pending", 50)],
+            "scrap_serials": list(conn.execute(
+                select(ScrapBattery.serial_no).order_by(ScrapBattery.serial_no).limit(10)
+            ).scalars()),
+            "ticket": ticket_of(1),
+        }
+
+def read_calls(keys):
+    month_from, month_to = date(END_DATE.year - 1, 1, 1), date(END_DATE.year - 1, 1, 31)
+    return {
+        "get_dashboard_stats": lambda s: (services.invalidate_dashboard_cache(), services.get_dashboard_stats(session=s)),
+        "get_service_queue_df": lambda s: services.get_service_queue_df(page_size=PAGE, session=s),
+        "get_service_queue_df (filtered)": lambda s: services.get_service_queue_df(status="pending", loaner=False, age_bucket="1-2 years", page_size=PAGE, session=s),
+        "get_recent_exchanges_df": lambda s: services.get_recent_exchanges_df(session=s),
+        "get_battery_by_serial": lambda s: services.get_battery_by_serial(keys["sold_serial"], session=s),
+        "get_battery_details_df": lambda s: services.get_battery_details_df(keys["sold_serial"], session=s),
+        "get_battery_exchanges_df": lambda s: services.get_battery_exchanges_df(keys["sold_serial"], page_size=PAGE, session=s),
+        "get_customer_by_phone": lambda s: services.get_customer_by_phone(keys["phone"], session=s),
+        "get_customer_details_df": lambda s: services.get_customer_details_df(keys["phone"], session=s),
+        "get_customer_batteries_df": lambda s: services.get_customer_batteries_df(keys["phone"], session=s),
+        "get_customer_exchanges_df": lambda s: services.get_customer_exchanges_df(keys["phone"], page_size=PAGE, session=s),
+        "get_customer_profile": lambda s: services.get_customer_profile(keys["phone"], page_size=PAGE, session=s),
+        "get_battery_profile": lambda s: services.get_battery_profile(keys["sold_serial"], page_size=PAGE, session=s),
+        "get_ticket_history": lambda s: services.get_ticket_history(keys["ticket"], session=s),
+        "search_records": lambda s: services.search_records("9000001", session=s),
+        "get_ready_for_pickup_items_df": lambda s: services.get_ready_for_pickup_items_df(keys["ready_phone"], session=s),
+        "get_pending_factory_stock_df": lambda s: services.get_pending_factory_stock_df(session=s),
+        "get_stock_receipt_history_df": lambda s: services.get_stock_receipt_history_df(page_size=PAGE, session=s),
+        "get_stock_receipt_history_df (month)": lambda s: services.get_stock_receipt_history_df(page_size=PAGE, date_from=month_from, date_to=month_to, session=s),
+        "get_scrap_batteries_df": lambda s: services.get_scrap_batteries_df(page_size=PAGE, session=s),
+        "get_challan_batteries_df": lambda s: services.get_challan_batteries_df(page_size=PAGE, session=s),
+        "get_batteries_expiring_soon": lambda s: services.get_batteries_expiring_soon(today=END_DATE, session=s),
+        "get_receipt_rows_df": lambda s: services.get_receipt_rows_df(page_size=PAGE, session=s),
+        "get_receipt_rows_df (month)": lambda s: services.get_receipt_rows_df(month_from, month_to, page_size=PAGE, session=s),
+        # Opens its own sessions, one per page of receipts
+        "iter_receipts (month)": lambda s: sum(1 for _ in receipts.iter_receipts(month_from, month_to)),
+        "export_table_csv (batteries)": lambda s: services.export_table_csv("batteries", io.StringIO(), session=s),
+    }
+
+def write_calls(keys):
+    today = date.today()
+    return {
+        "update_battery_status": lambda s, i: services.update_battery_status(keys["pending_serial"], "ready_for_pickup", session=s),
+        "process_service_entry": lambda s, i: services.process_service_entry(
+            keys["phone"], "Bench Customer", keys["sold_serial"], f"BENCH-T{i}", "MH01AB0001", today, "bench", session=s),
+        "process_new_battery_exchange": lambda s, i: services.process_new_battery_exchange(
+            keys["phone"], "Bench Customer", keys["sold_serial"], f"BENCH-NEW-{i}", "Exide Matrix",
+            f"BENCH-T{i}", "MH01AB0001", today, "bench", session=s),
+        "process_return_to_customer": lambda s, i: services.process_return_to_customer(keys["ready_serial"], keys["ready_phone"], session=s),
+        "process_stock_receptions (50)": lambda s, i: services.process_stock_receptions(keys["factory_serials"], session=s),
+        "upsert_battery": lambda s, i: services.upsert_battery(
+            keys["sold_serial"], "Exide Matrix", "sold", today, today, keys["phone"], f"BENCH-T{i}", "MH01AB0001", session=s),
+        "add_inventory_stock": lambda s, i: services.add_inventory_stock(f"BENCH-STOCK-{i}", "Exide Matrix", today, session=s),
+        "move_scrap_to_challan (10)": lambda s, i: services.move_scrap_to_challan(keys["scrap_serials"], session=s),
+        "clear_challan_to_archive": lambda s, i: services.clear_challan_to_archive(session=s),
+    }
+
+def best_and_median(timings):
+    return {"best_ms": round(min(timings) * 1000, 3), "median_ms": round(statistics.median(timings) * 1000, 3)}
+
+def time_reads(calls, repeats):
+    results = {}
+    for name, call in calls.items():
+        timings = []
+        # The first call also pays for cold caches and statement compilation
+        # and is not counted
+        for _ in range(repeats + 1):
+            session = database.get_session()
+            try:
+                start = time.perf_counter()
+                call(session)
+                timings.append(time.perf_counter() - start)
+            finally:
+                session.close()
+        results[name] = {"kind": "read", **best_and_median(timings[1:])}
+    return results
+
+def time_writes(calls, repeats):
+    results = {}
+    for name, call in calls.items():
+        timings = []
+        for i in range(repeats + 1):
+            session = database.get_session()
+            try:
+                start = time.perf_counter()
+                call(session, i)
+                session.flush()
+                timings.append(time.perf_counter() - start)
+            finally:
+                session.rollback()
+                session.close()
+        results[name] = {"kind": "write", **best_and_median(timings[1:])}
+    return results
+
+def time_bulk_import(engine, repeats, rows=1000):
+    # bulk_import_inventory commits chunk by chunk on its own, so its rows are
+    # deleted again after each timing
+    csv = "serial_no,model_type,date_of_purchase\n" + "".join(
+        f"BENCH-IMP-{n:06d},Exide Matrix,2025-06-01\n" for n in range(rows)
+    )
+    timings = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        services.bulk_import_inventory(io.BytesIO(csv.encode()), "bench.csv")
+        timings.append(time.perf_counter() - start)
+        with engine.begin() as conn:
+            conn.execute(delete(Battery).where(Battery.serial_no.like("BENCH-IMP-%")))
+    with engine.begin() as conn:
+        # The inserts and deletes leave extra segments and tombstones in the FTS
+        # index that would slow every later write; merge them back into one
+        if conn.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).first():
+            conn.execute(text("INSERT INTO search_fts (search_fts) VALUES ('optimize')"))
+    return {f"bulk_import_inventory ({rows})": {"kind": "write", **best_and_median(timings)}}
+
+def time_once(call):
+    start = time.perf_counter()
+    call()
+    return time.perf_counter() - start
+
+def time_maintenance(path, repeats):
+    """
+    Times the rollups, the ledger replay and archiving closed years on a
+    scratch copy of the data set: from scratch, then with nothing new to do.
+    Archiving runs once, as it leaves nothing to archive behind it.
+    """
+    results = {}
+    def record(name, timings):
+        results[name] = {"kind": "maintenance", **best_and_median(timings)}
+
+    with tempfile.TemporaryDirectory() as scratch:
+        copy = os.path.join(scratch, "bench.db")
+        shutil.copyfile(path, copy)
+        os.environ["EXCHANGE_ARCHIVE_DIR"] = os.path.join(scratch, "exchange_archive")
+        use_database(f"sqlite:///{copy}")
+        try:
+            record("rebuild_rollups", [time_once(services.rebuild_rollups) for _ in range(repeats)])
+            record("refresh_rollups (up to date)", [time_once(services.refresh_rollups) for _ in range(repeats)])
+            record("rebuild_ledger_state", [time_once(ledger.rebuild_ledger_state) for _ in range(repeats)])
+            record("replay_ledger (up to date)", [time_once(ledger.replay_ledger) for _ in range(repeats)])
+            record("archive_closed_years", [time_once(lambda: archive.archive_closed_years(today=END_DATE))])
+            keys = sample_keys(database.get_db_engine())
+            record("get_battery_exchanges_df (archive)", [
+                time_once(lambda: services.get_battery_exchanges_df(keys["sold_serial"], page_size=PAGE, include_archive=True))
+                for _ in range(repeats)
+            ])
+            record("iter_archived_exchanges", [
+                time_once(lambda: sum(len(batch) for batch in services.iter_archived_exchanges())) for _ in range(repeats)
+            ])
+        finally:
+            database.reset_engine()
+            del os.environ["EXCHANGE_ARCHIVE_DIR"]
+    return results
+
+def use_database(url):
+    # The services reach the database through database.get_db_engine, which
+    # reads DB_URL from the environment first; drop the cached engine so the
+    # next call builds one for this URL
+    os.environ["DB_URL"] = url
+    database.reset_engine()
+    services.invalidate_dashboard_cache()
+    return database.get_db_engine()
+
+def prepare(preset, seed):
+    os.makedirs(DATA_DIR, exist_ok=True)
+    counts = PRESETS[preset]
+    path = os.path.join(DATA_DIR, f"bench_{preset}_{counts['batteries']}_{counts['exchanges']}_s{seed}.db")
+    url = f"sqlite:///{path}"
+    if not os.path.exists(path):
+        print(f"Generating {preset} data set into {path} ...")
+        start = time.perf_counter()
+        try:
+            generate(create_engine(url), **counts, seed=seed)
+        except BaseException:
+            # Never leave a half-filled file behind to be reused next time
+            os.remove(path)
+            raise
+        print(f"  done in {time.perf_counter() - start:.1f}s")
+    else:
+        # Data sets generated on an older commit get the current schema
+        engine = create_engine(url)
+        Base.metadata.create_all(engine)
+        run_migrations(engine)
+    return url
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=HERE,
+                              capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+def run(sizes, repeats=REPEATS, seed=DEFAULT_SEED):
+    report = {
+        "commit": git_commit(),
+        "created_at": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "seed": seed,
+        "repeats": repeats,
+        "sizes": {},
+    }
+    for preset in sizes:
+        url = prepare(preset, seed)
+        engine = use_database(url)
+        keys = sample_keys(engine)
+        print(f"{preset}: {PRESETS[preset]}")
+        results = time_reads(read_calls(keys), repeats)
+        results.update(time_writes(write_calls(keys), repeats))
+        results.update(time_bulk_import(engine, repeats))
+        results.update(time_maintenance(url.removeprefix("sqlite:///"), repeats))
+        for name, timing in results.items():
+            print(f"  {name:<40} {timing['best_ms']:>10.2f} ms")
+        report["sizes"][preset] = {"rows": PRESETS[preset], "services": results}
+    return report
+
+def compare(report, baseline):
+    """Prints the services that got slower than in the baseline report. Returns how many."""
+    regressions = 0
+    for preset, size in report["sizes"].items():
+        old = baseline.get("sizes", {}).get(preset, {}).get("services", {})
+        for name, timing in size["services"].items():
+            if name not in old:
+                continue
+            ratio = timing["best_ms"] / max(old[name]["best_ms"], 1e-6)
+            if ratio > REGRESSION_RATIO and timing["best_ms"] - old[name]["best_ms"] > REGRESSION_MIN_MS:
+                regressions += 1
+                print(f"  SLOWER {preset} {name}: {old[name]['best_ms']:.2f} -> {timing['best_ms']:.2f} ms ({ratio:.2f}x)")
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time the services on generated data sets.")
+    parser.add_argument("--sizes", nargs="+", choices=list(PRESETS), default=DEFAULT_SIZES)
+    parser.add_argument("--repeats", type=int, default=REPEATS)
+    parser.add_argument("--seed", type=int, default=DEFAULT_SEED)
+    parser.add_argument("--out", help="Result file (default: benchmarks/results/<timestamp>_<commit>.json)")
+    parser.add_argument("--compare", help="Earlier result file to compare against")
+    args = parser.parse_args()
+
+    report = run(args.sizes, args.repeats, args.seed)
+    out = args.out
+    if not out:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        stamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+        out = os.path.join(RESULTS_DIR, f"{stamp}_{report['commit']}.json")
+    with open(out, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {out}")
+
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+        print(f"Compared with {args.compare} (commit {baseline.get('commit')}):")
+        if compare(report, baseline):
+            sys.exit(1)
+        print("  no regressions")
@@ -0,0 +1,190 @@
+import functools
+import os
+import sys
+import time
+from datetime import date, datetime, timedelta
+import numpy as np
+from sqlalchemy import create_engine, insert
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import BATTERY_MODELS
+from services import warranty_expiry_for
+from models import Base, Customer, Battery, Exchange, ScrapBattery, ChallanBattery, ArchivedScrapBattery
+from migrations import run_migrations
+
+# Seeded synthetic shop data. The same preset and seed always produce the
+# same rows, so timings taken on different commits are comparable.
+#
+#   python benchmarks/generate.py <db_url> [preset] [seed]
+
+PRESETS = {
+    "small": {"customers": 2_000, "batteries": 10_000, "exchanges": 50_000},
+    "medium": {"customers": 20_000, "batteries": 100_000, "exchanges": 500_000},
+    "large": {"customers": 200_000, "batteries": 1_000_000, "exchanges": 5_000_000},
+}
+DEFAULT_SEED = 23
+# Dates are spread back from a fixed day rather than today, so the data set
+# does not drift from one run to the next
+END_DATE = date(2026, 1, 1)
+HISTORY_DAYS = 3 * 365
+BATCH = 50_000
+
+# Where batteries sit in the workflow, as a share of all batteries. Only a
+# few hundred are in the workshop at any time in a real shop.
+BATTERY_STATUSES = {
+    "sold": 0.45,
+    "active_with_customer": 0.30,
+    "returned_faulty/WNA": 0.10,
+    "in_stock": 0.08,
+    "factory_pending": 0.05,
+    "pending": 0.015,
+    "ready_for_pickup": 0.005,
+}
+# Of the faulty batteries: still in scrap, on a challan, already archived
+SCRAP_STAGES = {"scrap": 0.6, "challan": 0.2, "archived": 0.2}
+EXCHANGE_ACTIONS = {
+    "SERVICE_PENDING": 0.35,
+    "RETURNED_TO_CUSTOMER": 0.30,
+    "STOCK_RECEIVED": 0.20,
+    "NEW_REPLACEMENT_ISSUED": 0.15,
+}
+OWNED_STATUSES = {"sold", "active_with_customer", "returned_faulty/WNA", "pending", "ready_for_pickup"}
+NAMES = ["Ramesh", "Suresh", "Anita", "Priya", "Vikram", "Sunita", "Arjun", "Kavita", "Rahul", "Meena"]
+SURNAMES = ["Kumar", "Sharma", "Patil", "Singh", "Reddy", "Iyer", "Desai", "Joshi"]
+STATES = ["MH", "KA", "GJ", "DL", "TN"]
+
+def phone_of(i):
+    return f"9{i:09d}"
+
+def serial_of(i):
+    return f"BT{i:08d}"
+
+def ticket_of(i):
+    return f"TKT{i:07d}"
+
+def vehicle_of(i):
+    return f"{STATES[i % len(STATES)]}{i % 50:02d}AB{i % 10000:04d}"
+
+def _pick(rng, weights, size):
+    names = list(weights)
+    probabilities = np.array([weights[n] for n in names])
+    return np.array(names, dtype=object)[rng.choice(len(names), size=size, p=probabilities / probabilities.sum())]
+
+def _days_ago(days):
+    return END_DATE - timedelta(days=int(days))
+
+def _insert(conn, table, rows):
+    for start in range(0, len(rows), BATCH):
+        conn.execute(insert(table), rows[start:start + BATCH])
+
+def _customers(conn, rng, count):
+    created = rng.integers(0, HISTORY_DAYS, size=count)
+    _insert(conn, Customer, [
+        {"phone": phone_of(i), "name": f"{NAMES[i % len(NAMES)]} {SURNAMES[i % len(SURNAMES)]}",
+         "created_at": _days_ago(created[i])}
+        for i in range(count)
+    ])
+
+def _batteries(conn, rng, count, customers):
+    statuses = _pick(rng, BATTERY_STATUSES, count)
+    owners = rng.integers(0, customers, size=count)
+    purchased = rng.integers(0, HISTORY_DAYS, size=count)
+    models = rng.integers(0, len(BATTERY_MODELS), size=count)
+    loaner = rng.random(count) < 0.2
+    # Few distinct (model, purchase day) pairs, so work each expiry out once
+    expiry_of = functools.lru_cache(maxsize=None)(warranty_expiry_for)
+    rows = []
+    for i in range(count):
+        status = statuses[i]
+        owned = status in OWNED_STATUSES
+        purchase_date = _days_ago(purchased[i]) if owned else None
+        model = BATTERY_MODELS[models[i]]
+        rows.append({
+            "serial_no": serial_of(i),
+            "model_type": model,
+            "status": status,
+            "sold_date": purchase_date,
+            "date_of_purchase": purchase_date,
+            "warranty_expiry": expiry_of(model, purchase_date),
+            "current_owner_phone": phone_of(owners[i]) if owned else None,
+            "ticket_id": ticket_of(i) if status in ("pending", "ready_for_pickup") else None,
+            "vehicle_no": vehicle_of(i) if owned else None,
+            "has_loaner": bool(loaner[i]) if status == "pending" else False,
+        })
+    _insert(conn, Battery, rows)
+    return statuses, owners
+
+def _exchanges(conn, rng, count, batteries, owners):
+    first_date = datetime.combine(_days_ago(HISTORY_DAYS), datetime.min.time())
+    for start in range(0, count, BATCH):
+        size = min(BATCH, count - start)
+        actions = _pick(rng, EXCHANGE_ACTIONS, size)
+        serials = rng.integers(0, batteries, size=size)
+        replacements = rng.integers(0, batteries, size=size)
+        # Evenly spread over the history, oldest first, so ids and dates rise together
+        # as they do in the live table
+        offsets = (np.arange(start, start + size) * (HISTORY_DAYS * 86400 / count)).astype(np.int64)
+        rows = []
+        for j in range(size):
+            i = start + j
+            serial = serials[j]
+            action = actions[j]
+            stock = action == "STOCK_RECEIVED"
+            rows.append({
+                "date": first_date + timedelta(seconds=int(offsets[j])),
+                "old_battery_serial": serial_of(serial),
+                "new_battery_serial": serial_of(replacements[j]) if action == "NEW_REPLACEMENT_ISSUED" else None,
+                "customer_phone": None if stock else phone_of(owners[serial]),
+                "action_taken": action,
+                "ticket_id": None if stock else ticket_of(i),
+                "notes": "Received from Factory" if stock else f"Ticket: {ticket_of(i)}. Benchmark data",
+            })
+        _insert(conn, Exchange, rows)
+
+def _scrap(conn, rng, statuses, owners):
+    faulty = np.flatnonzero(statuses == "returned_faulty/WNA")
+    stages = _pick(rng, SCRAP_STAGES, len(faulty))
+    received = rng.integers(0, HISTORY_DAYS, size=len(faulty))
+    tables = {"scrap": ScrapBattery, "challan": ChallanBattery, "archived": ArchivedScrapBattery}
+    rows = {stage: [] for stage in tables}
+    for k, i in enumerate(faulty):
+        received_date = _days_ago(received[k])
+        row = {
+            "serial_no": serial_of(i),
+            "model_type": BATTERY_MODELS[i % len(BATTERY_MODELS)],
+            "received_date": received_date,
+            "customer_phone": phone_of(owners[i]),
+            "ticket_id": ticket_of(i),
+            "notes": "Benchmark data",
+        }
+        if stages[k] != "scrap":
+            row["challan_date"] = datetime.combine(received_date + timedelta(days=7), datetime.min.time())
+        if stages[k] == "archived":
+            row["final_archived_date"] = row["challan_date"] + timedelta(days=30)
+        rows[stages[k]].append(row)
+    for stage, table in tables.items():
+        _insert(conn, table, rows[stage])
+
+def generate(engine, customers, batteries, exchanges, seed=DEFAULT_SEED):
+    """
+    Creates the schema and fills it with the given volumes. The rows go in
+    before the migrations run, so migration-built structures such as the
+    search index are populated in one pass rather than by triggers row by row.
+    """
+    rng = np.random.default_rng(seed)
+    Base.metadata.create_all(engine)
+    with engine.begin() as conn:
+        _customers(conn, rng, customers)
+        statuses, owners = _batteries(conn, rng, batteries, customers)
+        _exchanges(conn, rng, exchanges, batteries, owners)
+        _scrap(conn, rng, statuses, owners)
+    run_migrations(engine)
+
+if __name__ == "__main__":
+    if len(sys.argv) < 2:
+        raise SystemExit("usage: python benchmarks/generate.py <db_url> [preset] [seed]")
+    preset = sys.argv[2] if len(sys.argv) > 2 else "small"
+    seed = int(sys.argv[3]) if len(sys.argv) > 3 else DEFAULT_SEED
+    start = time.perf_counter()
+    generate(create_engine(sys.argv[1]), **PRESETS[preset], seed=seed)
+    print(f"Generated {preset} ({PRESETS[preset]}) in {time.perf_counter() - start:.1f}s")
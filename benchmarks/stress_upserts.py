@@ -0,0 +1,157 @@
+import argparse
+import os
+import sys
+import threading
+import time
+from collections import Counter
+from datetime import date
+from sqlalchemy import func, select
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from config import BATTERY_MODELS
+from models import Battery, Customer, Exchange
+import database
+import services
+
+# Concurrent counters working on the same customers and batteries. Every
+# round, --workers threads are released together and for each of --keys shared
+# phones they
+#   - log a service entry (racing the customer upsert on the phone),
+#   - save the same shared battery with upsert_battery (racing insert/update),
+#   - all hand back the same serviced battery, as a double-clicked pickup
+#     would; exactly one of them may win, the others get StatusConflictError.
+# Afterwards it checks that nothing failed (no primary-key collisions, no lock
+# errors), that each row holds one complete write of the last round - nothing
+# lost, nothing torn between two writers - and that every round returned each
+# battery exactly once.
+#
+#   python benchmarks/stress_upserts.py [db_url] [--workers 8] [--rounds 50] [--keys 3]
+#
+# Writes rows prefixed STRESS- on each run; use a scratch file or database.
+
+DEFAULT_URL = "sqlite:///stress_upserts.db"
+
+def run_worker(worker, args, run_id, barrier, errors, outcomes):
+    def attempt(name, service, *service_args):
+        try:
+            service(*service_args)
+            outcomes[name] += 1
+        except services.StatusConflictError:
+            outcomes[f"{name} refused"] += 1
+        except Exception as e:
+            # The driver's message, without SQLAlchemy's wrapping
+            error = getattr(e, "orig", None) or e
+            errors.append(f"{type(e).__name__}: {str(error).splitlines()[0]}")
+
+    for round_no in range(args.rounds):
+        stamp = f"w{worker}-r{round_no}"
+        barrier.wait()
+        for key in range(args.keys):
+            phone = f"STRESS-{run_id}-{key}"
+            attempt("service entry", services.process_service_entry,
+                    phone, f"Customer {stamp}", f"STRESS-{run_id}-SVC-{key}-{stamp}", f"T-{stamp}", f"V-{stamp}",
+                    date(2025, 1, 1 + round_no % 28), "stress", worker % 2 == 0)
+            attempt("upsert", services.upsert_battery,
+                    f"STRESS-{run_id}-BAT-{key}", BATTERY_MODELS[key % len(BATTERY_MODELS)], "sold", date(2025, 2, 1),
+                    date(2025, 2, 1 + round_no % 28), phone, f"T-{stamp}", f"V-{stamp}")
+        barrier.wait()
+        for key in range(args.keys):
+            attempt("return", services.process_return_to_customer, f"STRESS-{run_id}-PICK-{key}", f"STRESS-{run_id}-{key}")
+        barrier.wait()
+        if worker == 0:
+            # Back into the workshop for the next round
+            for key in range(args.keys):
+                attempt("reopen", services.update_battery_status, f"STRESS-{run_id}-PICK-{key}", "pending")
+
+def check(args, run_id, outcomes):
+    problems = []
+    last_round = f"r{args.rounds - 1}"
+    prefix = f"STRESS-{run_id}-"
+    with database.unit_of_work() as session:
+        customers = session.execute(select(Customer.phone, Customer.name).where(Customer.phone.startswith(prefix))).all()
+        if len(customers) != args.keys:
+            problems.append(f"{len(customers)} customers instead of {args.keys}")
+        for phone, name in customers:
+            if not name.endswith(last_round):
+                problems.append(f"customer {phone} kept an earlier name: {name}")
+
+        batteries = session.execute(
+            select(Battery.serial_no, Battery.ticket_id, Battery.vehicle_no).where(Battery.serial_no.startswith(f"{prefix}BAT-"))
+        ).all()
+        if len(batteries) != args.keys:
+            problems.append(f"{len(batteries)} shared batteries instead of {args.keys}")
+        for serial, ticket, vehicle in batteries:
+            if ticket.removeprefix("T-") != vehicle.removeprefix("V-"):
+                problems.append(f"battery {serial} mixes two writes: {ticket} / {vehicle}")
+            elif not ticket.endswith(last_round):
+                problems.append(f"battery {serial} kept an earlier write: {ticket}")
+
+        returns = session.execute(
+            select(Exchange.old_battery_serial, func.count())
+            .where(Exchange.old_battery_serial.startswith(f"{prefix}PICK-"), Exchange.action_taken == "RETURNED_TO_CUSTOMER")
+            .group_by(Exchange.old_battery_serial)
+        ).all()
+        if len(returns) != args.keys:
+            problems.append(f"{len(returns)} batteries returned instead of {args.keys}")
+        for serial, count in returns:
+            if count != args.rounds:
+                problems.append(f"battery {serial} returned {count} times in {args.rounds} rounds")
+
+        entries = session.scalar(
+            select(func.count()).select_from(Exchange)
+            .where(Exchange.customer_phone.startswith(prefix), Exchange.action_taken == "SERVICE_PENDING",
+                   Exchange.old_battery_serial.startswith(f"{prefix}SVC-"))
+        )
+        if entries != outcomes["service entry"]:
+            problems.append(f"{entries} service exchanges for {outcomes['service entry']} successful entries")
+    return problems
+
+def seed_pickups(run_id, keys):
+    # One battery per phone waiting in the workshop
+    for key in range(keys):
+        services.process_service_entry(
+            f"STRESS-{run_id}-{key}", "Customer", f"STRESS-{run_id}-PICK-{key}", "T", "V", date(2025, 1, 1), "stress"
+        )
+
+def main():
+    parser = argparse.ArgumentParser(description="Race concurrent writers on the same customers and batteries.")
+    parser.add_argument("db_url", nargs="?", default=DEFAULT_URL)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--rounds", type=int, default=50)
+    parser.add_argument("--keys", type=int, default=3, help="Phones (and batteries) the workers share")
+    args = parser.parse_args()
+
+    os.environ["DB_URL"] = args.db_url
+    database.reset_engine()
+    database.init_db()
+    run_id = f"{int(time.time())}"
+    seed_pickups(run_id, args.keys)
+    barrier = threading.Barrier(args.workers)
+    errors, outcomes = [], Counter()
+    threads = [
+        threading.Thread(target=run_worker, args=(worker, args, run_id, barrier, errors, outcomes))
+        for worker in range(args.workers)
+    ]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    calls = sum(outcomes.values()) + len(errors)
+    print(f"{calls} calls in {elapsed:.1f}s ({calls / elapsed:.0f} calls/s): "
+          + ", ".join(f"{count} {name}" for name, count in sorted(outcomes.items())))
+    for error, count in Counter(errors).most_common(5):
+        print(f"{count}x {error}")
+    problems = check(args, run_id, outcomes)
+    for problem in problems[:20]:
+        print(problem)
+    if errors or problems:
+        print(f"FAILED: {len(errors)} errors, {len(problems)} inconsistencies")
+        return 1
+    print("OK: no errors, no lost or torn updates, every pickup handled once")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,122 @@
+import re
+import sys
+from datetime import date, datetime
+from sqlalchemy import event, text
+from database import get_db_engine, init_db
+import services
+
+# Runs each read service against the configured database, captures the SQL it
+# emits and checks the query plan of every filtered statement. A statement
+# fails if the planner has to scan a whole table to answer it.
+
+SAMPLE_SERIAL = "CHECK-SERIAL"
+SAMPLE_PHONE = "0000000000"
+SAMPLE_TICKET = "CHECK-TICKET"
+SAMPLE_FROM = date(2024, 1, 1)
+SAMPLE_TO = date(2024, 3, 31)
+SAMPLE_TERM = "CHECK"
+
+SERVICE_CALLS = [
+    ("get_dashboard_stats", lambda: services.get_dashboard_stats()),
+    ("get_service_queue_df", lambda: services.get_service_queue_df()),
+    ("get_service_queue_df (filtered page)", lambda: services.get_service_queue_df(status="pending", loaner=True, age_bucket="1-2 years", page_size=10, cursor=(SAMPLE_FROM, SAMPLE_SERIAL))),
+    ("get_battery_by_serial", lambda: services.get_battery_by_serial(SAMPLE_SERIAL)),
+    ("get_battery_details_df", lambda: services.get_battery_details_df(SAMPLE_SERIAL)),
+    ("get_battery_exchanges_df", lambda: services.get_battery_exchanges_df(SAMPLE_SERIAL)),
+    ("get_battery_exchanges_df (page)", lambda: services.get_battery_exchanges_df(SAMPLE_SERIAL, page_size=25, cursor=1000)),
+    ("get_customer_by_phone", lambda: services.get_customer_by_phone(SAMPLE_PHONE)),
+    ("get_customer_details_df", lambda: services.get_customer_details_df(SAMPLE_PHONE)),
+    ("get_customer_batteries_df", lambda: services.get_customer_batteries_df(SAMPLE_PHONE)),
+    ("get_customer_exchanges_df", lambda: services.get_customer_exchanges_df(SAMPLE_PHONE)),
+    ("get_customer_exchanges_df (page)", lambda: services.get_customer_exchanges_df(SAMPLE_PHONE, page_size=25, cursor=1000)),
+    ("get_customer_profile", lambda: services.get_customer_profile(SAMPLE_PHONE, page_size=25)),
+    ("get_battery_profile", lambda: services.get_battery_profile(SAMPLE_SERIAL, page_size=25, cursor=1000)),
+    ("search_records", lambda: services.search_records(SAMPLE_TERM)),
+    ("get_ticket_history", lambda: services.get_ticket_history(SAMPLE_TICKET)),
+    ("get_ready_for_pickup_items_df", lambda: services.get_ready_for_pickup_items_df(SAMPLE_PHONE)),
+    ("get_pending_factory_stock_df", lambda: services.get_pending_factory_stock_df()),
+    ("get_stock_receipt_history_df", lambda: services.get_stock_receipt_history_df()),
+    ("get_stock_receipt_history_df (page)", lambda: services.get_stock_receipt_history_df(page_size=25, cursor=1000)),
+    ("get_stock_receipt_history_df (dates)", lambda: services.get_stock_receipt_history_df(page_size=25, date_from=SAMPLE_FROM, date_to=SAMPLE_TO)),
+    ("get_customer_exchanges_df (dates)", lambda: services.get_customer_exchanges_df(SAMPLE_PHONE, page_size=25, date_from=SAMPLE_FROM, date_to=SAMPLE_TO)),
+    ("get_scrap_batteries_df (dates)", lambda: services.get_scrap_batteries_df(page_size=25, date_from=SAMPLE_FROM, date_to=SAMPLE_TO)),
+    ("get_challan_batteries_df (dates)", lambda: services.get_challan_batteries_df(page_size=25, date_from=SAMPLE_FROM, date_to=SAMPLE_TO)),
+    ("get_scrap_batteries_df (page)", lambda: services.get_scrap_batteries_df(page_size=25, cursor=(SAMPLE_FROM, SAMPLE_SERIAL))),
+    ("get_challan_batteries_df (page)", lambda: services.get_challan_batteries_df(page_size=25, cursor=(SAMPLE_FROM, SAMPLE_SERIAL))),
+    ("get_batteries_expiring_soon", lambda: services.get_batteries_expiring_soon(30, limit=200)),
+    ("get_receipt_rows_df (dates)", lambda: services.get_receipt_rows_df(SAMPLE_FROM, SAMPLE_TO, page_size=500)),
+    ("get_receipt_rows_df (page)", lambda: services.get_receipt_rows_df(SAMPLE_FROM, SAMPLE_TO, page_size=500, cursor=(datetime(2024, 2, 1), 1000))),
+]
+
+def capture_statements(engine, call):
+    captured = []
+
+    def _record(conn, cursor, statement, parameters, context, executemany):
+        captured.append((statement, parameters))
+
+    event.listen(engine, "before_cursor_execute", _record)
+    try:
+        call()
+    finally:
+        event.remove(engine, "before_cursor_execute", _record)
+    return captured
+
+def explain(engine, statement, parameters):
+    with engine.connect() as conn:
+        if engine.dialect.name == "sqlite":
+            rows = conn.exec_driver_sql("EXPLAIN QUERY PLAN " + statement, parameters).fetchall()
+            return [row[-1] for row in rows]
+        # Small tables make Postgres prefer a sequential scan even when an index
+        # exists, so take it off the table and see whether an index can be used.
+        conn.execute(text("SET LOCAL enable_seqscan = off"))
+        rows = conn.exec_driver_sql("EXPLAIN " + statement, parameters).fetchall()
+        return [row[0].strip() for row in rows]
+
+def uses_index(dialect_name, plan):
+    if dialect_name == "sqlite":
+        # Scanning the single row of a FROM-less SELECT, the rows a subquery
+        # (co-routine) already produced, or a virtual table through one of its
+        # own indexes (FTS5 MATCH shows as "INDEX 0:M1") is not a table scan
+        derived = {line.split()[-1] for line in plan if line.startswith(("CO-ROUTINE", "MATERIALIZE"))}
+        accesses = [
+            line for line in plan
+            if line.startswith(("SCAN", "SEARCH")) and line != "SCAN CONSTANT ROW"
+            and not (line.startswith("SCAN") and line.split()[1] in derived)
+            and not re.search(r"VIRTUAL TABLE INDEX \d+:\S", line)
+        ]
+        return bool(accesses) and all(line.startswith("SEARCH") for line in accesses)
+    return not any("Seq Scan" in line for line in plan)
+
+def check_index_usage(engine):
+    """
+    Returns a list of (service, statement, plan, ok) for every filtered statement
+    issued by the services in SERVICE_CALLS.
+    """
+    results = []
+    for name, call in SERVICE_CALLS:
+        for statement, parameters in capture_statements(engine, call):
+            if not re.search(r"\bWHERE\b", statement, re.IGNORECASE):
+                # Unfiltered aggregates (e.g. total counts) read the whole table by design
+                continue
+            if "pg_catalog" in statement or "sqlite_master" in statement:
+                # Table introspection issued by pandas, not by the service itself
+                continue
+            plan = explain(engine, statement, parameters)
+            results.append((name, statement, plan, uses_index(engine.dialect.name, plan)))
+    return results
+
+if __name__ == "__main__":
+    engine = get_db_engine()
+    init_db()
+    failures = 0
+    for name, statement, plan, ok in check_index_usage(engine):
+        print(f"[{'OK' if ok else 'FAIL'}] {name}")
+        for line in plan:
+            print(f"    {line}")
+        if not ok:
+            failures += 1
+            print(f"    SQL: {' '.join(statement.split())}")
+    if failures:
+        print(f"{failures} statement(s) are not served by an index.")
+        sys.exit(1)
+    print("All service queries use an index.")
@@ -0,0 +1,189 @@
+import argparse
+from datetime import date
+import os
+import sys
+from archive import ARCHIVE_KEEP_YEARS, archive_closed_years
+from database import Base, get_db_engine, init_db
+from ledger import diff_ledger, rebuild_ledger_state, replay_ledger
+from migrations import run_migrations
+from receipts import write_receipts_html, write_receipts_zip
+from services import (
+    EXPORT_TABLES, bulk_import_inventory, clear_challan_to_archive,
+    backfill_warranty_expiry, export_table_csv, move_scrap_to_challan, rebuild_rollups, refresh_rollups
+)
+
+# Bulk operations from the command line, on the same services the app uses
+# but without Streamlit. The database comes from DB_URL (environment or
+# .streamlit/secrets.toml) unless --db-url is given; DB_URL is only read when
+# the first command touches the database.
+#
+#   python cli.py import stock.csv [--rejects rejects.csv]
+#   python cli.py challan SERIAL [SERIAL ...]
+#   python cli.py archive
+#   python cli.py export batteries [--out batteries.csv]
+#   python cli.py receipts --from 2025-01-01 --to 2025-01-31 --out january.zip
+#   python cli.py rollups [--rebuild]
+#   python cli.py warranty [--recompute]
+#   python cli.py ledger [--rebuild] [--out divergent.csv]
+#   python cli.py archive-exchanges [--keep-years 2]
+#   python cli.py migrate
+
+def cmd_import(args):
+    def progress(rows, inserted):
+        print(f"\r{rows} rows read, {inserted} added", end="", file=sys.stderr, flush=True)
+
+    with open(args.file, "rb") as f:
+        result = bulk_import_inventory(f, os.path.basename(args.file), on_progress=progress)
+    print(file=sys.stderr)
+    rejects = result["rejects"]
+    print(f"Imported {result['inserted']} of {result['rows']} rows; {len(rejects)} rejected.")
+    if args.rejects:
+        rejects.to_csv(args.rejects, index=False)
+        print(f"Rejected rows written to {args.rejects}")
+    elif not rejects.empty:
+        print(rejects.head(20).to_string(index=False))
+    return 0
+
+def cmd_challan(args):
+    moved = move_scrap_to_challan(args.serials)
+    print(f"Moved {moved} of {len(args.serials)} batteries from scrap to the challan.")
+    return 0 if moved == len(args.serials) else 1
+
+def cmd_archive(args):
+    archived = clear_challan_to_archive()
+    print(f"Archived {archived} challan batteries.")
+    return 0
+
+def cmd_export(args):
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            rows = export_table_csv(args.table, f)
+        print(f"Exported {rows} {args.table} rows to {args.out}", file=sys.stderr)
+    else:
+        rows = export_table_csv(args.table, sys.stdout)
+        print(f"Exported {rows} {args.table} rows", file=sys.stderr)
+    return 0
+
+def cmd_receipts(args):
+    if args.out.endswith(".zip"):
+        with open(args.out, "wb") as f:
+            count = write_receipts_zip(f, args.date_from, args.date_to)
+    else:
+        with open(args.out, "w", encoding="utf-8") as f:
+            count = write_receipts_html(f, args.date_from, args.date_to)
+    print(f"Wrote {count} receipts to {args.out}")
+    return 0
+
+def cmd_rollups(args):
+    counted = rebuild_rollups() if args.rebuild else refresh_rollups()
+    print(f"Counted {counted} exchanges into the report rollups.")
+    return 0
+
+def cmd_warranty(args):
+    updated = backfill_warranty_expiry(overwrite=args.recompute)
+    print(f"Set the warranty expiry of {updated} batteries.")
+    return 0
+
+def cmd_ledger(args):
+    def progress(replayed):
+        print(f"\r{replayed} exchanges replayed", end="", file=sys.stderr, flush=True)
+
+    replayed = rebuild_ledger_state(on_progress=progress) if args.rebuild else replay_ledger(on_progress=progress)
+    if replayed:
+        print(file=sys.stderr)
+    print(f"Replayed {replayed} exchanges into the ledger state.")
+    if args.out:
+        with open(args.out, "w", newline="") as f:
+            counts = diff_ledger(f)
+    else:
+        counts = diff_ledger()
+    print(f"{counts['total']} batteries diverge from the ledger: {counts['status']} by status, "
+          f"{counts['owner']} by owner, {counts['missing_battery']} with no battery row.")
+    if args.out:
+        print(f"Divergent batteries written to {args.out}")
+    return 1 if counts["total"] else 0
+
+def cmd_archive_exchanges(args):
+    def progress(year, rows):
+        print(f"Archived {rows} exchanges of {year}.")
+
+    archived = archive_closed_years(args.keep_years, on_progress=progress)
+    if not archived:
+        print("No closed years to archive.")
+    return 0
+
+def cmd_migrate(args):
+    # init_db would run them as well; this one reports what was applied
+    engine = get_db_engine()
+    Base.metadata.create_all(engine)
+    applied = run_migrations(engine)
+    if applied:
+        print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+    else:
+        print("Database schema is up to date.")
+    return 0
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Battery shop bulk operations.")
+    parser.add_argument("--db-url", help="Database URL (overrides DB_URL)")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    p = commands.add_parser("import", help="Add stock from a CSV or Excel file")
+    p.add_argument("file")
+    p.add_argument("--rejects", help="Write rejected rows to this CSV file")
+    p.set_defaults(func=cmd_import, needs_schema=True)
+
+    p = commands.add_parser("challan", help="Move scrap batteries onto the challan")
+    p.add_argument("serials", nargs="+")
+    p.set_defaults(func=cmd_challan, needs_schema=True)
+
+    p = commands.add_parser("archive", help="Archive every battery on the challan")
+    p.set_defaults(func=cmd_archive, needs_schema=True)
+
+    p = commands.add_parser("export", help="Export a table as CSV")
+    p.add_argument("table", choices=list(EXPORT_TABLES))
+    p.add_argument("--out", help="Output file (default: stdout)")
+    p.set_defaults(func=cmd_export, needs_schema=True)
+
+    p = commands.add_parser("receipts", help="Reprint warranty receipts for a date range")
+    p.add_argument("--from", dest="date_from", type=date.fromisoformat, help="First day (YYYY-MM-DD)")
+    p.add_argument("--to", dest="date_to", type=date.fromisoformat, help="Last day (YYYY-MM-DD)")
+    p.add_argument("--out", required=True, help="Output file: .zip for one HTML file per receipt, otherwise one combined HTML")
+    p.set_defaults(func=cmd_receipts, needs_schema=True)
+
+    p = commands.add_parser("rollups", help="Bring the report rollups up to date")
+    p.add_argument("--rebuild", action="store_true", help="Recount the whole exchanges ledger")
+    p.set_defaults(func=cmd_rollups, needs_schema=True)
+
+    p = commands.add_parser("warranty", help="Fill in missing warranty expiry dates from the model catalog")
+    p.add_argument("--recompute", action="store_true", help="Recompute every battery, e.g. after a warranty term changed")
+    p.set_defaults(func=cmd_warranty, needs_schema=True)
+
+    p = commands.add_parser("ledger", help="Replay the exchanges ledger and report batteries that diverge from it")
+    p.add_argument("--rebuild", action="store_true", help="Discard the snapshot and replay the whole ledger")
+    p.add_argument("--out", help="Write the divergent batteries to this CSV file")
+    p.set_defaults(func=cmd_ledger, needs_schema=True)
+
+    p = commands.add_parser("archive-exchanges", help="Move closed years of exchanges out to Parquet files")
+    p.add_argument("--keep-years", type=int, default=ARCHIVE_KEEP_YEARS,
+                   help="Years kept in the exchanges table, counting the current one (default: %(default)s)")
+    p.set_defaults(func=cmd_archive_exchanges, needs_schema=True)
+
+    p = commands.add_parser("migrate", help="Create missing tables and apply pending migrations")
+    p.set_defaults(func=cmd_migrate, needs_schema=False)
+    return parser
+
+def main(argv=None):
+    args = build_parser().parse_args(argv)
+    if args.db_url:
+        os.environ["DB_URL"] = args.db_url
+    try:
+        if args.needs_schema:
+            init_db()
+        return args.func(args)
+    except RuntimeError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        return 2
+
+if __name__ == "__main__":
+    sys.exit(main())
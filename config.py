@@ -1,9 +1,63 @@
-import streamlit as st
+import functools
+import os
+import tomllib
+
+# Settings come from the environment first, then from the same secrets.toml
+# files Streamlit reads (the project's .streamlit/secrets.toml, then the one in
+# the home directory), so the services, scripts and the CLI need no Streamlit
+# runtime. Streamlit Community Cloud also exports root-level secrets as
+# environment variables.
+SECRETS_FILES = [
+    os.path.join(os.getcwd(), ".streamlit", "secrets.toml"),
+    os.path.join(os.path.expanduser("~"), ".streamlit", "secrets.toml"),
+]
+
+@functools.lru_cache(maxsize=None)
+def _secrets():
+    secrets = {}
+    # The project file wins over the global one, as in Streamlit
+    for path in reversed(SECRETS_FILES):
+        if os.path.exists(path):
+            with open(path, "rb") as f:
+                secrets.update(tomllib.load(f))
+    return secrets
+
+def get_setting(name, default=None):
+    value = os.environ.get(name)
+    if value is not None:
+        return value
+    return _secrets().get(name, default)
 
 def get_db_url():
-    return st.secrets.get("DB_URL")
+    return get_setting("DB_URL")
+
+def get_instrumentation_enabled():
+    # Opt-in query instrumentation (see instrumentation.py)
+    return str(get_setting("INSTRUMENTATION", False)).lower() in ("1", "true", "yes", "on")
+
+def get_exchange_archive_dir():
+    # Where archive.py writes closed years of exchanges as Parquet files
+    return get_setting("EXCHANGE_ARCHIVE_DIR", "exchange_archive")
 
 def get_admin_credentials():
-    return st.secrets.get("ADMIN_USER", "admin"), st.secrets.get("ADMIN_PASSWORD", "exide23")
+    return get_setting("ADMIN_USER", "admin"), get_setting("ADMIN_PASSWORD", "exide23")
 
 SHOP_NAME = "EXIDE CARE VIKAS 23"
+
+# Warranty terms per model, counted from the date of purchase. A battery's
+# warranty_expiry is derived from these on every write; after changing a term,
+# run `python cli.py warranty --recompute` to update the stored dates.
+BATTERY_CATALOG = {
+    "Exide Mileage": {"warranty_months": 48},
+    "Exide Matrix": {"warranty_months": 72},
+    "Exide Eezy": {"warranty_months": 36},
+    "Exide Gold": {"warranty_months": 48},
+    "Exide Epiq": {"warranty_months": 60},
+    "Exide Express": {"warranty_months": 48},
+    "Exide Drive": {"warranty_months": 36},
+    "Exide Eko": {"warranty_months": 24},
+    "Exide Ride": {"warranty_months": 36},
+    "Exide Xplore": {"warranty_months": 48},
+}
+
+BATTERY_MODELS = list(BATTERY_CATALOG)
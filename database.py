@@ -1,29 +1,72 @@
+from contextlib import contextmanager
+import functools
 from sqlalchemy import create_engine
 from sqlalchemy.orm import sessionmaker, declarative_base
-from config import get_db_url
-import streamlit as st
+from config import get_db_url, get_instrumentation_enabled
+from migrations import ensure_exchange_partitions, run_migrations
+import instrumentation
 
 Base = declarative_base()
 
-@st.cache_resource
+# One engine, session factory and schema check per process. Call
+# reset_engine() after changing DB_URL to build them again.
+
+@functools.lru_cache(maxsize=None)
 def get_db_engine():
     db_url = get_db_url()
     if not db_url:
-        st.error("Missing DB_URL in Streamlit Secrets!")
-        st.stop()
-    return create_engine(
+        raise RuntimeError("Missing DB_URL: set it in the environment or in .streamlit/secrets.toml")
+    instrumented = get_instrumentation_enabled()
+    instrumentation.enable(instrumented)
+    engine = create_engine(
         db_url,
         pool_pre_ping=True,
         pool_size=10,
-        max_overflow=20
+        max_overflow=20,
+        # Measures how long services wait for a pooled connection
+        **({"poolclass": instrumentation.TimedQueuePool} if instrumented else {})
     )
+    if instrumented:
+        instrumentation.instrument_engine(engine)
+    return engine
+
+@functools.lru_cache(maxsize=None)
+def get_session_factory():
+    # expire_on_commit=False keeps objects returned by the services readable after
+    # their session has committed and closed.
+    return sessionmaker(bind=get_db_engine(), expire_on_commit=False)
 
 def get_session():
-    engine = get_db_engine()
-    Session = sessionmaker(bind=engine)
-    return Session()
+    return get_session_factory()()
 
-@st.cache_resource
+@contextmanager
+def unit_of_work():
+    """
+    Opens one session - one pooled connection and one transaction - that can be
+    passed to several service calls via their `session` argument.
+    Commits when the block exits normally and rolls back if it raises.
+    """
+    session = get_session()
+    try:
+        yield session
+        session.commit()
+    except Exception:
+        session.rollback()
+        raise
+    finally:
+        session.close()
+
+@functools.lru_cache(maxsize=None)
 def init_db():
     engine = get_db_engine()
     Base.metadata.create_all(engine)
+    run_migrations(engine)
+    with engine.begin() as conn:
+        ensure_exchange_partitions(conn)
+
+def reset_engine():
+    if get_db_engine.cache_info().currsize:
+        get_db_engine().dispose()
+    get_db_engine.cache_clear()
+    get_session_factory.cache_clear()
+    init_db.cache_clear()
@@ -0,0 +1,250 @@
+import functools
+import inspect
+import json
+import logging
+import threading
+import time
+from collections import Counter, deque
+from contextvars import ContextVar
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+
+# Opt-in query instrumentation. When enabled (INSTRUMENTATION in the secrets or
+# the environment, see config.get_instrumentation_enabled), database.py builds
+# the engine with TimedQueuePool and calls instrument_engine, and every service
+# decorated with @track_service records its latency, statement count, number
+# of result rows handed back to the caller, time spent in the database and time
+# spent waiting for a pooled connection. A call that runs the same SQL N_PLUS_ONE_THRESHOLD times or more
+# is flagged as a likely N+1.
+#
+# Disabled, track_service costs one flag check per call and no engine events
+# are registered.
+
+N_PLUS_ONE_THRESHOLD = 5
+RECENT_CALLS = 200
+
+logger = logging.getLogger("battery_shop.instrumentation")
+
+_enabled = False
+_lock = threading.Lock()
+_totals = {}
+_recent = deque(maxlen=RECENT_CALLS)
+# The outermost service call running in this thread, and the calls made during
+# the current Streamlit rerun
+_current_call = ContextVar("current_service_call", default=None)
+_rerun_calls = ContextVar("rerun_service_calls", default=None)
+
+
+def enable(enabled=True):
+    global _enabled
+    _enabled = enabled
+    if enabled and not logger.handlers:
+        # One line per rerun on stderr, next to Streamlit's own log
+        handler = logging.StreamHandler()
+        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s %(message)s"))
+        logger.addHandler(handler)
+        logger.setLevel(logging.INFO)
+        logger.propagate = False
+
+
+def is_enabled():
+    return _enabled
+
+
+class _CallStats:
+    __slots__ = ("name", "started", "statements", "db_ms", "pool_wait_ms", "result_rows", "sql")
+
+    def __init__(self, name):
+        self.name = name
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.db_ms = 0.0
+        self.pool_wait_ms = 0.0
+        self.result_rows = 0
+        self.sql = Counter()
+
+
+def _count_result_rows(result):
+    # Rows handed back to the caller, not rows the database read: DataFrames
+    # and lists by length, the frames of a profile dict summed, a single ORM
+    # object as one row
+    if result is None or isinstance(result, (bool, int, float, str)):
+        return 0
+    if isinstance(result, dict):
+        return sum(len(value) for value in result.values() if hasattr(value, "columns"))
+    if hasattr(result, "__len__"):
+        return len(result)
+    return 1
+
+
+def _record(stats, elapsed_ms):
+    repeated = {sql: count for sql, count in stats.sql.items() if count >= N_PLUS_ONE_THRESHOLD}
+    call = {
+        "service": stats.name,
+        "ms": round(elapsed_ms, 2),
+        "statements": stats.statements,
+        "result_rows": stats.result_rows,
+        "db_ms": round(stats.db_ms, 2),
+        "pool_wait_ms": round(stats.pool_wait_ms, 2),
+        "repeated": {" ".join(sql.split())[:200]: count for sql, count in repeated.items()},
+    }
+    with _lock:
+        total = _totals.setdefault(stats.name, {
+            "calls": 0, "total_ms": 0.0, "max_ms": 0.0, "statements": 0, "result_rows": 0,
+            "db_ms": 0.0, "pool_wait_ms": 0.0, "n_plus_one_calls": 0,
+        })
+        total["calls"] += 1
+        total["total_ms"] += elapsed_ms
+        total["max_ms"] = max(total["max_ms"], elapsed_ms)
+        total["statements"] += stats.statements
+        total["result_rows"] += stats.result_rows
+        total["db_ms"] += stats.db_ms
+        total["pool_wait_ms"] += stats.pool_wait_ms
+        total["n_plus_one_calls"] += bool(repeated)
+        _recent.append(call)
+    rerun = _rerun_calls.get()
+    if rerun is not None:
+        rerun.append(call)
+    if repeated:
+        logger.warning("Possible N+1 in %s: %s", stats.name, json.dumps(call["repeated"]))
+
+
+def track_service(func):
+    """
+    Records one call of a service function. Services called from inside
+    another tracked service are counted as part of the outer call.
+    """
+    if inspect.isgeneratorfunction(func):
+        return _track_generator(func)
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled or _current_call.get() is not None:
+            return func(*args, **kwargs)
+        stats = _CallStats(func.__name__)
+        token = _current_call.set(stats)
+        try:
+            result = func(*args, **kwargs)
+            stats.result_rows = _count_result_rows(result)
+            return result
+        finally:
+            _current_call.reset(token)
+            _record(stats, (time.perf_counter() - stats.started) * 1000)
+    return wrapper
+
+
+def _track_generator(func):
+    # A generator service does its work while it is iterated, not when it is
+    # called. The call is recorded once the iteration ends (or is abandoned);
+    # its latency is the time spent inside the generator, not in the loop
+    # consuming it, and its result rows are those of every item yielded.
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        if not _enabled or _current_call.get() is not None:
+            yield from func(*args, **kwargs)
+            return
+        stats = _CallStats(func.__name__)
+        inner = func(*args, **kwargs)
+        busy_ms = 0.0
+        try:
+            while True:
+                token = _current_call.set(stats)
+                started = time.perf_counter()
+                try:
+                    item = next(inner)
+                except StopIteration:
+                    return
+                finally:
+                    busy_ms += (time.perf_counter() - started) * 1000
+                    _current_call.reset(token)
+                stats.result_rows += _count_result_rows(item)
+                yield item
+        finally:
+            inner.close()
+            _record(stats, busy_ms)
+    return wrapper
+
+
+class TimedQueuePool(QueuePool):
+    """QueuePool that charges the time spent waiting for a connection to the running service."""
+
+    def connect(self):
+        started = time.perf_counter()
+        connection = super().connect()
+        stats = _current_call.get()
+        if stats is not None:
+            stats.pool_wait_ms += (time.perf_counter() - started) * 1000
+        return connection
+
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    conn.info.setdefault("instrumentation_started", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    started = conn.info["instrumentation_started"].pop()
+    stats = _current_call.get()
+    if stats is not None:
+        stats.statements += 1
+        stats.db_ms += (time.perf_counter() - started) * 1000
+        stats.sql[statement] += 1
+
+
+def _handle_error(exception_context):
+    # A failed statement never reaches after_cursor_execute
+    started = exception_context.connection.info.get("instrumentation_started") if exception_context.connection else None
+    if started:
+        started.pop()
+
+
+def instrument_engine(engine):
+    event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    event.listen(engine, "handle_error", _handle_error)
+
+
+# --- REPORTING ---
+def start_rerun():
+    """Starts collecting the service calls of one Streamlit rerun."""
+    if _enabled:
+        _rerun_calls.set([])
+
+
+def log_rerun(page, started):
+    """Writes one structured log line for the rerun started with start_rerun()."""
+    calls = _rerun_calls.get()
+    if not _enabled or calls is None:
+        return
+    _rerun_calls.set(None)
+    logger.info(json.dumps({
+        "event": "rerun",
+        "page": page,
+        "ms": round((time.perf_counter() - started) * 1000, 2),
+        "service_calls": len(calls),
+        "statements": sum(call["statements"] for call in calls),
+        "db_ms": round(sum(call["db_ms"] for call in calls), 2),
+        "pool_wait_ms": round(sum(call["pool_wait_ms"] for call in calls), 2),
+        "n_plus_one": sorted({call["service"] for call in calls if call["repeated"]}),
+        "services": calls,
+    }))
+
+
+def service_totals():
+    """Per-service totals since start-up (or the last reset), slowest first."""
+    with _lock:
+        rows = [{"service": name, **total} for name, total in _totals.items()]
+    for row in rows:
+        row["avg_ms"] = row["total_ms"] / row["calls"]
+        row["avg_statements"] = row["statements"] / row["calls"]
+    return sorted(rows, key=lambda row: row["total_ms"], reverse=True)
+
+
+def recent_calls():
+    with _lock:
+        return list(reversed(_recent))
+
+
+def reset():
+    with _lock:
+        _totals.clear()
+        _recent.clear()
@@ -0,0 +1,194 @@
+import pandas as pd
+from sqlalchemy import and_, case, func, or_, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from database import unit_of_work
+from instrumentation import track_service
+from models import Battery, BatteryLedgerState, Exchange, RollupCheckpoint
+from services import STATUS_UPDATE_ACTION, now, iter_archived_exchanges
+
+# The exchanges table is the shop's event log; batteries.status is kept
+# separately and can drift from it (an exchange logged for a serial that has no
+# battery row, a status set without an exchange, a hand edit). replay_ledger()
+# rebuilds each battery's status and owner from the exchanges alone into
+# battery_ledger_state, and diff_ledger() compares that with batteries.
+#
+# The replay reads the ledger in id order, chunk_size exchanges per
+# transaction, and commits the state of each chunk together with its
+# checkpoint. The state table is therefore a snapshot as of the checkpoint:
+# a later run only replays exchanges above it, and memory never holds more
+# than one chunk.
+#
+#   python cli.py ledger [--rebuild] [--out divergent.csv]
+
+LEDGER_CHECKPOINT = "battery_ledger"
+LEDGER_CHUNK_SIZE = 50000
+
+# action_taken -> status it leaves the old_battery_serial in. STATUS_UPDATED
+# carries its status in exchanges.status instead.
+OLD_BATTERY_STATUS = {
+    "STOCK_RECEIVED": "in_stock",
+    "SERVICE_PENDING": "pending",
+    "NEW_REPLACEMENT_ISSUED": "returned_faulty/WNA",
+    "RETURNED_TO_CUSTOMER": "active_with_customer",
+}
+# A replacement hands the new battery to the customer
+NEW_BATTERY_STATUS = {"NEW_REPLACEMENT_ISSUED": "sold"}
+# Actions that make customer_phone the owner of the old / new battery
+OWNER_OF_OLD = {"SERVICE_PENDING"}
+OWNER_OF_NEW = {"NEW_REPLACEMENT_ISSUED"}
+
+LEDGER_COLUMNS = ["id", "action_taken", "old_battery_serial", "new_battery_serial", "customer_phone", "status"]
+DIFF_COLUMNS = ["serial_no", "kind", "ledger_status", "battery_status", "ledger_owner", "battery_owner", "last_exchange_id"]
+
+
+def _insert(session):
+    return pg_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+
+def _events(chunk):
+    """One row per battery an exchange touched: serial_no, status, owner (or None), id."""
+    old_status = chunk["action_taken"].map(OLD_BATTERY_STATUS)
+    updated = chunk["action_taken"] == STATUS_UPDATE_ACTION
+    old_status[updated] = chunk.loc[updated, "status"]
+    old = pd.DataFrame({
+        "serial_no": chunk["old_battery_serial"],
+        "status": old_status,
+        "owner": chunk["customer_phone"].where(chunk["action_taken"].isin(OWNER_OF_OLD)),
+        "id": chunk["id"],
+    })
+    replaced = chunk["action_taken"].isin(NEW_BATTERY_STATUS)
+    new = pd.DataFrame({
+        "serial_no": chunk.loc[replaced, "new_battery_serial"],
+        "status": chunk.loc[replaced, "action_taken"].map(NEW_BATTERY_STATUS),
+        "owner": chunk.loc[replaced, "customer_phone"].where(chunk.loc[replaced, "action_taken"].isin(OWNER_OF_NEW)),
+        "id": chunk.loc[replaced, "id"],
+    })
+    events = pd.concat([old, new], ignore_index=True)
+    events = events[events["serial_no"].notna() & (events["serial_no"] != "") & events["status"].notna()]
+    return events.sort_values("id", kind="stable")
+
+def _chunk_state(chunk):
+    """Latest status and owner per battery within one chunk of the ledger."""
+    events = _events(chunk)
+    if events.empty:
+        return []
+    latest = events.groupby("serial_no").agg(status=("status", "last"), last_exchange_id=("id", "max"))
+    # Only some actions name an owner; the others keep the one on record
+    latest["current_owner_phone"] = events.dropna(subset=["owner"]).groupby("serial_no")["owner"].last()
+    latest = latest.reset_index().astype(object)
+    return latest.where(latest.notna(), None).to_dict("records")
+
+def _save_state(session, rows):
+    if not rows:
+        return
+    state = BatteryLedgerState.__table__
+    stmt = _insert(session)(state)
+    session.execute(stmt.on_conflict_do_update(
+        index_elements=[state.c.serial_no],
+        set_={
+            "status": stmt.excluded.status,
+            "current_owner_phone": func.coalesce(stmt.excluded.current_owner_phone, state.c.current_owner_phone),
+            "last_exchange_id": stmt.excluded.last_exchange_id,
+        },
+    ), rows)
+
+@track_service
+def replay_ledger(chunk_size=LEDGER_CHUNK_SIZE, on_progress=None):
+    """
+    Replays the exchanges above the checkpoint into battery_ledger_state.
+    Returns the number of exchanges replayed.
+    """
+    replayed = 0
+    while True:
+        with unit_of_work() as session:
+            session.execute(
+                _insert(session)(RollupCheckpoint.__table__)
+                .values(name=LEDGER_CHECKPOINT, last_exchange_id=0)
+                .on_conflict_do_nothing(index_elements=["name"])
+            )
+            mark = session.scalar(select(RollupCheckpoint.last_exchange_id).where(RollupCheckpoint.name == LEDGER_CHECKPOINT))
+            chunk = pd.read_sql(
+                select(*[Exchange.__table__.c[name] for name in LEDGER_COLUMNS])
+                .where(Exchange.id > mark).order_by(Exchange.id).limit(chunk_size),
+                session.connection()
+            )
+            if chunk.empty:
+                return replayed
+            # Another replay that got here first has moved the mark: stop rather than apply the chunk twice
+            claimed = session.execute(
+                update(RollupCheckpoint)
+                .where(RollupCheckpoint.name == LEDGER_CHECKPOINT, RollupCheckpoint.last_exchange_id == mark)
+                .values(last_exchange_id=int(chunk["id"].iloc[-1]), updated_at=now())
+            ).rowcount
+            if not claimed:
+                return replayed
+            _save_state(session, _chunk_state(chunk))
+        replayed += len(chunk)
+        if on_progress:
+            on_progress(replayed)
+
+@track_service
+def rebuild_ledger_state(chunk_size=LEDGER_CHUNK_SIZE, on_progress=None):
+    """
+    Discards the snapshot and replays the whole ledger: the archived years
+    first (archive.py), then the exchanges table. Returns the number of
+    exchanges replayed.
+    """
+    def progress(replayed):
+        if on_progress:
+            on_progress(archived + replayed)
+
+    with unit_of_work() as session:
+        session.execute(BatteryLedgerState.__table__.delete())
+        session.execute(RollupCheckpoint.__table__.delete().where(RollupCheckpoint.name == LEDGER_CHECKPOINT))
+    # Archived ids all come before the table's, so the checkpoint stays at 0 until replay_ledger
+    archived = 0
+    for chunk in iter_archived_exchanges(LEDGER_COLUMNS, chunk_size):
+        with unit_of_work() as session:
+            _save_state(session, _chunk_state(chunk))
+        archived += len(chunk)
+        progress(0)
+    return archived + replay_ledger(chunk_size, progress)
+
+def _divergent_query():
+    state = BatteryLedgerState
+    missing = Battery.serial_no.is_(None)
+    status_differs = Battery.status.is_distinct_from(state.status)
+    owner_differs = and_(state.current_owner_phone.isnot(None),
+                         Battery.current_owner_phone.is_distinct_from(state.current_owner_phone))
+    kind = case(
+        (missing, "missing_battery"),
+        (status_differs, "status"),
+        else_="owner",
+    )
+    return (
+        select(state.serial_no, kind.label("kind"), state.status.label("ledger_status"),
+               Battery.status.label("battery_status"), state.current_owner_phone.label("ledger_owner"),
+               Battery.current_owner_phone.label("battery_owner"), state.last_exchange_id)
+        .select_from(state)
+        .outerjoin(Battery, Battery.serial_no == state.serial_no)
+        .where(or_(missing, status_differs, owner_differs))
+        .order_by(state.serial_no)
+        .execution_options(stream_results=True)
+    )
+
+@track_service
+def diff_ledger(file_obj=None, chunk_size=LEDGER_CHUNK_SIZE):
+    """
+    Compares the replayed state with batteries, as of the last replay. Returns
+    counts of divergent batteries by kind - missing_battery (exchanges for a
+    serial with no battery row), status, owner - plus "total", and writes the
+    divergent rows as CSV to `file_obj` if given. Rows are streamed, never
+    loaded at once.
+    """
+    counts = {"missing_battery": 0, "status": 0, "owner": 0, "total": 0}
+    with unit_of_work() as session:
+        for chunk in pd.read_sql(_divergent_query(), session.connection(), chunksize=chunk_size):
+            for kind, n in chunk["kind"].value_counts().items():
+                counts[kind] += int(n)
+            counts["total"] += len(chunk)
+            if file_obj is not None:
+                chunk.to_csv(file_obj, header=counts["total"] == len(chunk), index=False)
+    if file_obj is not None and counts["total"] == 0:
+        pd.DataFrame(columns=DIFF_COLUMNS).to_csv(file_obj, index=False)
+    return counts
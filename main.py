@@ -1,85 +1,291 @@
+import json
+import time
 import streamlit as st
 import pandas as pd
-from datetime import datetime
-from config import SHOP_NAME
-from auth import check_login
-from database import init_db
+from datetime import date, datetime
+from config import SHOP_NAME, BATTERY_MODELS
+from auth import check_login, is_admin
+from database import init_db, unit_of_work
+import instrumentation
+import otp
+from receipts import receipts_file, render_receipt
 from services import (
-    calculate_age, generate_otp, send_otp_simulation,
-    get_battery_by_serial, update_battery_status,
+    calculate_age, calculate_ages,
+    get_battery_by_serial, update_battery_status, StatusConflictError,
     process_new_battery_exchange, process_service_entry,
-    process_return_to_customer, process_stock_reception,
-    upsert_battery, get_dashboard_stats, get_batteries_in_service,
+    process_return_to_customer, process_stock_receptions,
+    upsert_battery, get_dashboard_stats, get_service_queue_df, SERVICE_AGE_BUCKETS,
     get_recent_exchanges_df, get_ready_for_pickup_items_df,
-    get_battery_details_df, get_battery_exchanges_df,
-    get_customer_details_df, get_customer_batteries_df,
-    get_customer_exchanges_df, add_inventory_stock,
+    get_battery_profile, get_customer_profile,
+    add_inventory_stock, bulk_import_inventory,
     get_pending_factory_stock_df, get_stock_receipt_history_df,
-    get_customer_by_phone, get_scrap_batteries_df,
-    move_scrap_to_challan, get_challan_batteries_df, clear_challan_to_archive
+    get_customer_by_phone, get_scrap_batteries_df, get_ticket_history,
+    move_scrap_to_challan, get_challan_batteries_df, clear_challan_to_archive,
+    search_records, SEARCH_MIN_CHARS,
+    refresh_rollups, get_rollup_df, get_rollup_checkpoint,
+    warranty_status, get_batteries_expiring_soon, WARRANTY_EXPIRING_DAYS
 )
 import streamlit.components.v1 as components
 
-# --- CONSTANTS ---
-BATTERY_MODELS = [
-    "Exide Mileage", "Exide Matrix", "Exide Eezy", "Exide Gold",
-    "Exide Epiq", "Exide Express", "Exide Drive", "Exide Eko",
-    "Exide Ride", "Exide Xplore"
-]
+HISTORY_PAGE_SIZE = 25
+QUEUE_PAGE_SIZE = 10
+EXPIRING_LIST_LIMIT = 200
 
 # --- CALLBACKS ---
+OTP_ERRORS = {
+    otp.INVALID: "Invalid OTP.",
+    otp.LOCKED: "Too many wrong attempts. Send a new OTP.",
+    otp.EXPIRED: "OTP has expired. Send a new OTP.",
+    otp.UNKNOWN: "OTP has expired. Send a new OTP.",
+}
+
+
+def send_otp(phone, purpose):
+    # Queues the SMS and returns at once; otp_delivery_notice() follows it up
+    otp.cancel_otp(st.session_state.get("otp_token"))
+    st.session_state.otp_token = otp.request_otp(phone, purpose)
+    st.session_state.otp_purpose = purpose
+
+
+def check_otp_input(input_key):
+    result = otp.check_otp(st.session_state.otp_token, st.session_state[input_key])
+    if result == otp.VERIFIED:
+        return True
+    st.error(OTP_ERRORS[result])
+    return False
+
+
 def verify_claim_otp():
-    if st.session_state.claim_otp_input == st.session_state.current_otp:
+    if check_otp_input("claim_otp_input"):
         st.session_state.otp_verified = True
-    else:
-        st.error("Invalid OTP.")
 
 
 def verify_pickup_otp():
-    if st.session_state.pickup_otp_input == st.session_state.current_otp:
+    if check_otp_input("pickup_otp_input"):
         st.session_state.pickup_verified = True
+
+
+def resend_otp():
+    send_otp(st.session_state.temp_phone, st.session_state.otp_purpose)
+
+
+def receive_stock(serials):
+    received = process_stock_receptions(serials)
+    skipped = sorted(set(serials) - set(received))
+    st.session_state.stock_receive_result = (received, skipped)
+    st.session_state.receive_scan_list = ""
+    # New editor key so the ticked rows don't carry over onto the refreshed list
+    st.session_state.stock_receive_round = st.session_state.get("stock_receive_round", 0) + 1
+
+
+def save_battery_status(serial, status, version):
+    # `version` is bound when the button is drawn, so a change made at another
+    # counter since then is refused instead of overwritten
+    try:
+        if update_battery_status(serial, status, expected_version=version):
+            st.session_state.status_update_result = ("success", f"Status of {serial} updated to {status}!")
+        else:
+            st.session_state.status_update_result = ("warning", f"Battery {serial} was not found; nothing was updated.")
+    except StatusConflictError as e:
+        st.session_state.status_update_result = ("warning", str(e))
+
+
+def update_report_tables():
+    counted = refresh_rollups()
+    st.session_state.reports_update_result = f"Counted {counted} new exchanges into the reports."
+
+
+def pick_search_match(options):
+    choice = st.session_state.history_quick_pick
+    if choice:
+        kind, key = options[choice]
+        st.session_state.history_search_type = "Battery Serial Number" if kind == "battery" else "Customer Phone"
+        st.session_state.history_query = key
+
+
+def pager_next(key, cursor):
+    st.session_state[key].append(cursor)
+
+
+def pager_previous(key):
+    if len(st.session_state[key]) > 1:
+        st.session_state[key].pop()
+
+
+def keyset_cursor(key):
+    """Cursor of the page currently shown for the pager stored under `key`."""
+    return st.session_state.setdefault(key, [None])[-1]
+
+
+def keyset_controls(key, page, cursor_of, page_size=HISTORY_PAGE_SIZE):
+    """
+    Takes a page fetched with page_size + 1 rows - the extra row tells us there
+    is a next page without a COUNT(*) - draws Previous/Next controls and
+    returns the page trimmed to page_size.
+    """
+    cursors = st.session_state.setdefault(key, [None])
+    has_next = len(page) > page_size
+    page = page.iloc[:page_size]
+
+    if has_next or len(cursors) > 1:
+        col_prev, col_page, col_next = st.columns([1, 2, 1])
+        col_prev.button("◀ Previous", key=f"{key}_prev", disabled=len(cursors) == 1,
+                        on_click=pager_previous, args=(key,))
+        col_page.caption(f"Page {len(cursors)}")
+        if has_next:
+            col_next.button("Next ▶", key=f"{key}_next",
+                            on_click=pager_next, args=(key, cursor_of(page.iloc[-1])))
+    return page
+
+
+def keyset_page(key, fetch, cursor_of, page_size=HISTORY_PAGE_SIZE):
+    """
+    Fetches the current page via fetch(page_size, cursor) and draws Previous/Next
+    controls. The cursors of the pages walked so far are kept in session state
+    under `key`, so include anything that changes the result set (e.g. the
+    search term) in the key.
+    """
+    page = fetch(page_size + 1, keyset_cursor(key))
+    return keyset_controls(key, page, cursor_of, page_size)
+
+
+def date_range_filter(label, key):
+    """Optional from/to date picker. Returns (date_from, date_to); either may be None."""
+    picked = st.date_input(label, value=(), key=key)
+    date_from = picked[0] if len(picked) > 0 else None
+    date_to = picked[1] if len(picked) > 1 else None
+    return date_from, date_to
+
+
+@st.fragment(run_every=1)
+def otp_in_flight(token):
+    # Polls the dispatch queue without rerunning the page; one full rerun once it settles
+    if otp.delivery_status(token)["status"] == otp.QUEUED:
+        st.caption("📨 Sending OTP...")
+    else:
+        st.rerun()
+
+
+def otp_delivery_notice(token):
+    """Shows where the OTP for `token` is: sending, sent, failed or expired."""
+    status = otp.delivery_status(token)
+    if status["status"] == otp.QUEUED:
+        otp_in_flight(token)
+    elif status["status"] == otp.SENT:
+        st.info(f"OTP sent to customer's phone. Valid for {status['expires_in'] // 60 + 1} more min.")
+        provider = otp.get_provider()
+        # The local stand-in sends nothing, so show the message once instead
+        if isinstance(provider, otp.FakeSMSProvider) and st.session_state.get("otp_shown") != token:
+            st.session_state.otp_shown = token
+            st.toast(f"🔔 SMS SENT: {provider.last_message(status['phone'])}", icon="📱")
+    elif status["status"] == otp.FAILED:
+        st.error(f"Could not send the OTP: {status['error']}")
     else:
-        st.error("Invalid OTP.")
+        st.warning("OTP has expired.")
+    if status["status"] in (otp.FAILED, otp.EXPIRED):
+        st.button("Resend OTP", key=f"resend_{token}", on_click=resend_otp)
+
+
+def receipt_reprints():
+    with st.expander("🧾 Reprint Receipts"):
+        st.caption("Warranty replacement receipts for a date range, e.g. end-of-day reprints or an Exide audit. "
+                   "Open the combined file in a browser and print it (or print to PDF) for one receipt per page. "
+                   "For months of receipts, `python cli.py receipts` writes them straight to a file.")
+        date_from, date_to = date_range_filter("Exchanges between", "reprint_date_range")
+        zipped = st.radio("Format", ["Combined HTML", "ZIP (one file per receipt)"], horizontal=True,
+                          key="reprint_format") != "Combined HTML"
+        suffix = f"{date_from or 'all'}_{date_to or date_from or 'today'}"
+        # Rendered only when the button is clicked, on a separate thread
+        st.download_button(
+            "💾 Download Receipts", data=lambda: receipts_file(date_from, date_to, zipped),
+            file_name=f"receipts_{suffix}.{'zip' if zipped else 'html'}",
+            mime="application/zip" if zipped else "text/html", key="reprint_download",
+        )
 
 
 # --- PAGE COMPONENTS ---
 def page_dashboard():
     st.title(f"🔋 {SHOP_NAME} Dashboard")
     
-    stats = get_dashboard_stats()
+    # The headline reads share one connection (the service queue is read further
+    # down, once its filters are known); writes below run in their own
+    # transaction because st.rerun() must not happen inside an open unit of work.
+    with unit_of_work() as session:
+        stats = get_dashboard_stats(session=session)
+        recent = get_recent_exchanges_df(session=session)
+        expiring = get_batteries_expiring_soon(WARRANTY_EXPIRING_DAYS, limit=EXPIRING_LIST_LIMIT, session=session)
+
     col1, col2, col3 = st.columns(3)
     col1.metric("Total Customers", stats["total_customers"])
-    col2.metric("Active Batteries (Replaced)", stats["batteries_replaced"])
+    col2.metric("Batteries Replaced (Returned Faulty)", stats["batteries_replaced"],
+                help="Old batteries swapped out under warranty: status returned_faulty/WNA")
     col3.metric("Total Services/Exchanges", stats["exchanges_done"])
 
+    more = "+" if len(expiring) == EXPIRING_LIST_LIMIT else ""
+    with st.expander(f"⏳ Warranties Expiring in the Next {WARRANTY_EXPIRING_DAYS} Days ({len(expiring)}{more})"):
+        if expiring.empty:
+            st.info("No warranties expire in this period.")
+        else:
+            st.dataframe(
+                expiring[["warranty_expiry", "days_left", "serial_no", "model_type", "customer_name", "current_owner_phone", "vehicle_no"]],
+                hide_index=True, use_container_width=True
+            )
+
+    with st.expander(f"Battery Breakdown ({stats['total_batteries']} batteries)"):
+        col_s, col_m = st.columns(2)
+        col_s.dataframe(
+            pd.DataFrame(sorted(stats["by_status"].items()), columns=["Status", "Count"]),
+            hide_index=True, use_container_width=True
+        )
+        col_m.dataframe(
+            pd.DataFrame(sorted(stats["by_model"].items()), columns=["Model", "Count"]),
+            hide_index=True, use_container_width=True
+        )
+
     st.markdown("---")
     st.subheader("🛠️ Active Service Management")
-    
-    in_service = get_batteries_in_service()
-    
-    if in_service:
+    if "status_update_result" in st.session_state:
+        level, message = st.session_state.pop("status_update_result")
+        st.success(message) if level == "success" else st.warning(message)
+
+    # Only the visible page of the queue is fetched and gets widgets
+    col_status, col_loaner, col_age, col_ticket = st.columns(4)
+    status_filter = col_status.selectbox("Status", ["All", "pending", "ready_for_pickup"], key="queue_status")
+    loaner_filter = col_loaner.selectbox("Loaner", ["All", "With loaner", "No loaner"], key="queue_loaner")
+    age_filter = col_age.selectbox("Age", ["All", *SERVICE_AGE_BUCKETS, "Unknown"], key="queue_age")
+    ticket_filter = col_ticket.text_input("Ticket ID contains", key="queue_ticket").strip()
+    filters = {
+        "status": None if status_filter == "All" else status_filter,
+        "loaner": None if loaner_filter == "All" else loaner_filter == "With loaner",
+        "age_bucket": None if age_filter == "All" else age_filter,
+        "ticket": ticket_filter or None,
+    }
+    in_service = keyset_page(
+        f"service_queue_{'_'.join(str(v) for v in filters.values())}",
+        lambda size, cursor: get_service_queue_df(**filters, page_size=size, cursor=cursor),
+        lambda row: (row['date_of_purchase'], row['serial_no']), QUEUE_PAGE_SIZE
+    )
+
+    if not in_service.empty:
         # Summary Table
-        data = []
-        for b in in_service:
-            data.append({
-                "Serial No": b.serial_no,
-                "Ticket ID": b.ticket_id,
-                "Vehicle No": b.vehicle_no,
-                "Status": b.status.upper(),
-                "Purchase Date": b.date_of_purchase,
-                "Age": calculate_age(b.date_of_purchase),
-                "Loaner": "YES" if b.has_loaner else "No"
-            })
-        df_active = pd.DataFrame(data)
-        st.dataframe(df_active, use_container_width=True)
-
-        for battery in in_service:
-            age_info = calculate_age(battery.date_of_purchase)
+        df_active = pd.DataFrame({
+            "Serial No": in_service["serial_no"],
+            "Ticket ID": in_service["ticket_id"],
+            "Vehicle No": in_service["vehicle_no"],
+            "Status": in_service["status"].str.upper(),
+            "Purchase Date": in_service["date_of_purchase"],
+            "Age": in_service["Age"],
+            "Warranty": in_service["Warranty"],
+            "Loaner": in_service["has_loaner"].map({True: "YES", False: "No"}),
+        })
+        st.dataframe(df_active, use_container_width=True, hide_index=True)
+
+        for battery in in_service.itertuples():
             loaner_badge = " | 🔴 HAS LOANER" if battery.has_loaner else ""
             with st.expander(
                     f"Battery: {battery.serial_no} | Vehicle: {battery.vehicle_no or 'N/A'} | Status: {battery.status.upper()}{loaner_badge}"):
                 st.write(f"**Ticket ID:** {battery.ticket_id or 'N/A'}")
-                st.write(f"**Age since Purchase:** {age_info}")
+                st.write(f"**Age since Purchase:** {battery.Age}")
                 if battery.has_loaner:
                     st.warning("⚠️ This customer has a temporary loaner battery.")
 
@@ -108,16 +314,15 @@ def page_dashboard():
                         st.session_state.menu_selection = "Service"
                         st.rerun()
                 elif new_status != battery.status:
-                    if st.button(f"Save Status for {battery.serial_no}", key=f"btn_{battery.serial_no}"):
-                        update_battery_status(battery.serial_no, new_status)
-                        st.success(f"Status updated to {new_status}!")
-                        st.rerun()
+                    st.button(f"Save Status for {battery.serial_no}", key=f"btn_{battery.serial_no}",
+                              on_click=save_battery_status, args=(battery.serial_no, new_status, int(battery.version)))
+    elif any(filters.values()):
+        st.info("No batteries in service match these filters.")
     else:
         st.info("No batteries currently pending or ready for pickup.")
 
     st.markdown("---")
     st.subheader("Recent Service History")
-    recent = get_recent_exchanges_df()
     st.dataframe(recent, use_container_width=True)
 
 
@@ -128,8 +333,8 @@ def page_service():
 
     if 'otp_verified' not in st.session_state:
         st.session_state.otp_verified = False
-    if 'current_otp' not in st.session_state:
-        st.session_state.current_otp = None
+    if 'otp_token' not in st.session_state:
+        st.session_state.otp_token = None
     if 'exchange_complete' not in st.session_state:
         st.session_state.exchange_complete = False
 
@@ -138,38 +343,7 @@ def page_service():
             st.success("Exchange Logged Successfully!")
             summary = st.session_state.last_exchange_summary
 
-            # Professionally formatted HTML Receipt
-            html_receipt = f"""
-            <div style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; padding: 20px; border: 1px solid #eee; max-width: 500px; margin: auto; background-color: white; color: #333;">
-                <div style="text-align: center; border-bottom: 2px solid #ed1c24; padding-bottom: 10px;">
-                    <h2 style="margin: 0; color: #ed1c24;">{SHOP_NAME}</h2>
-                    <p style="margin: 5px 0; font-size: 14px;">Authorized Exide Care Dealer</p>
-                </div>
-
-                <div style="margin: 20px 0;">
-                    <h4 style="border-bottom: 1px solid #eee; padding-bottom: 5px;">WARRANTY TRANSACTION RECEIPT</h4>
-                    <table style="width: 100%; font-size: 14px; border-collapse: collapse;">
-                        <tr><td style="padding: 5px 0; color: #666;">Customer Name:</td><td style="padding: 5px 0; font-weight: bold;">{summary['cust_name']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">Vehicle Reg No:</td><td style="padding: 5px 0; font-weight: bold;">{summary['vehicle_no']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">New Battery SN:</td><td style="padding: 5px 0; font-weight: bold;">{summary['new_serial']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">Old Battery SN:</td><td style="padding: 5px 0; font-weight: bold;">{summary['old_serial']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">Exide Ticket ID:</td><td style="padding: 5px 0; font-weight: bold;">{summary['ticket_id']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">Battery Model:</td><td style="padding: 5px 0; font-weight: bold;">{summary['new_model']}</td></tr>
-                        <tr><td style="padding: 5px 0; color: #666;">Purchase Date:</td><td style="padding: 5px 0; font-weight: bold;">{summary['purchase_date']}</td></tr>
-                    </table>
-                </div>
-
-                <div style="margin-top: 20px; padding: 10px; background-color: #f9f9f9; border-radius: 4px; font-size: 13px;">
-                    <strong>Technician Notes:</strong><br>
-                    {summary['notes']}
-                </div>
-
-                <div style="margin-top: 30px; text-align: center; font-size: 12px; color: #999; border-top: 1px solid #eee; padding-top: 10px;">
-                    Generated on: {datetime.now().strftime('%Y-%m-%d %H:%M')}<br>
-                    Thank you for choosing Exide Care!
-                </div>
-            </div>
-            """
+            html_receipt = st.session_state.last_receipt_html
 
             st.markdown("### 📄 Transaction Receipt")
             components.html(html_receipt, height=500, scrolling=True)
@@ -181,7 +355,7 @@ def page_service():
                         <script>
                             var printWin = window.open('', '', 'width=800,height=900');
                             printWin.document.write('<html><head><title>Receipt - {summary['new_serial']}</title></head><body>');
-                            printWin.document.write(`{html_receipt}`);
+                            printWin.document.write({json.dumps(html_receipt)});
                             printWin.document.write('<script>window.onload = function() {{ window.print(); window.close(); }}<\\/script>');
                             printWin.document.write('</body></html>');
                             printWin.document.close();
@@ -221,39 +395,40 @@ def page_service():
             if len(phone) < 10 or not old_serial:
                 st.error("Please enter valid Phone and Serial Number.")
             else:
-                batt = get_battery_by_serial(old_serial)
+                with unit_of_work() as session:
+                    batt = get_battery_by_serial(old_serial, session=session)
+                    cust = get_customer_by_phone(phone, session=session)
 
+                # warranty_expiry is kept up to date on every write, so the lookup above is all it takes
+                warranty = warranty_status(batt.warranty_expiry) if batt else None
                 valid_warranty = True
-                if batt:
-                    expiry = batt.warranty_expiry
-                    if expiry and datetime.now().strftime("%Y-%m-%d") > expiry:
-                        st.warning(f"⚠️ Warning: This battery warranty expired on {expiry}")
-                        valid_warranty = False
+                if warranty and warranty["status"] == "expired":
+                    st.warning(f"⚠️ Warning: This battery warranty expired on {warranty['expiry']}")
+                    valid_warranty = False
+                elif warranty and warranty["status"] == "valid":
+                    st.success(f"✅ Warranty valid until {warranty['expiry']} ({warranty['days_left']} days left).")
 
                 if valid_warranty:
-                    otp = generate_otp()
-                    st.session_state.current_otp = otp
+                    send_otp(phone, "claim")
                     st.session_state.temp_phone = phone
                     st.session_state.temp_old_serial = old_serial
                     st.session_state.workflow = "CLAIM"
                     st.session_state.otp_verified = False
                     
-                    # Fetch details for pre-filling next stage
-                    cust = get_customer_by_phone(phone)
+                    # Pre-fill the next stage with the details fetched above
                     st.session_state.temp_cust_name = cust.name if cust else ""
                     st.session_state.temp_vehicle_no = batt.vehicle_no if batt and batt.vehicle_no else ""
                     
-                    send_otp_simulation(phone, otp)
-                    st.info("OTP sent to customer's phone.")
-                    
                     # Clear prefill data after successful submission
                     if st.session_state.get("prefill_service"):
                         st.session_state.prefill_service = False
                         st.session_state.prefill_phone = ""
                         st.session_state.prefill_old_serial = ""
 
-        if st.session_state.current_otp and not st.session_state.otp_verified and st.session_state.get(
+        if st.session_state.otp_token and not st.session_state.otp_verified and st.session_state.get(
                 'workflow') == "CLAIM":
+            # The form stays usable while the SMS is still on its way
+            otp_delivery_notice(st.session_state.otp_token)
             st.text_input("Enter OTP for Warranty Claim", key="claim_otp_input")
             st.button("Verify OTP", key="claim_verify_btn", on_click=verify_claim_otp)
 
@@ -287,7 +462,7 @@ def page_service():
                     col_e, col_f = st.columns(2)
                     new_model = col_e.selectbox("Battery Model", BATTERY_MODELS)
                     purchase_date = col_f.date_input("Date of Purchase", value=datetime.now())
-                    col_f.caption(f"Age: {calculate_age(purchase_date.strftime('%Y-%m-%d'))}")
+                    col_f.caption(f"Age: {calculate_age(purchase_date)}")
 
                     notes = st.text_area("Technician Notes", "Warranty replacement issued.")
                     final_submit = st.button("Complete Exchange")
@@ -314,11 +489,15 @@ def page_service():
                                     'old_serial': st.session_state.temp_old_serial, 'ticket_id': ticket_id,
                                     'new_model': new_model, 'purchase_date': purchase_date.strftime("%Y-%m-%d"), 'notes': notes
                                 }
+                                # Rendered once, so reruns and the print/save buttons reuse it
+                                st.session_state.last_receipt_html = render_receipt(st.session_state.last_exchange_summary)
                                 st.session_state.exchange_complete = True
                                 # Clear intent flag
                                 if 'intent_issue_replacement' in st.session_state:
                                     del st.session_state.intent_issue_replacement
                                 st.rerun()
+                            except StatusConflictError as e:
+                                st.warning(str(e))
                             except Exception as e:
                                 st.error(f"Error: {e}")
             else:
@@ -334,7 +513,7 @@ def page_service():
                     col_z1, col_z2 = st.columns(2)
                     vehicle_no = col_z1.text_input("Vehicle Registration No.", value=val_vehicle)
                     purchase_date = col_z2.date_input("Date of Purchase", value=datetime.now())
-                    col_z2.caption(f"Age: {calculate_age(purchase_date.strftime('%Y-%m-%d'))}")
+                    col_z2.caption(f"Age: {calculate_age(purchase_date)}")
                     
                     # --- NEW FEATURE: TEMPORARY BATTERY (SIMPLE) ---
                     st.markdown("---")
@@ -364,6 +543,8 @@ def page_service():
                             # Clear intent flag
                             if 'intent_issue_replacement' in st.session_state:
                                 del st.session_state.intent_issue_replacement
+                        except StatusConflictError as e:
+                            st.warning(str(e))
                         except Exception as e:
                             st.error(f"Error: {e}")
 
@@ -375,7 +556,7 @@ def page_service():
 
             if not ready_items.empty:
                 st.write("Items in service:")
-                ready_items['Age'] = ready_items['date_of_purchase'].apply(calculate_age)
+                ready_items['Age'] = calculate_ages(ready_items['date_of_purchase'])['Age']
                 # Show loaner status in table
                 ready_items['Loaner'] = ready_items['has_loaner'].apply(lambda x: "YES" if x else "No")
                 st.dataframe(ready_items[['serial_no', 'status', 'ticket_id', 'vehicle_no', 'Age', 'Loaner']])
@@ -392,30 +573,38 @@ def page_service():
                     return_loaner = st.checkbox(f"Confirm return of loaner battery?", value=True)
 
                 if st.button("Verify Customer & Send OTP for Pickup", key="pickup_send_otp"):
-                    otp = generate_otp()
-                    st.session_state.current_otp = otp
+                    send_otp(search_phone, "pickup")
                     st.session_state.temp_phone = search_phone
                     st.session_state.temp_pickup_serial = selected_serial
+                    st.session_state.temp_pickup_version = int(selected_row['version'])
                     st.session_state.workflow = "PICKUP"
                     st.session_state.pickup_verified = False
                     st.session_state.return_loaner_flag = return_loaner # Store this choice
-                    send_otp_simulation(search_phone, otp)
 
-                if st.session_state.current_otp and st.session_state.get('workflow') == "PICKUP":
+                if st.session_state.otp_token and st.session_state.get('workflow') == "PICKUP":
+                    if not st.session_state.get('pickup_verified'):
+                        otp_delivery_notice(st.session_state.otp_token)
                     st.text_input("Enter OTP for Pickup", key="pickup_otp_input")
                     if st.button("Confirm Return to Customer", key="confirm_pickup_btn", on_click=verify_pickup_otp):
                         if st.session_state.get('pickup_verified'):
-                            if process_return_to_customer(
-                                st.session_state.temp_pickup_serial, 
-                                search_phone,
-                                return_loaner=st.session_state.get('return_loaner_flag', False)
-                            ):
+                            try:
+                                # A second click, or a pickup already handled at another counter, is refused
+                                returned = process_return_to_customer(
+                                    st.session_state.temp_pickup_serial, 
+                                    search_phone,
+                                    return_loaner=st.session_state.get('return_loaner_flag', False),
+                                    expected_version=st.session_state.get('temp_pickup_version')
+                                )
+                            except StatusConflictError as e:
+                                st.warning(str(e))
+                                returned = False
+                            st.session_state.otp_token = None
+                            st.session_state.workflow = None
+                            st.session_state.pickup_verified = False
+                            if returned:
                                 st.success(f"Battery {st.session_state.temp_pickup_serial} returned successfully!")
                                 if st.session_state.get('return_loaner_flag'):
                                     st.info("Loaner battery marked as returned.")
-                                st.session_state.current_otp = None
-                                st.session_state.workflow = None
-                                st.session_state.pickup_verified = False
                                 st.rerun()
             else:
                 st.warning("No items found in service for this phone number.")
@@ -423,11 +612,29 @@ def page_service():
 
 def page_history():
     st.title("🔎 Search History")
-    search_type = st.radio("Search By:", ["Battery Serial Number", "Customer Phone"])
-    query = st.text_input("Enter Search Term")
+    quick = st.text_input("Quick search (serial, vehicle no, phone or name)", key="history_quick")
+    if quick:
+        matches = search_records(quick)
+        if matches.empty:
+            st.caption(f"No matches. Type at least {SEARCH_MIN_CHARS} characters.")
+        else:
+            options = {f"{row.value} ({row.field.replace('_', ' ')}) → {row.key}": (row.kind, row.key)
+                       for row in matches.itertuples()}
+            st.selectbox("Matches", [None, *options], key="history_quick_pick",
+                         format_func=lambda option: "Pick a match..." if option is None else option,
+                         on_change=pick_search_match, args=(options,))
+    search_type = st.radio("Search By:", ["Battery Serial Number", "Customer Phone", "Ticket ID"], key="history_search_type")
+    query = st.text_input("Enter Search Term", key="history_query")
+    date_from, date_to = date_range_filter("Exchanges between (optional)", "history_date_range")
+    # Closed years moved out to the archive (python cli.py archive-exchanges) are read only on request
+    include_archive = st.checkbox("Include archived years", key="history_include_archive")
     if query:
+        # Each search is one statement: details plus the current page of exchanges
         if search_type == "Battery Serial Number":
-            batt = get_battery_details_df(query)
+            pager_key = f"battery_history_{query}_{date_from}_{date_to}_{include_archive}"
+            profile = get_battery_profile(query, page_size=HISTORY_PAGE_SIZE + 1, cursor=keyset_cursor(pager_key),
+                                          date_from=date_from, date_to=date_to, include_archive=include_archive)
+            batt = profile["battery"]
             if not batt.empty:
                 row = batt.iloc[0]
                 st.subheader("Battery Details")
@@ -436,39 +643,82 @@ def page_history():
                 st.write(f"**Age since Purchase:** {calculate_age(row['date_of_purchase'])}")
                 st.dataframe(batt)
                 st.subheader("Service History")
-                trans = get_battery_exchanges_df(query)
+                trans = keyset_controls(pager_key, profile["exchanges"], lambda row: int(row['id']))
                 st.dataframe(trans)
             else:
                 st.warning("No battery found.")
+        elif search_type == "Ticket ID":
+            ticket_log = get_ticket_history(query, include_archive=include_archive)
+            if not ticket_log.empty:
+                st.subheader(f"Ticket {query}")
+                st.dataframe(ticket_log.drop(columns=['id']), hide_index=True)
+            else:
+                st.warning("No exchanges found for this ticket.")
         else:
-            cust = get_customer_details_df(query)
+            pager_key = f"customer_history_{query}_{date_from}_{date_to}_{include_archive}"
+            profile = get_customer_profile(query, page_size=HISTORY_PAGE_SIZE + 1, cursor=keyset_cursor(pager_key),
+                                           date_from=date_from, date_to=date_to, include_archive=include_archive)
+            cust = profile["customer"]
             if not cust.empty:
                 st.write(f"**Customer Name:** {cust.iloc[0]['name']}")
                 st.subheader("Batteries Owned")
-                owned = get_customer_batteries_df(query)
+                owned = profile["batteries"]
                 if not owned.empty:
-                    owned['Age'] = owned['date_of_purchase'].apply(calculate_age)
-                    st.dataframe(owned[['serial_no', 'model_type', 'status', 'ticket_id', 'vehicle_no', 'Age']])
+                    owned[['Age', 'Warranty']] = calculate_ages(owned['date_of_purchase'], owned['warranty_expiry'])[['Age', 'Warranty']]
+                    st.dataframe(owned[['serial_no', 'model_type', 'status', 'ticket_id', 'vehicle_no', 'Age', 'Warranty']])
                 st.subheader("Exchange Logs")
-                history = get_customer_exchanges_df(query)
+                history = keyset_controls(pager_key, profile["exchanges"], lambda row: int(row['id']))
                 st.dataframe(history)
             else:
                 st.warning("Customer not found.")
 
+    st.markdown("---")
+    receipt_reprints()
+
 
 def page_inventory():
     st.title("📦 Quick Inventory Add")
-    with st.form("add_stock"):
-        serial = st.text_input("Serial Number")
-        model = st.selectbox("Model", BATTERY_MODELS)
-        p_date = st.date_input("Date of Purchase (If pre-owned/return)", value=datetime.now())
-        submit = st.form_submit_button("Add to Stock")
-        if submit and serial:
+    tab_single, tab_bulk = st.tabs(["Single Battery", "Bulk Import"])
+
+    with tab_single:
+        with st.form("add_stock"):
+            serial = st.text_input("Serial Number")
+            model = st.selectbox("Model", BATTERY_MODELS)
+            p_date = st.date_input("Date of Purchase (If pre-owned/return)", value=datetime.now())
+            submit = st.form_submit_button("Add to Stock")
+            if submit and serial:
+                try:
+                    add_inventory_stock(serial, model, p_date)
+                    st.success(f"Battery {serial} added. Age: {calculate_age(p_date)}")
+                except Exception as e:
+                    st.error(f"Error: {e}")
+
+    with tab_bulk:
+        st.write("Upload a CSV or Excel sheet with the columns **serial_no**, **model_type** and optionally "
+                 "**date_of_purchase** (YYYY-MM-DD, defaults to today).")
+        st.caption(f"Valid models: {', '.join(BATTERY_MODELS)}")
+        upload = st.file_uploader("Stock file", type=["csv", "xlsx"])
+        if upload is not None and st.button("Import Stock"):
+            progress = st.progress(0.0, text="Importing...")
+
+            def on_progress(rows_read, inserted):
+                # Total rows are unknown while streaming; ~30 bytes per row is close enough for a progress bar
+                progress.progress(min(rows_read / max(upload.size / 30, 1), 1.0),
+                                  text=f"Read {rows_read} rows, added {inserted}")
+
             try:
-                add_inventory_stock(serial, model, p_date)
-                st.success(f"Battery {serial} added. Age: {calculate_age(p_date.strftime('%Y-%m-%d'))}")
+                result = bulk_import_inventory(upload, upload.name, on_progress=on_progress)
             except Exception as e:
-                st.error(f"Error: {e}")
+                st.error(f"Import failed: {e}")
+            else:
+                progress.progress(1.0, text="Import finished")
+                st.success(f"Added {result['inserted']} of {result['rows']} batteries to stock.")
+                rejects = result["rejects"]
+                if not rejects.empty:
+                    st.warning(f"{len(rejects)} row(s) were rejected.")
+                    st.dataframe(rejects, hide_index=True, use_container_width=True)
+                    st.download_button("💾 Download Rejected Rows", rejects.to_csv(index=False),
+                                       file_name=f"rejected_{upload.name}.csv", mime="text/csv")
 
 
 def page_stock_loan_exide():
@@ -490,51 +740,77 @@ def page_stock_loan_exide():
                         model=model,
                         status='factory_pending',
                         sold_date=None,
-                        p_date=req_date.strftime("%Y-%m-%d"),
+                        p_date=req_date,
                         phone=None,
                         ticket=ticket_id,
                         vehicle=None
                     )
                     st.success(f"Added {serial} to pending list.")
                     st.rerun()
+                except StatusConflictError as e:
+                    st.warning(str(e))
                 except Exception as e:
                     st.error(f"Error: {e}")
 
     st.markdown("---")
     st.subheader("⏳ Pending Stock from Exide Factory")
-    pending_stock = get_pending_factory_stock_df()
+    with unit_of_work() as session:
+        pending_stock = get_pending_factory_stock_df(session=session)
+
+    if "stock_receive_result" in st.session_state:
+        received, skipped = st.session_state.pop("stock_receive_result")
+        if received:
+            st.success(f"Received {len(received)} batteries into stock.")
+        if skipped:
+            st.warning(f"Not pending from factory, skipped: {', '.join(skipped)}")
 
     if not pending_stock.empty:
-        for index, row in pending_stock.iterrows():
-            col1, col2, col3, col4, col5 = st.columns([2, 2, 2, 2, 2])
-            with col1:
-                st.write(f"**SN:** {row['serial_no']}")
-            with col2:
-                st.write(f"**Model:** {row['model_type']}")
-            with col3:
-                st.write(f"**Ticket:** {row['ticket_id']}")
-            with col4:
-                st.write(f"**Date:** {row['date_of_purchase']}")
-            with col5:
-                if st.button("Mark Received", key=f"recv_{row['serial_no']}"):
-                    process_stock_reception(row['serial_no'], row['model_type'])
-                    st.success(f"Stock {row['serial_no']} received!")
-                    st.rerun()
+        pending_stock.insert(0, "Receive", False)
+        edited_stock = st.data_editor(
+            pending_stock[["Receive", "serial_no", "model_type", "ticket_id", "date_of_purchase"]],
+            column_config={
+                "Receive": st.column_config.CheckboxColumn(
+                    "Received?",
+                    help="Tick every battery that arrived in this shipment",
+                    default=False,
+                )
+            },
+            disabled=["serial_no", "model_type", "ticket_id", "date_of_purchase"],
+            hide_index=True,
+            use_container_width=True,
+            key=f"pending_stock_editor_{st.session_state.get('stock_receive_round', 0)}"
+        )
+        scan_list = st.text_area("Or scan / paste serial numbers (one per line)", key="receive_scan_list")
+
+        to_receive = edited_stock.loc[edited_stock["Receive"], "serial_no"].tolist()
+        to_receive += [line.strip() for line in scan_list.splitlines() if line.strip()]
+        to_receive = list(dict.fromkeys(to_receive))
+        if to_receive:
+            st.button(f"📥 Mark {len(to_receive)} Received", on_click=receive_stock, args=(to_receive,))
     else:
         st.info("No pending stock from factory.")
 
     st.markdown("---")
     st.subheader("📜 Received Stock History (Audit)")
-    audit_log = get_stock_receipt_history_df()
+    date_from, date_to = date_range_filter("Received between (optional)", "stock_receipt_date_range")
+    audit_log = keyset_page(
+        f"stock_receipt_history_{date_from}_{date_to}",
+        lambda size, cursor: get_stock_receipt_history_df(page_size=size, cursor=cursor, date_from=date_from, date_to=date_to),
+        lambda row: int(row['id'])
+    )
     if not audit_log.empty:
-        st.dataframe(audit_log, use_container_width=True)
+        st.dataframe(audit_log.drop(columns=['id']), use_container_width=True, hide_index=True)
     else:
         st.info("No stock receipt history found.")
 
 def page_scrap_batteries():
     st.title("♻️ Scrap Batteries")
     st.subheader("List of Scrap Batteries (Replaced)")
-    scrap_df = get_scrap_batteries_df()
+    scrap_df = keyset_page(
+        "scrap_list",
+        lambda size, cursor: get_scrap_batteries_df(page_size=size, cursor=cursor),
+        lambda row: (row['received_date'], row['serial_no'])
+    )
     
     if not scrap_df.empty:
         # Insert a boolean column for selection
@@ -553,7 +829,7 @@ def page_scrap_batteries():
             disabled=[c for c in scrap_df.columns if c != "Select"],
             hide_index=True,
             use_container_width=True,
-            key="scrap_editor"
+            key=f"scrap_editor_{len(st.session_state['scrap_list'])}"
         )
         
         selected_rows = edited_df[edited_df["Select"]]
@@ -562,11 +838,13 @@ def page_scrap_batteries():
             st.write(f"Selected {len(selected_rows)} items.")
             if st.button("📦 Move Selected to Challan"):
                 serials_to_move = selected_rows['serial_no'].tolist()
-                if move_scrap_to_challan(serials_to_move):
-                    st.success(f"Successfully moved {len(serials_to_move)} batteries to Challan.")
+                moved = move_scrap_to_challan(serials_to_move)
+                if moved:
+                    st.success(f"Successfully moved {moved} batteries to Challan.")
+                    st.session_state.pop("scrap_list", None)
                     st.rerun()
                 else:
-                    st.error("Failed to move batteries.")
+                    st.error("None of the selected batteries are in scrap any more.")
     else:
         st.info("No scrap batteries found.")
 
@@ -574,20 +852,129 @@ def page_chalaan():
     st.title("📜 Challan")
     st.subheader("Challan List")
     
-    challan_df = get_challan_batteries_df()
+    challan_df = keyset_page(
+        "challan_list",
+        lambda size, cursor: get_challan_batteries_df(page_size=size, cursor=cursor),
+        lambda row: (row['challan_date'], row['serial_no'])
+    )
     if not challan_df.empty:
         st.dataframe(challan_df, use_container_width=True)
         
         st.markdown("---")
         if st.button("🗑️ Clear Challan (Move to Audit)"):
-            if clear_challan_to_archive():
-                st.success("Challan cleared successfully! Records moved to audit.")
+            archived = clear_challan_to_archive()
+            if archived:
+                st.success(f"Challan cleared successfully! {archived} records moved to audit.")
+                st.session_state.pop("challan_list", None)
                 st.rerun()
             else:
-                st.error("Failed to clear challan.")
+                st.error("Challan was already empty.")
     else:
         st.info("No batteries in Challan.")
 
+def page_reports():
+    st.title("📈 Reports")
+    # Read-only: the charts read the daily rollups, never the exchanges ledger.
+    # They are brought up to date by the button or `python cli.py rollups`
+    # (e.g. scheduled), both of which count only the exchanges added since.
+    if "reports_update_result" in st.session_state:
+        st.success(st.session_state.pop("reports_update_result"))
+    checkpoint = get_rollup_checkpoint()
+    col_status, col_update = st.columns([3, 1])
+    if checkpoint["updated_at"]:
+        col_status.caption(f"Counted up to exchange #{checkpoint['last_exchange_id']} (updated {checkpoint['updated_at']:%Y-%m-%d %H:%M}).")
+    if (checkpoint["latest_exchange_id"] or 0) > (checkpoint["last_exchange_id"] or 0):
+        col_status.caption("Newer exchanges are not counted yet.")
+        col_update.button("🔄 Update Reports", on_click=update_report_tables,
+                          help="Counts the exchanges added since the last update. `python cli.py rollups` does the same from a scheduled job.")
+
+    today = date.today()
+    year_ago = (pd.Timestamp(today) - pd.DateOffset(months=11)).replace(day=1).date()
+    col_range, col_period = st.columns([2, 1])
+    picked = col_range.date_input("Period", value=(year_ago, today), key="reports_range")
+    date_from = picked[0] if len(picked) > 0 else year_ago
+    date_to = picked[1] if len(picked) > 1 else today
+    period = col_period.radio("Group by", ["Month", "Week", "Day"], horizontal=True, key="reports_period")
+
+    rollup = get_rollup_df(date_from, date_to)
+    if rollup.empty:
+        st.info("No exchanges in this period.")
+        return
+    freq = {"Month": "M", "Week": "W", "Day": "D"}[period]
+    rollup["period"] = pd.to_datetime(rollup["day"]).dt.to_period(freq).dt.start_time
+
+    def counts(action, by):
+        rows = rollup[rollup["action_taken"] == action]
+        if rows.empty:
+            return pd.DataFrame()
+        return rows.pivot_table(index="period", columns=by, values="count", aggfunc="sum", fill_value=0)
+
+    totals = rollup.groupby("action_taken")["count"].sum()
+    col1, col2, col3, col4 = st.columns(4)
+    col1.metric("Replacements Issued", int(totals.get("NEW_REPLACEMENT_ISSUED", 0)))
+    col2.metric("Taken for Service", int(totals.get("SERVICE_PENDING", 0)))
+    col3.metric("Returned to Customers", int(totals.get("RETURNED_TO_CUSTOMER", 0)))
+    col4.metric("Stock Received", int(totals.get("STOCK_RECEIVED", 0)))
+
+    st.subheader("Replacements per Model")
+    replacements = counts("NEW_REPLACEMENT_ISSUED", "model_type")
+    if replacements.empty:
+        st.info("No replacements in this period.")
+    else:
+        st.bar_chart(replacements)
+
+    st.subheader("Service Volume")
+    service = rollup[rollup["action_taken"].isin(["SERVICE_PENDING", "RETURNED_TO_CUSTOMER"])]
+    if service.empty:
+        st.info("No service entries in this period.")
+    else:
+        volume = service.pivot_table(index="period", columns="action_taken", values="count", aggfunc="sum", fill_value=0)
+        st.line_chart(volume.rename(columns={"SERVICE_PENDING": "Taken for service", "RETURNED_TO_CUSTOMER": "Returned"}))
+
+    st.subheader("Stock Received per Model")
+    stock = counts("STOCK_RECEIVED", "model_type")
+    if stock.empty:
+        st.info("No stock received in this period.")
+    else:
+        st.bar_chart(stock)
+
+    with st.expander("Totals by Model"):
+        st.dataframe(
+            rollup.pivot_table(index="model_type", columns="action_taken", values="count", aggfunc="sum", fill_value=0),
+            use_container_width=True
+        )
+
+
+def page_diagnostics():
+    st.title("🩺 Diagnostics")
+    # Service timings and SQL are for the admin only. The menu already hides
+    # the page from anyone else; checked here too so no other route shows it
+    if not is_admin(st.session_state.get("username")):
+        st.error("Diagnostics are only available to the admin account.")
+        return
+    st.caption(f"Service calls since start-up. A call that runs the same SQL {instrumentation.N_PLUS_ONE_THRESHOLD}+ times is flagged as a possible N+1.")
+    st.button("Reset counters", on_click=instrumentation.reset)
+
+    totals = pd.DataFrame(instrumentation.service_totals())
+    if totals.empty:
+        st.info("No service calls recorded yet.")
+        return
+
+    flagged = totals.loc[totals["n_plus_one_calls"] > 0, "service"]
+    if not flagged.empty:
+        st.warning(f"⚠️ Repeated identical statements in: {', '.join(flagged)}")
+
+    st.subheader("Per Service")
+    st.dataframe(
+        totals[["service", "calls", "avg_ms", "max_ms", "total_ms", "avg_statements", "result_rows", "db_ms", "pool_wait_ms", "n_plus_one_calls"]].round(2),
+        hide_index=True, use_container_width=True
+    )
+
+    st.subheader("Recent Calls")
+    recent = pd.DataFrame(instrumentation.recent_calls())
+    recent["repeated"] = recent["repeated"].map(lambda repeated: "; ".join(f"{count}x {sql}" for sql, count in repeated.items()))
+    st.dataframe(recent, hide_index=True, use_container_width=True)
+
 def main():
     st.set_page_config(page_title="Exide Warranty System", page_icon="🔋")
     
@@ -607,7 +994,11 @@ def main():
     </script>
     """, unsafe_allow_html=True)
 
-    init_db()
+    try:
+        init_db()
+    except RuntimeError as e:
+        st.error(str(e))
+        st.stop()
 
     if 'authenticated' not in st.session_state:
         st.session_state.authenticated = False
@@ -619,6 +1010,7 @@ def main():
         if st.button("Login"):
             if check_login(user, pw):
                 st.session_state.authenticated = True
+                st.session_state.username = user
                 st.rerun()
             else:
                 st.error("Invalid credentials.")
@@ -627,6 +1019,7 @@ def main():
     st.sidebar.title(SHOP_NAME)
     if st.sidebar.button("Logout"):
         st.session_state.authenticated = False
+        st.session_state.pop("username", None)
         st.rerun()
 
     # Handle menu selection redirection
@@ -641,22 +1034,37 @@ def main():
     if "sidebar_menu" not in st.session_state:
         st.session_state.sidebar_menu = "Dashboard"
 
-    menu = st.sidebar.radio("Menu", ["Dashboard", "Service", "Search History", "Stock Loan Exide", "Scrap Batteries/Trnf", "Challan"], key="sidebar_menu")
-
-    if menu == "Dashboard":
-        page_dashboard()
-    elif menu == "Service":
-        page_service()
-    elif menu == "Search History":
-        page_history()
-    elif menu == "Stock Loan Exide":
-        page_stock_loan_exide()
-    elif menu == "Scrap Batteries/Trnf":
-        page_scrap_batteries()
-    elif menu == "Challan":
-        page_chalaan()
-    #elif menu == "Add Inventory":
-     #   page_inventory()
+    pages = ["Dashboard", "Service", "Search History", "Reports", "Add Inventory", "Stock Loan Exide", "Scrap Batteries/Trnf", "Challan"]
+    if instrumentation.is_enabled() and is_admin(st.session_state.get("username")):
+        pages.append("Diagnostics")
+    if st.session_state.sidebar_menu not in pages:
+        st.session_state.sidebar_menu = "Dashboard"
+    menu = st.sidebar.radio("Menu", pages, key="sidebar_menu")
+
+    rerun_started = time.perf_counter()
+    instrumentation.start_rerun()
+    try:
+        if menu == "Dashboard":
+            page_dashboard()
+        elif menu == "Service":
+            page_service()
+        elif menu == "Search History":
+            page_history()
+        elif menu == "Stock Loan Exide":
+            page_stock_loan_exide()
+        elif menu == "Scrap Batteries/Trnf":
+            page_scrap_batteries()
+        elif menu == "Challan":
+            page_chalaan()
+        elif menu == "Add Inventory":
+            page_inventory()
+        elif menu == "Reports":
+            page_reports()
+        elif menu == "Diagnostics":
+            page_diagnostics()
+    finally:
+        # Also reached when a page calls st.rerun() or st.stop()
+        instrumentation.log_rerun(menu, rerun_started)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,520 @@
+from datetime import date, datetime
+import os
+import re
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import inspect, text
+from sqlalchemy.sql import sqltypes
+from config import BATTERY_CATALOG, get_exchange_archive_dir
+
+# Schema changes for databases that already exist. Base.metadata.create_all()
+# only creates missing tables, so anything added to an existing table (columns,
+# indexes, type changes) needs a migration here. Each migration runs exactly once
+# per database and is recorded in the schema_migrations table.
+
+MIGRATION_LOCK_KEY = 230023
+BACKFILL_BATCH_SIZE = 5000
+
+def _column_exists(conn, table, column):
+    return any(c["name"] == column for c in inspect(conn).get_columns(table))
+
+def _m001_hot_lookup_indexes(conn):
+    # Same names SQLAlchemy generates for index=True, so fresh databases created
+    # by create_all() and migrated databases end up identical.
+    indexes = [
+        ("ix_batteries_status", "batteries", "status"),
+        ("ix_batteries_current_owner_phone", "batteries", "current_owner_phone"),
+        ("ix_exchanges_customer_phone", "exchanges", "customer_phone"),
+        ("ix_exchanges_old_battery_serial", "exchanges", "old_battery_serial"),
+        ("ix_exchanges_new_battery_serial", "exchanges", "new_battery_serial"),
+        ("ix_exchanges_action_taken", "exchanges", "action_taken"),
+    ]
+    for name, table, column in indexes:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({column})"))
+
+def _m002_exchange_ticket_id(conn):
+    if not _column_exists(conn, "exchanges", "ticket_id"):
+        conn.execute(text("ALTER TABLE exchanges ADD COLUMN ticket_id TEXT"))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_exchanges_ticket_id ON exchanges (ticket_id)"))
+
+    # Backfill from the "Ticket: <id>." prefix that writers have always put in notes
+    if conn.dialect.name == "postgresql":
+        conn.execute(text(
+            "UPDATE exchanges SET ticket_id = NULLIF(TRIM(substring(notes from 'Ticket: (.*?)\\.')), '') "
+            "WHERE ticket_id IS NULL AND notes LIKE '%Ticket: %'"
+        ))
+        return
+
+    # SQLite has no regex functions, so parse in Python a batch at a time
+    pattern = re.compile(r"Ticket: (.*?)\.")
+    last_id = 0
+    while True:
+        rows = conn.execute(text(
+            "SELECT id, notes FROM exchanges "
+            "WHERE id > :last_id AND ticket_id IS NULL AND notes LIKE '%Ticket: %' "
+            "ORDER BY id LIMIT :batch"
+        ), {"last_id": last_id, "batch": BACKFILL_BATCH_SIZE}).fetchall()
+        if not rows:
+            break
+        last_id = rows[-1][0]
+        updates = []
+        for exchange_id, notes in rows:
+            match = pattern.search(notes)
+            if match and match.group(1).strip():
+                updates.append({"id": exchange_id, "ticket_id": match.group(1).strip()})
+        if updates:
+            conn.execute(text("UPDATE exchanges SET ticket_id = :ticket_id WHERE id = :id"), updates)
+
+def _m003_keyset_pagination_indexes(conn):
+    indexes = [
+        ("ix_exchanges_customer_phone_id", "exchanges", "customer_phone, id"),
+        ("ix_exchanges_action_taken_id", "exchanges", "action_taken, id"),
+        ("ix_scrap_batteries_received_date_serial_no", "scrap_batteries", "received_date, serial_no"),
+        ("ix_challan_batteries_challan_date_serial_no", "challan_batteries", "challan_date, serial_no"),
+    ]
+    for name, table, columns in indexes:
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS {name} ON {table} ({columns})"))
+    # Superseded by the composites above, which serve the same equality lookups
+    conn.execute(text("DROP INDEX IF EXISTS ix_exchanges_customer_phone"))
+    conn.execute(text("DROP INDEX IF EXISTS ix_exchanges_action_taken"))
+
+DATE_COLUMNS = [
+    ("customers", "created_at"),
+    ("batteries", "sold_date"),
+    ("batteries", "date_of_purchase"),
+    ("batteries", "warranty_expiry"),
+    ("scrap_batteries", "received_date"),
+    ("challan_batteries", "received_date"),
+    ("audit_scrap_batteries", "received_date"),
+]
+DATETIME_COLUMNS = [
+    ("exchanges", "date"),
+    ("challan_batteries", "challan_date"),
+    ("audit_scrap_batteries", "challan_date"),
+    ("audit_scrap_batteries", "final_archived_date"),
+]
+
+def _is_text_column(conn, table, column):
+    for c in inspect(conn).get_columns(table):
+        if c["name"] == column:
+            return isinstance(c["type"], sqltypes.String)
+    return False
+
+def _pg_date_expr(column):
+    # Accepts YYYY-MM-DD... and the DD-MM-YYYY / DD/MM/YYYY forms typed in by hand
+    return (
+        f"CASE WHEN {column} ~ '^\\d{{4}}-\\d{{2}}-\\d{{2}}' THEN to_date(substring({column} from 1 for 10), 'YYYY-MM-DD') "
+        f"WHEN {column} ~ '^\\d{{2}}[-/]\\d{{2}}[-/]\\d{{4}}' THEN to_date(substring({column} from 1 for 10), 'DD-MM-YYYY') END"
+    )
+
+def _sqlite_date_expr(column):
+    return (
+        f"CASE WHEN {column} GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]*' THEN substr({column}, 1, 10) "
+        f"WHEN {column} GLOB '[0-9][0-9][-/][0-9][0-9][-/][0-9][0-9][0-9][0-9]*' "
+        f"THEN substr({column}, 7, 4) || '-' || substr({column}, 4, 2) || '-' || substr({column}, 1, 2) END"
+    )
+
+def _m004_native_date_types(conn):
+    # Values that match none of the known formats (including empty strings)
+    # become NULL rather than blocking the migration.
+    if conn.dialect.name == "postgresql":
+        for table, column in DATE_COLUMNS:
+            if _is_text_column(conn, table, column):
+                conn.execute(text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE DATE USING ({_pg_date_expr(column)})"
+                ))
+        for table, column in DATETIME_COLUMNS:
+            if _is_text_column(conn, table, column):
+                time_part = f"substring({column} from '^.{{10}}[ T](\\d{{2}}:\\d{{2}}:\\d{{2}}(?:\\.\\d+)?)')::time"
+                conn.execute(text(
+                    f"ALTER TABLE {table} ALTER COLUMN {column} TYPE TIMESTAMP "
+                    f"USING ({_pg_date_expr(column)} + COALESCE({time_part}, time '00:00'))"
+                ))
+    else:
+        # SQLite has no column types to change. SQLAlchemy's Date/DateTime store
+        # ISO text there, so rewrite every value into exactly the format it
+        # writes ('YYYY-MM-DD' and 'YYYY-MM-DD HH:MM:SS.ffffff'); that keeps
+        # string comparison, and with it index range scans, in date order.
+        for table, column in DATE_COLUMNS:
+            if _is_text_column(conn, table, column):
+                conn.execute(text(f"UPDATE {table} SET {column} = {_sqlite_date_expr(column)} WHERE {column} IS NOT NULL"))
+        for table, column in DATETIME_COLUMNS:
+            if _is_text_column(conn, table, column):
+                conn.execute(text(
+                    f"UPDATE {table} SET {column} = {_sqlite_date_expr(column)} || ' ' || "
+                    f"CASE WHEN length({column}) >= 19 THEN substr({column}, 12, 8) ELSE '00:00:00' END || '.' || "
+                    f"CASE WHEN substr({column}, 20, 1) = '.' THEN substr(substr({column}, 21) || '000000', 1, 6) ELSE '000000' END "
+                    f"WHERE {column} IS NOT NULL"
+                ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_exchanges_date ON exchanges (date)"))
+
+# (table, column) pairs served by the type-ahead search (services.search_records)
+SEARCH_COLUMNS = [
+    ("batteries", "serial_no"),
+    ("batteries", "vehicle_no"),
+    ("customers", "phone"),
+    ("customers", "name"),
+]
+
+def _sqlite_search_triggers(table, key, columns):
+    fields = " UNION ALL ".join(
+        f"SELECT '{c}', new.{key}, new.{c} WHERE new.{c} IS NOT NULL AND new.{c} <> ''" for c in columns
+    )
+    field_list = ", ".join(f"'{c}'" for c in columns)
+    changed = " OR ".join(f"old.{c} IS NOT new.{c}" for c in columns)
+    return [
+        f"CREATE TRIGGER IF NOT EXISTS search_{table}_ai AFTER INSERT ON {table} BEGIN "
+        f"INSERT INTO search_terms (field, ref, value) {fields}; END",
+        f"CREATE TRIGGER IF NOT EXISTS search_{table}_au AFTER UPDATE ON {table} WHEN {changed} BEGIN "
+        f"DELETE FROM search_terms WHERE ref = old.{key} AND field IN ({field_list}); "
+        f"INSERT INTO search_terms (field, ref, value) {fields}; END",
+        f"CREATE TRIGGER IF NOT EXISTS search_{table}_ad AFTER DELETE ON {table} BEGIN "
+        f"DELETE FROM search_terms WHERE ref = old.{key} AND field IN ({field_list}); END",
+    ]
+
+def _m005_search_index(conn):
+    if conn.dialect.name == "postgresql":
+        try:
+            with conn.begin_nested():
+                conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+        except Exception:
+            # Without pg_trgm the search still works, just without an index
+            return
+        for table, column in SEARCH_COLUMNS:
+            conn.execute(text(
+                f"CREATE INDEX IF NOT EXISTS ix_{table}_{column}_trgm ON {table} USING gin ({column} gin_trgm_ops)"
+            ))
+        return
+
+    # SQLite: every searchable value is a row of search_terms, kept current by
+    # triggers on the source tables, and indexed by an external-content FTS5
+    # table with the trigram tokenizer (substring matching, SQLite 3.34+).
+    # search_terms.id is a real INTEGER PRIMARY KEY, so VACUUM cannot renumber
+    # the rows behind the FTS index.
+    try:
+        with conn.begin_nested():
+            conn.execute(text(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS search_fts USING fts5("
+                "value, content='search_terms', content_rowid='id', tokenize='trigram')"
+            ))
+    except Exception:
+        # No FTS5 or no trigram tokenizer in this SQLite build: search falls back to LIKE
+        return
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS search_terms ("
+        "id INTEGER PRIMARY KEY, field TEXT NOT NULL, ref TEXT NOT NULL, value TEXT NOT NULL)"
+    ))
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_search_terms_ref ON search_terms (ref, field)"))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS search_terms_ai AFTER INSERT ON search_terms BEGIN "
+        "INSERT INTO search_fts (rowid, value) VALUES (new.id, new.value); END"
+    ))
+    conn.execute(text(
+        "CREATE TRIGGER IF NOT EXISTS search_terms_ad AFTER DELETE ON search_terms BEGIN "
+        "INSERT INTO search_fts (search_fts, rowid, value) VALUES ('delete', old.id, old.value); END"
+    ))
+    for statement in (_sqlite_search_triggers("batteries", "serial_no", ["serial_no", "vehicle_no"])
+                      + _sqlite_search_triggers("customers", "phone", ["phone", "name"])):
+        conn.execute(text(statement))
+
+    # Index what is already there
+    conn.execute(text("DELETE FROM search_terms"))
+    for table, column in SEARCH_COLUMNS:
+        key = "serial_no" if table == "batteries" else "phone"
+        conn.execute(text(
+            f"INSERT INTO search_terms (field, ref, value) "
+            f"SELECT '{column}', {key}, {column} FROM {table} WHERE {column} IS NOT NULL AND {column} <> ''"
+        ))
+    conn.execute(text("INSERT INTO search_fts (search_fts) VALUES ('rebuild')"))
+
+def _m006_receipt_index(conn):
+    # Receipt reprints walk one action over a date range in (date, id) order
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_exchanges_action_taken_date_id ON exchanges (action_taken, date, id)"
+    ))
+
+def warranty_expiry_expr(dialect_name, months, purchase_date="date_of_purchase"):
+    """
+    SQL for purchase_date (an SQL expression) plus whole months, clamped to the
+    end of a shorter month (31 Jan + 1 month = 28/29 Feb) - what Postgres does
+    and SQLite does not. services.py computes warranty_expiry with it too.
+    """
+    if dialect_name == "postgresql":
+        return f"({purchase_date} + make_interval(months => {months}))::date"
+    return (
+        f"min(date({purchase_date}, '+{months} months'), "
+        f"date({purchase_date}, 'start of month', '+{months + 1} months', '-1 day'))"
+    )
+
+def fill_warranty_expiry(conn, overwrite=False):
+    """
+    Sets batteries.warranty_expiry from date_of_purchase and the model's term in
+    BATTERY_CATALOG, one UPDATE per model. Only fills missing values unless
+    `overwrite`, e.g. after a warranty term changed. Returns the rows updated.
+    """
+    updated = 0
+    for model, terms in BATTERY_CATALOG.items():
+        expr = warranty_expiry_expr(conn.dialect.name, int(terms["warranty_months"]))
+        only_missing = "" if overwrite else " AND warranty_expiry IS NULL"
+        updated += conn.execute(text(
+            f"UPDATE batteries SET warranty_expiry = {expr} "
+            f"WHERE model_type = :model AND date_of_purchase IS NOT NULL{only_missing}"
+        ), {"model": model}).rowcount
+    return updated
+
+def _m007_warranty_expiry(conn):
+    conn.execute(text("CREATE INDEX IF NOT EXISTS ix_batteries_warranty_expiry ON batteries (warranty_expiry)"))
+    fill_warranty_expiry(conn)
+
+def _m008_battery_version(conn):
+    if not _column_exists(conn, "batteries", "version"):
+        conn.execute(text("ALTER TABLE batteries ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+
+# --- EXCHANGE PARTITIONS (Postgres) ---
+# On Postgres exchanges is range-partitioned on date, one partition per year
+# (exchanges_y2025) plus a default one for anything outside them. Queries still
+# go through the exchanges table; a closed year leaves by dropping its
+# partition (see archive.py). SQLite keeps a single table.
+
+EXCHANGE_PARTITION_PREFIX = "exchanges_y"
+EXCHANGE_DEFAULT_PARTITION = "exchanges_default"
+# The partition key cannot be NULL; exchanges logged before dates were recorded get this one
+UNDATED_EXCHANGE_DATE = "1970-01-01"
+_EXCHANGE_COLUMNS = "id, date, old_battery_serial, new_battery_serial, customer_phone, action_taken, ticket_id, notes"
+
+def _year_bounds(year):
+    return f"FROM ('{year}-01-01') TO ('{year + 1}-01-01')"
+
+def exchanges_partitioned(conn):
+    if conn.dialect.name != "postgresql":
+        return False
+    return bool(conn.execute(text("SELECT relkind = 'p' FROM pg_class WHERE oid = to_regclass('exchanges')")).scalar())
+
+def exchange_partition_years(conn):
+    """Years that have their own exchanges partition (none unless partitioned)."""
+    if not exchanges_partitioned(conn):
+        return []
+    names = conn.execute(text(
+        "SELECT c.relname FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid "
+        "WHERE i.inhparent = 'exchanges'::regclass"
+    )).scalars()
+    return sorted(int(name[len(EXCHANGE_PARTITION_PREFIX):]) for name in names if name.startswith(EXCHANGE_PARTITION_PREFIX))
+
+def create_exchange_partition(conn, year):
+    # Built beside the table and attached, so exchanges of that year that went
+    # to the default partition in the meantime move into it
+    name = f"{EXCHANGE_PARTITION_PREFIX}{year}"
+    conn.execute(text(f"CREATE TABLE {name} (LIKE exchanges INCLUDING DEFAULTS)"))
+    conn.execute(text(
+        f"WITH moved AS (DELETE FROM {EXCHANGE_DEFAULT_PARTITION} "
+        f"WHERE date >= '{year}-01-01' AND date < '{year + 1}-01-01' RETURNING *) "
+        f"INSERT INTO {name} SELECT * FROM moved"
+    ))
+    conn.execute(text(f"ALTER TABLE exchanges ATTACH PARTITION {name} FOR VALUES {_year_bounds(year)}"))
+
+def ensure_exchange_partitions(conn, today=None):
+    """
+    Creates this year's and next year's exchanges partitions if they are
+    missing, so new exchanges never pile up in the default partition. Returns
+    the years created; does nothing unless exchanges is partitioned.
+    """
+    if not exchanges_partitioned(conn):
+        return []
+    conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+    year = (today or date.today()).year
+    existing = set(exchange_partition_years(conn))
+    created = [y for y in (year, year + 1) if y not in existing]
+    for y in created:
+        create_exchange_partition(conn, y)
+    return created
+
+def _m009_partition_exchanges(conn):
+    # Postgres only. A partitioned table's primary key must contain the
+    # partition key, so it becomes (id, date) with date NOT NULL. The table is
+    # rebuilt: copied into yearly partitions, then the indexes recreated on it;
+    # the id sequence carries over.
+    if conn.dialect.name != "postgresql" or exchanges_partitioned(conn):
+        return
+    sequence = conn.execute(text("SELECT pg_get_serial_sequence('exchanges', 'id')")).scalar()
+    indexes = conn.execute(text(
+        "SELECT indexdef FROM pg_indexes "
+        "WHERE schemaname = current_schema() AND tablename = 'exchanges' AND indexname <> 'exchanges_pkey'"
+    )).scalars().all()
+    years = set(conn.execute(text(
+        "SELECT DISTINCT extract(year FROM date)::int FROM exchanges WHERE date IS NOT NULL"
+    )).scalars())
+    years |= {date.today().year, date.today().year + 1}
+
+    conn.execute(text("ALTER TABLE exchanges RENAME TO exchanges_unpartitioned"))
+    conn.execute(text("ALTER TABLE exchanges_unpartitioned RENAME CONSTRAINT exchanges_pkey TO exchanges_unpartitioned_pkey"))
+    conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY NONE"))
+    conn.execute(text(
+        f"CREATE TABLE exchanges ("
+        f"id INTEGER NOT NULL DEFAULT nextval('{sequence}'), "
+        f"date TIMESTAMP NOT NULL, "
+        f"old_battery_serial TEXT, new_battery_serial TEXT, customer_phone TEXT, "
+        f"action_taken TEXT, ticket_id TEXT, notes TEXT, "
+        f"PRIMARY KEY (id, date)"
+        f") PARTITION BY RANGE (date)"
+    ))
+    conn.execute(text(f"CREATE TABLE {EXCHANGE_DEFAULT_PARTITION} PARTITION OF exchanges DEFAULT"))
+    for year in sorted(years):
+        conn.execute(text(
+            f"CREATE TABLE {EXCHANGE_PARTITION_PREFIX}{year} PARTITION OF exchanges FOR VALUES {_year_bounds(year)}"
+        ))
+    conn.execute(text(
+        f"INSERT INTO exchanges ({_EXCHANGE_COLUMNS}) "
+        f"SELECT id, COALESCE(date, TIMESTAMP '{UNDATED_EXCHANGE_DATE}'), old_battery_serial, new_battery_serial, "
+        f"customer_phone, action_taken, ticket_id, notes FROM exchanges_unpartitioned"
+    ))
+    conn.execute(text("DROP TABLE exchanges_unpartitioned"))
+    conn.execute(text(f"ALTER SEQUENCE {sequence} OWNED BY exchanges.id"))
+    # Created on the parent, each index is built on every partition
+    for definition in indexes:
+        conn.execute(text(definition))
+
+def _m010_legacy_battery_statuses(conn):
+    # Statuses outside services.ALLOWED_TRANSITIONS. 'replaced' (only ever read,
+    # by the old dashboard) is a battery swapped out under warranty; a battery
+    # without a status is with its owner if it has one, else in stock.
+    conn.execute(text("UPDATE batteries SET status = 'returned_faulty/WNA', version = version + 1 WHERE status = 'replaced'"))
+    conn.execute(text(
+        "UPDATE batteries SET status = CASE WHEN current_owner_phone IS NULL THEN 'in_stock' "
+        "ELSE 'active_with_customer' END, version = version + 1 "
+        "WHERE status IS NULL OR status = ''"
+    ))
+
+def _m011_status_updates_not_counted(conn):
+    # STATUS_UPDATED exchanges only log a status change; they leave the report
+    # rollups and get their own count on archived years
+    conn.execute(text("DELETE FROM exchange_daily_rollup WHERE action_taken = 'STATUS_UPDATED'"))
+    if not _column_exists(conn, "exchange_archives", "status_updates"):
+        conn.execute(text("ALTER TABLE exchange_archives ADD COLUMN status_updates INTEGER NOT NULL DEFAULT 0"))
+
+def _m012_undated_last_indexes(conn):
+    # Scrap and challan pages are keyed on coalesce(date, '0001-01-01'), serial_no
+    # so rows without a date page correctly (services._undated_last); the
+    # expression indexes replace the plain ones and serve date ranges too
+    indexes = [
+        ("ix_scrap_batteries_received_date_serial_no", "scrap_batteries", "received_date"),
+        ("ix_challan_batteries_challan_date_serial_no", "challan_batteries", "challan_date"),
+    ]
+    for name, table, column in indexes:
+        conn.execute(text(f"DROP INDEX IF EXISTS {name}"))
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS {name.replace('_serial_no', '_undated_serial_no')} "
+            f"ON {table} ((coalesce({column}, '0001-01-01')), serial_no)"
+        ))
+
+def _m013_receipt_index_undated_last(conn):
+    # Receipt reprints are keyed on coalesce(date, '0001-01-01'), id like the
+    # scrap and challan lists (migration 12)
+    conn.execute(text("DROP INDEX IF EXISTS ix_exchanges_action_taken_date_id"))
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_exchanges_action_taken_undated_date_id "
+        "ON exchanges (action_taken, (coalesce(date, '0001-01-01')), id)"
+    ))
+
+_STATUS_NOTE_PREFIX = "Status changed to "
+
+def _add_status_to_archive_file(path):
+    # Rewrites one archived year with the status column, row group by row group
+    # so the id ranges reads skip on are kept; replaced only once complete
+    source = pq.ParquetFile(path)
+    if "status" in source.schema_arrow.names:
+        return
+    partial = f"{path}.partial"
+    with pq.ParquetWriter(partial, source.schema_arrow.append(pa.field("status", pa.string())), compression="zstd") as writer:
+        for group in range(source.num_row_groups):
+            table = source.read_row_group(group)
+            notes = table.column("notes").to_pandas()
+            updated = (table.column("action_taken").to_pandas() == "STATUS_UPDATED") & notes.str.startswith(_STATUS_NOTE_PREFIX, na=False)
+            status = notes.str.removeprefix(_STATUS_NOTE_PREFIX).str.strip().where(updated)
+            writer.write_table(table.append_column("status", pa.array(status, type=pa.string(), from_pandas=True)))
+    os.replace(partial, path)
+
+def _m014_exchange_status(conn):
+    # The status a STATUS_UPDATED exchange set, which the ledger replay read
+    # back from the notes until now; backfilled from them once, like ticket_id
+    # in migration 2, in the table and in the years already archived
+    if not _column_exists(conn, "exchanges", "status"):
+        conn.execute(text("ALTER TABLE exchanges ADD COLUMN status TEXT"))
+    conn.execute(text(
+        f"UPDATE exchanges SET status = trim(substr(notes, {len(_STATUS_NOTE_PREFIX) + 1})) "
+        f"WHERE action_taken = 'STATUS_UPDATED' AND status IS NULL AND notes LIKE '{_STATUS_NOTE_PREFIX}%'"
+    ))
+    directory = get_exchange_archive_dir()
+    for file_name in conn.execute(text("SELECT file_name FROM exchange_archives")).scalars():
+        path = os.path.join(directory, file_name)
+        if os.path.exists(path):
+            _add_status_to_archive_file(path)
+
+def _m015_service_queue_index(conn):
+    # The service queue pages oldest purchase first on
+    # (coalesce(date_of_purchase, '9999-12-31'), serial_no) within a status
+    conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_batteries_status_undated_purchase_serial_no "
+        "ON batteries (status, (coalesce(date_of_purchase, '9999-12-31')), serial_no)"
+    ))
+
+# (version, description, function). Append only - never renumber or edit a
+# migration that has already shipped.
+MIGRATIONS = [
+    (1, "Secondary indexes on hot lookup columns", _m001_hot_lookup_indexes),
+    (2, "exchanges.ticket_id column, backfilled from notes", _m002_exchange_ticket_id),
+    (3, "Composite indexes for keyset pagination", _m003_keyset_pagination_indexes),
+    (4, "Native DATE/TIMESTAMP columns", _m004_native_date_types),
+    (5, "Substring search index (pg_trgm / SQLite FTS5 trigram)", _m005_search_index),
+    (6, "Composite index for receipt reprints by date", _m006_receipt_index),
+    (7, "Warranty expiry from the model catalog, indexed", _m007_warranty_expiry),
+    (8, "batteries.version for compare-and-swap status changes", _m008_battery_version),
+    (9, "exchanges partitioned by year on Postgres", _m009_partition_exchanges),
+    (10, "Legacy and missing battery statuses mapped to the state machine", _m010_legacy_battery_statuses),
+    (11, "STATUS_UPDATED exchanges left out of the rollups", _m011_status_updates_not_counted),
+    (12, "Scrap and challan keyset indexes with undated rows last", _m012_undated_last_indexes),
+    (13, "Receipt keyset index with undated exchanges last", _m013_receipt_index_undated_last),
+    (14, "exchanges.status for STATUS_UPDATED, backfilled from notes", _m014_exchange_status),
+    (15, "Service queue keyset index, oldest purchase first", _m015_service_queue_index),
+]
+
+def _ensure_migrations_table(engine):
+    with engine.begin() as conn:
+        conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, "
+            "description TEXT, "
+            "applied_at TEXT)"
+        ))
+
+def get_applied_versions(conn):
+    return {row[0] for row in conn.execute(text("SELECT version FROM schema_migrations"))}
+
+def run_migrations(engine):
+    """
+    Applies every pending migration in version order, each in its own transaction.
+    Returns the list of versions applied by this call.
+    """
+    _ensure_migrations_table(engine)
+    applied_now = []
+    for version, description, migrate in MIGRATIONS:
+        with engine.begin() as conn:
+            if conn.dialect.name == "postgresql":
+                # Serialise concurrent app instances starting up against the same database
+                conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+            if version in get_applied_versions(conn):
+                continue
+            migrate(conn)
+            conn.execute(
+                text("INSERT INTO schema_migrations (version, description, applied_at) VALUES (:v, :d, :at)"),
+                {"v": version, "d": description, "at": datetime.now().strftime("%Y-%m-%d %H:%M:%S")}
+            )
+            applied_now.append(version)
+    return applied_now
+
+if __name__ == "__main__":
+    from database import get_db_engine
+    applied = run_migrations(get_db_engine())
+    if applied:
+        print(f"Applied migrations: {', '.join(str(v) for v in applied)}")
+    else:
+        print("Database schema is up to date.")
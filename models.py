@@ -1,62 +1,122 @@
-from sqlalchemy import Column, String, Integer, Text, Boolean
+from sqlalchemy import Column, String, Integer, Text, Boolean, Date, DateTime, Index, text
 from database import Base
 
 class Customer(Base):
     __tablename__ = 'customers'
     phone = Column(Text, primary_key=True)
     name = Column(Text)
-    created_at = Column(Text)
+    created_at = Column(Date)
 
 class Battery(Base):
+    # The service queue pages on (status, coalesce(date_of_purchase), serial_no),
+    # an expression index created by migration 15
     __tablename__ = 'batteries'
     serial_no = Column(Text, primary_key=True)
     model_type = Column(Text)
-    status = Column(Text)
-    sold_date = Column(Text)
-    date_of_purchase = Column(Text)
-    warranty_expiry = Column(Text)
-    current_owner_phone = Column(Text)
+    status = Column(Text, index=True)
+    sold_date = Column(Date)
+    date_of_purchase = Column(Date)
+    # date_of_purchase + the model's term in config.BATTERY_CATALOG
+    warranty_expiry = Column(Date, index=True)
+    current_owner_phone = Column(Text, index=True)
     ticket_id = Column(Text)
     vehicle_no = Column(Text)
     # Removed complex loaner tracking, kept simple flag on the battery being serviced
     has_loaner = Column(Boolean, default=False)
+    # Bumped by every status change; see ALLOWED_TRANSITIONS in services.py
+    version = Column(Integer, nullable=False, default=0, server_default=text("0"))
 
 class Exchange(Base):
+    # Range-partitioned by year on Postgres (migration 9), with primary key
+    # (id, date); closed years can be archived to Parquet (archive.py)
     __tablename__ = 'exchanges'
     id = Column(Integer, primary_key=True, autoincrement=True)
-    date = Column(Text)
-    old_battery_serial = Column(Text)
-    new_battery_serial = Column(Text)
+    date = Column(DateTime, index=True)
+    old_battery_serial = Column(Text, index=True)
+    new_battery_serial = Column(Text, index=True)
     customer_phone = Column(Text)
     action_taken = Column(Text)
+    ticket_id = Column(Text, index=True)
     notes = Column(Text)
+    # The status a STATUS_UPDATED exchange set; NULL for every other action
+    status = Column(Text)
+
+    # Composite with id so filtered history pages are served newest-first
+    # straight from the index (keyset pagination). Receipts page on
+    # (action_taken, coalesce(date), id), an expression index from migration 13.
+    __table_args__ = (
+        Index("ix_exchanges_customer_phone_id", "customer_phone", "id"),
+        Index("ix_exchanges_action_taken_id", "action_taken", "id"),
+    )
 
 class ScrapBattery(Base):
+    # Paged by (coalesce(received_date), serial_no): the index is an expression
+    # index, created by migration 12
     __tablename__ = 'scrap_batteries'
     serial_no = Column(Text, primary_key=True)
     model_type = Column(Text)
-    received_date = Column(Text)
+    received_date = Column(Date)
     customer_phone = Column(Text)
     ticket_id = Column(Text)
     notes = Column(Text)
 
 class ChallanBattery(Base):
+    # Paged by (coalesce(challan_date), serial_no), see ScrapBattery
     __tablename__ = 'challan_batteries'
     serial_no = Column(Text, primary_key=True)
     model_type = Column(Text)
-    received_date = Column(Text)
+    received_date = Column(Date)
     customer_phone = Column(Text)
     ticket_id = Column(Text)
     notes = Column(Text)
-    challan_date = Column(Text)
+    challan_date = Column(DateTime)
 
 class ArchivedScrapBattery(Base):
     __tablename__ = 'audit_scrap_batteries'
     serial_no = Column(Text, primary_key=True)
     model_type = Column(Text)
-    received_date = Column(Text)
+    received_date = Column(Date)
     customer_phone = Column(Text)
     ticket_id = Column(Text)
     notes = Column(Text)
-    challan_date = Column(Text)
-    final_archived_date = Column(Text)
+    challan_date = Column(DateTime)
+    final_archived_date = Column(DateTime)
+
+class ExchangeDailyRollup(Base):
+    # Exchanges counted per day, action and battery model; maintained by
+    # services.refresh_rollups() so reports never scan the exchanges ledger
+    __tablename__ = 'exchange_daily_rollup'
+    day = Column(Date, primary_key=True)
+    action_taken = Column(Text, primary_key=True)
+    model_type = Column(Text, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class RollupCheckpoint(Base):
+    # High-water mark: the last exchanges.id already processed by a rollup or
+    # by the ledger replay
+    __tablename__ = 'rollup_checkpoints'
+    name = Column(Text, primary_key=True)
+    last_exchange_id = Column(Integer, nullable=False, default=0)
+    updated_at = Column(DateTime)
+
+class BatteryLedgerState(Base):
+    # Battery status and owner as replayed from the exchanges ledger (ledger.py),
+    # compared against batteries to find rows that drifted from their history
+    __tablename__ = 'battery_ledger_state'
+    serial_no = Column(Text, primary_key=True)
+    status = Column(Text)
+    current_owner_phone = Column(Text)
+    last_exchange_id = Column(Integer)
+
+class ExchangeArchive(Base):
+    # One row per year of exchanges moved out of the exchanges table into a
+    # Parquet file (archive.py); file_name is relative to EXCHANGE_ARCHIVE_DIR
+    __tablename__ = 'exchange_archives'
+    year = Column(Integer, primary_key=True)
+    file_name = Column(Text, nullable=False)
+    rows = Column(Integer, nullable=False)
+    # Of those, STATUS_UPDATED rows, which the dashboard total leaves out
+    status_updates = Column(Integer, nullable=False, default=0, server_default=text("0"))
+    first_exchange_id = Column(Integer)
+    last_exchange_id = Column(Integer)
+    archived_at = Column(DateTime)
@@ -0,0 +1,178 @@
+import abc
+import queue
+import secrets
+import threading
+import time
+import uuid
+from config import SHOP_NAME, get_setting
+
+# One-time passwords for warranty claims and pickups. request_otp() stores the
+# code server-side under a random token and queues the SMS; a background
+# worker hands it to the SMS provider, so the page never waits on the gateway.
+# The page keeps only the token, polls delivery_status() and finally calls
+# check_otp() with what the customer read out.
+#
+# Codes live for OTP_TTL_SECONDS and allow OTP_MAX_ATTEMPTS wrong guesses.
+# State is per process, which is what a single Streamlit server needs.
+
+OTP_TTL_SECONDS = 300
+OTP_MAX_ATTEMPTS = 5
+OTP_PURPOSES = {"claim": "warranty claim", "pickup": "battery pickup"}
+
+QUEUED, SENT, FAILED, EXPIRED = "queued", "sent", "failed", "expired"
+VERIFIED, INVALID, LOCKED, UNKNOWN = "verified", "invalid", "locked", "unknown"
+
+
+# --- PROVIDERS ---
+class SMSProvider(abc.ABC):
+    """Sends one text message. Raise to report a failed delivery."""
+
+    @abc.abstractmethod
+    def send(self, phone, message):
+        ...
+
+
+class FakeSMSProvider(SMSProvider):
+    """
+    Local stand-in for an SMS gateway: waits `delay` seconds to mimic the
+    network, then keeps the message in an outbox instead of sending it.
+    """
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.outbox = []
+        self._lock = threading.Lock()
+
+    def send(self, phone, message):
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("SMS gateway unavailable")
+        with self._lock:
+            self.outbox.append((phone, message))
+
+    def last_message(self, phone):
+        with self._lock:
+            for sent_to, message in reversed(self.outbox):
+                if sent_to == phone:
+                    return message
+        return None
+
+
+_provider = None
+_provider_lock = threading.Lock()
+
+def get_provider():
+    global _provider
+    with _provider_lock:
+        if _provider is None:
+            _provider = FakeSMSProvider(delay=float(get_setting("FAKE_SMS_DELAY", 1.0)))
+        return _provider
+
+def set_provider(provider):
+    """Plugs in a real gateway (or a test double) in place of FakeSMSProvider."""
+    global _provider
+    with _provider_lock:
+        _provider = provider
+
+
+# --- STORE ---
+_otps = {}
+_store_lock = threading.Lock()
+
+def _purge_expired(now):
+    # Called with _store_lock held
+    for token in [t for t, entry in _otps.items() if entry["expires_at"] <= now]:
+        del _otps[token]
+
+def _update(token, **changes):
+    with _store_lock:
+        if token in _otps:
+            _otps[token].update(changes)
+
+
+# --- DISPATCH ---
+_outgoing = queue.Queue()
+_worker = None
+_worker_lock = threading.Lock()
+
+def _dispatch_loop():
+    while True:
+        token, phone, message = _outgoing.get()
+        try:
+            get_provider().send(phone, message)
+            _update(token, status=SENT)
+        except Exception as e:
+            _update(token, status=FAILED, error=str(e))
+        finally:
+            _outgoing.task_done()
+
+def _ensure_worker():
+    global _worker
+    with _worker_lock:
+        if _worker is None or not _worker.is_alive():
+            _worker = threading.Thread(target=_dispatch_loop, name="otp-dispatch", daemon=True)
+            _worker.start()
+
+
+# --- API ---
+def request_otp(phone, purpose):
+    """
+    Creates a code for `phone`, queues the SMS and returns at once with the
+    token that identifies this OTP.
+    """
+    code = f"{secrets.randbelow(9000) + 1000}"
+    token = uuid.uuid4().hex
+    now = time.monotonic()
+    with _store_lock:
+        _purge_expired(now)
+        _otps[token] = {
+            "phone": phone, "purpose": purpose, "code": code, "status": QUEUED, "error": None,
+            "attempts": 0, "expires_at": now + OTP_TTL_SECONDS,
+        }
+    message = f"{SHOP_NAME}: your OTP for {OTP_PURPOSES.get(purpose, purpose)} is {code}. Valid for {OTP_TTL_SECONDS // 60} minutes."
+    _ensure_worker()
+    _outgoing.put((token, phone, message))
+    return token
+
+def delivery_status(token):
+    """{"status": queued/sent/failed/expired, "error", "phone", "expires_in" seconds}"""
+    now = time.monotonic()
+    with _store_lock:
+        entry = _otps.get(token)
+        if entry is None or entry["expires_at"] <= now:
+            return {"status": EXPIRED, "error": None, "phone": None, "expires_in": 0}
+        return {
+            "status": entry["status"], "error": entry["error"], "phone": entry["phone"],
+            "expires_in": int(entry["expires_at"] - now),
+        }
+
+def check_otp(token, code):
+    """
+    Returns VERIFIED (and uses the OTP up), INVALID, LOCKED after too many
+    wrong codes, EXPIRED, or UNKNOWN for a token that was never issued.
+    """
+    now = time.monotonic()
+    with _store_lock:
+        entry = _otps.get(token)
+        if entry is None:
+            return UNKNOWN
+        if entry["expires_at"] <= now:
+            del _otps[token]
+            return EXPIRED
+        if entry["attempts"] >= OTP_MAX_ATTEMPTS:
+            return LOCKED
+        # Compared as bytes: compare_digest rejects str with non-ASCII characters
+        if secrets.compare_digest(entry["code"].encode(), str(code or "").strip().encode()):
+            del _otps[token]
+            return VERIFIED
+        entry["attempts"] += 1
+        return LOCKED if entry["attempts"] >= OTP_MAX_ATTEMPTS else INVALID
+
+def cancel_otp(token):
+    with _store_lock:
+        _otps.pop(token, None)
+
+def wait_for_dispatch():
+    """Blocks until every queued message has been handed to the provider (for scripts and tests)."""
+    _outgoing.join()
@@ -0,0 +1,145 @@
+import html
+import io
+import re
+import string
+import tempfile
+import zipfile
+from datetime import datetime
+import pandas as pd
+from config import SHOP_NAME
+from services import RECEIPT_ACTIONS, get_receipt_rows_df
+
+# Warranty receipts as HTML. The template is parsed once at import; every field
+# is HTML-escaped before it is substituted. Batch output walks the exchanges a
+# page at a time and writes each receipt as soon as it is rendered, so memory
+# stays flat however many receipts a date range holds.
+#
+# There is no PDF renderer in the stack: the combined document carries print
+# CSS (one receipt per sheet), so "Print to PDF" in a browser produces the
+# audit PDF.
+
+RECEIPT_PAGE_SIZE = 500
+# Printed in place of the exchange time on reprints of legacy exchanges without a date
+UNDATED = "date not recorded"
+RECEIPT_FIELDS = ["cust_name", "vehicle_no", "new_serial", "old_serial", "ticket_id", "new_model", "purchase_date", "notes"]
+
+RECEIPT_TEMPLATE = string.Template("""
+<div class="receipt" style="font-family: 'Segoe UI', Tahoma, Geneva, Verdana, sans-serif; padding: 20px; border: 1px solid #eee; max-width: 500px; margin: auto; background-color: white; color: #333;">
+    <div style="text-align: center; border-bottom: 2px solid #ed1c24; padding-bottom: 10px;">
+        <h2 style="margin: 0; color: #ed1c24;">$shop_name</h2>
+        <p style="margin: 5px 0; font-size: 14px;">Authorized Exide Care Dealer</p>
+    </div>
+
+    <div style="margin: 20px 0;">
+        <h4 style="border-bottom: 1px solid #eee; padding-bottom: 5px;">WARRANTY TRANSACTION RECEIPT</h4>
+        <table style="width: 100%; font-size: 14px; border-collapse: collapse;">
+            <tr><td style="padding: 5px 0; color: #666;">Customer Name:</td><td style="padding: 5px 0; font-weight: bold;">$cust_name</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">Vehicle Reg No:</td><td style="padding: 5px 0; font-weight: bold;">$vehicle_no</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">New Battery SN:</td><td style="padding: 5px 0; font-weight: bold;">$new_serial</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">Old Battery SN:</td><td style="padding: 5px 0; font-weight: bold;">$old_serial</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">Exide Ticket ID:</td><td style="padding: 5px 0; font-weight: bold;">$ticket_id</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">Battery Model:</td><td style="padding: 5px 0; font-weight: bold;">$new_model</td></tr>
+            <tr><td style="padding: 5px 0; color: #666;">Purchase Date:</td><td style="padding: 5px 0; font-weight: bold;">$purchase_date</td></tr>
+        </table>
+    </div>
+
+    <div style="margin-top: 20px; padding: 10px; background-color: #f9f9f9; border-radius: 4px; font-size: 13px;">
+        <strong>Technician Notes:</strong><br>
+        $notes
+    </div>
+
+    <div style="margin-top: 30px; text-align: center; font-size: 12px; color: #999; border-top: 1px solid #eee; padding-top: 10px;">
+        Generated on: $generated_on<br>
+        Thank you for choosing Exide Care!
+    </div>
+</div>
+""")
+
+DOCUMENT_HEAD = string.Template("""<!DOCTYPE html>
+<html><head><meta charset="utf-8"><title>$title</title>
+<style>
+body { background: #f4f4f4; }
+.receipt { margin-bottom: 24px !important; }
+@media print { body { background: white; } .receipt { page-break-after: always; break-after: page; } }
+</style></head><body>
+""")
+DOCUMENT_TAIL = "</body></html>\n"
+_UNSAFE_FILENAME_CHARS = re.compile(r"[^\w.-]")
+
+
+def _text(value):
+    if value is None or (not isinstance(value, str) and pd.isna(value)):
+        return ""
+    if isinstance(value, (datetime, pd.Timestamp)):
+        return value.strftime("%Y-%m-%d")
+    return str(value)
+
+def render_receipt(summary, generated_on=None):
+    """
+    Renders one receipt from a dict with the RECEIPT_FIELDS keys.
+    `generated_on` defaults to now; reprints pass the exchange time, or UNDATED.
+    """
+    values = {field: html.escape(_text(summary.get(field))) for field in RECEIPT_FIELDS}
+    values["notes"] = values["notes"].replace("\n", "<br>")
+    generated_on = generated_on or datetime.now()
+    values["generated_on"] = html.escape(generated_on) if isinstance(generated_on, str) else generated_on.strftime("%Y-%m-%d %H:%M")
+    values["shop_name"] = html.escape(SHOP_NAME)
+    return RECEIPT_TEMPLATE.substitute(values)
+
+def iter_receipts(date_from=None, date_to=None, actions=RECEIPT_ACTIONS, page_size=RECEIPT_PAGE_SIZE):
+    """
+    Yields (exchange row, receipt html) for every matching exchange, newest
+    first and undated ones last, fetching page_size exchanges at a time.
+    """
+    cursor = None
+    while True:
+        page = get_receipt_rows_df(date_from, date_to, actions, page_size=page_size, cursor=cursor)
+        for row in page.itertuples(index=False):
+            yield row, render_receipt(row._asdict(), generated_on=row.date if pd.notna(row.date) else UNDATED)
+        if len(page) < page_size:
+            return
+        last = page.iloc[-1]
+        cursor = (None if pd.isna(last["date"]) else last["date"].to_pydatetime(), int(last["id"]))
+
+def _document_title(date_from, date_to):
+    return f"{SHOP_NAME} receipts {date_from or 'start'} to {date_to or 'today'}"
+
+def write_receipts_html(file_obj, date_from=None, date_to=None, actions=RECEIPT_ACTIONS, page_size=RECEIPT_PAGE_SIZE):
+    """Writes every receipt into one printable HTML document (a text file object). Returns the count."""
+    file_obj.write(DOCUMENT_HEAD.substitute(title=html.escape(_document_title(date_from, date_to))))
+    count = 0
+    for _, receipt in iter_receipts(date_from, date_to, actions, page_size):
+        file_obj.write(receipt)
+        count += 1
+    file_obj.write(DOCUMENT_TAIL)
+    return count
+
+def write_receipts_zip(file_obj, date_from=None, date_to=None, actions=RECEIPT_ACTIONS, page_size=RECEIPT_PAGE_SIZE):
+    """Writes a ZIP (to a binary file object) with one HTML file per receipt. Returns the count."""
+    count = 0
+    with zipfile.ZipFile(file_obj, "w", compression=zipfile.ZIP_DEFLATED) as archive:
+        for row, receipt in iter_receipts(date_from, date_to, actions, page_size):
+            serial = _text(row.new_serial or row.old_serial)
+            day = f"{row.date:%Y%m%d}" if pd.notna(row.date) else "undated"
+            name = f"receipt_{day}_{row.id}_{_UNSAFE_FILENAME_CHARS.sub('_', serial)}.html"
+            title = html.escape(f"Receipt - {serial}")
+            archive.writestr(name, DOCUMENT_HEAD.substitute(title=title) + receipt + DOCUMENT_TAIL)
+            count += 1
+    return count
+
+def receipts_file(date_from=None, date_to=None, zipped=False):
+    """
+    The receipts of a date range as bytes - a ZIP or one combined HTML
+    document - for a download button. Rendered into a temporary file first,
+    so only the finished document is held in memory; for very large ranges
+    use `python cli.py receipts`, which writes straight to disk.
+    """
+    with tempfile.TemporaryFile() as out:
+        if zipped:
+            write_receipts_zip(out, date_from, date_to)
+        else:
+            text = io.TextIOWrapper(out, encoding="utf-8")
+            write_receipts_html(text, date_from, date_to)
+            text.detach()
+        out.seek(0)
+        return out.read()
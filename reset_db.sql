@@ -2,6 +2,11 @@
 -- Run this in the Neon Console SQL Editor to reset your database schema.
 
 -- 1. Drop existing tables (Order matters due to potential foreign keys, though none are explicitly enforced here)
+DROP TABLE IF EXISTS schema_migrations;
+DROP TABLE IF EXISTS rollup_checkpoints;
+DROP TABLE IF EXISTS battery_ledger_state;
+DROP TABLE IF EXISTS exchange_archives;
+DROP TABLE IF EXISTS exchange_daily_rollup;
 DROP TABLE IF EXISTS audit_scrap_batteries;
 DROP TABLE IF EXISTS challan_batteries;
 DROP TABLE IF EXISTS scrap_batteries;
@@ -13,7 +18,7 @@ DROP TABLE IF EXISTS customers;
 CREATE TABLE customers (
     phone TEXT PRIMARY KEY,
     name TEXT,
-    created_at TEXT
+    created_at DATE
 );
 
 -- 3. Create Batteries Table
@@ -21,31 +26,37 @@ CREATE TABLE batteries (
     serial_no TEXT PRIMARY KEY,
     model_type TEXT,
     status TEXT,
-    sold_date TEXT,
-    date_of_purchase TEXT,
-    warranty_expiry TEXT,
+    sold_date DATE,
+    date_of_purchase DATE,
+    warranty_expiry DATE,
     current_owner_phone TEXT,
     ticket_id TEXT,
     vehicle_no TEXT,
-    has_loaner BOOLEAN DEFAULT FALSE
+    has_loaner BOOLEAN DEFAULT FALSE,
+    version INTEGER NOT NULL DEFAULT 0
 );
 
--- 4. Create Exchanges Table
+-- 4. Create Exchanges Table, partitioned by year on date (the app adds the
+--    yearly partitions at startup, see ensure_exchange_partitions in migrations.py)
 CREATE TABLE exchanges (
-    id SERIAL PRIMARY KEY,
-    date TEXT,
+    id SERIAL,
+    date TIMESTAMP NOT NULL,
     old_battery_serial TEXT,
     new_battery_serial TEXT,
     customer_phone TEXT,
     action_taken TEXT,
-    notes TEXT
-);
+    ticket_id TEXT,
+    notes TEXT,
+    status TEXT,
+    PRIMARY KEY (id, date)
+) PARTITION BY RANGE (date);
+CREATE TABLE exchanges_default PARTITION OF exchanges DEFAULT;
 
 -- 5. Create Scrap Batteries Table
 CREATE TABLE scrap_batteries (
     serial_no TEXT PRIMARY KEY,
     model_type TEXT,
-    received_date TEXT,
+    received_date DATE,
     customer_phone TEXT,
     ticket_id TEXT,
     notes TEXT
@@ -55,23 +66,79 @@ CREATE TABLE scrap_batteries (
 CREATE TABLE challan_batteries (
     serial_no TEXT PRIMARY KEY,
     model_type TEXT,
-    received_date TEXT,
+    received_date DATE,
     customer_phone TEXT,
     ticket_id TEXT,
     notes TEXT,
-    challan_date TEXT
+    challan_date TIMESTAMP
 );
 
 -- 7. Create Archived Scrap Batteries Table (Audit)
 CREATE TABLE audit_scrap_batteries (
     serial_no TEXT PRIMARY KEY,
     model_type TEXT,
-    received_date TEXT,
+    received_date DATE,
     customer_phone TEXT,
     ticket_id TEXT,
     notes TEXT,
-    challan_date TEXT,
-    final_archived_date TEXT
+    challan_date TIMESTAMP,
+    final_archived_date TIMESTAMP
+);
+
+-- 8. Secondary indexes for the hot lookup columns (kept in sync with migrations.py)
+CREATE INDEX ix_batteries_status ON batteries (status);
+CREATE INDEX ix_batteries_current_owner_phone ON batteries (current_owner_phone);
+CREATE INDEX ix_batteries_warranty_expiry ON batteries (warranty_expiry);
+CREATE INDEX ix_batteries_status_undated_purchase_serial_no ON batteries (status, (coalesce(date_of_purchase, '9999-12-31')), serial_no);
+CREATE INDEX ix_exchanges_customer_phone_id ON exchanges (customer_phone, id);
+CREATE INDEX ix_exchanges_old_battery_serial ON exchanges (old_battery_serial);
+CREATE INDEX ix_exchanges_new_battery_serial ON exchanges (new_battery_serial);
+CREATE INDEX ix_exchanges_action_taken_id ON exchanges (action_taken, id);
+CREATE INDEX ix_exchanges_ticket_id ON exchanges (ticket_id);
+CREATE INDEX ix_exchanges_date ON exchanges (date);
+CREATE INDEX ix_exchanges_action_taken_undated_date_id ON exchanges (action_taken, (coalesce(date, '0001-01-01')), id);
+CREATE INDEX ix_scrap_batteries_received_date_undated_serial_no ON scrap_batteries ((coalesce(received_date, '0001-01-01')), serial_no);
+CREATE INDEX ix_challan_batteries_challan_date_undated_serial_no ON challan_batteries ((coalesce(challan_date, '0001-01-01')), serial_no);
+
+-- 9. Trigram indexes for the type-ahead search (substring matching)
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+CREATE INDEX ix_batteries_serial_no_trgm ON batteries USING gin (serial_no gin_trgm_ops);
+CREATE INDEX ix_batteries_vehicle_no_trgm ON batteries USING gin (vehicle_no gin_trgm_ops);
+CREATE INDEX ix_customers_phone_trgm ON customers USING gin (phone gin_trgm_ops);
+CREATE INDEX ix_customers_name_trgm ON customers USING gin (name gin_trgm_ops);
+
+-- 10. Reporting rollups, filled incrementally from exchanges by services.refresh_rollups()
+CREATE TABLE exchange_daily_rollup (
+    day DATE NOT NULL,
+    action_taken TEXT NOT NULL,
+    model_type TEXT NOT NULL,
+    count INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY (day, action_taken, model_type)
+);
+
+CREATE TABLE rollup_checkpoints (
+    name TEXT PRIMARY KEY,
+    last_exchange_id INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP
+);
+
+-- 11. Battery state replayed from the exchanges ledger (ledger.py)
+CREATE TABLE battery_ledger_state (
+    serial_no TEXT PRIMARY KEY,
+    status TEXT,
+    current_owner_phone TEXT,
+    last_exchange_id INTEGER
+);
+
+-- 12. Years of exchanges archived to Parquet files (archive.py)
+CREATE TABLE exchange_archives (
+    year INTEGER PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    rows INTEGER NOT NULL,
+    status_updates INTEGER NOT NULL DEFAULT 0,
+    first_exchange_id INTEGER,
+    last_exchange_id INTEGER,
+    archived_at TIMESTAMP
 );
 
 -- Verification
@@ -1,68 +1,415 @@
-from datetime import datetime
-import random
+from contextlib import contextmanager
+from datetime import date, datetime, time as dt_time, timedelta
+import csv
+import io
+import json
+import operator
+import os
+import threading
 import time
-import streamlit as st
+import numpy as np
 import pandas as pd
-from database import get_session
-from models import Customer, Battery, Exchange, ScrapBattery, ChallanBattery, ArchivedScrapBattery
+import pyarrow.parquet as pq
+from sqlalchemy import Boolean, Date, DateTime, case, event, func, literal, literal_column, null, or_, select, text, tuple_, union_all, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+from sqlalchemy.orm import Session, aliased
+from config import BATTERY_CATALOG, BATTERY_MODELS, get_exchange_archive_dir
+from database import unit_of_work
+from migrations import warranty_expiry_expr, fill_warranty_expiry
+from instrumentation import track_service
+from models import (
+    Customer, Battery, Exchange, ScrapBattery, ChallanBattery, ArchivedScrapBattery,
+    ExchangeArchive, ExchangeDailyRollup, RollupCheckpoint
+)
 
-def calculate_age(purchase_date_str):
-    if not purchase_date_str: return "N/A"
-    try:
-        p_date = datetime.strptime(purchase_date_str, "%Y-%m-%d")
-        today = datetime.now()
-        diff = today - p_date
-        days = diff.days
-        months = days // 30
-        remaining_days = days % 30
-        return f"{days} days (~{months} months, {remaining_days} days)"
-    except ValueError:
-        return "Invalid Date"
-
-def generate_otp():
-    return str(random.randint(1000, 9999))
-
-def send_otp_simulation(phone, otp):
-    with st.spinner(f"Sending OTP to {phone}..."):
-        time.sleep(1)
-    st.toast(f"🔔 SMS SENT: Your OTP is {otp}", icon="📱")
-    return True
+def calculate_age(purchase_date):
+    if purchase_date is None or pd.isna(purchase_date): return "N/A"
+    if isinstance(purchase_date, datetime):
+        purchase_date = purchase_date.date()
+    elif isinstance(purchase_date, str):
+        try:
+            purchase_date = date.fromisoformat(purchase_date)
+        except ValueError:
+            return "Invalid Date"
+    days = (date.today() - purchase_date).days
+    months = days // 30
+    remaining_days = days % 30
+    return f"{days} days (~{months} months, {remaining_days} days)"
+
+def calculate_ages(purchase_dates, warranty_expiry=None, today=None):
+    """
+    Vectorised calculate_age for a whole column of purchase dates. Returns a
+    DataFrame on the same index with age_days, age_months and the same "Age"
+    label calculate_age gives for one date. When a warranty_expiry column is
+    passed, warranty_days_left and a "Warranty" label are added too.
+    """
+    today = pd.Timestamp(today or date.today())
+    purchase_dates = pd.Series(purchase_dates)
+    parsed = pd.to_datetime(purchase_dates, errors="coerce").dt.normalize()
+    days = (today - parsed).dt.days.astype("Int64")
+    months = days // 30
+
+    # Ages repeat a lot (one per day since purchase), so format each distinct
+    # age once and spread the labels back out, instead of building N strings
+    label = pd.Series(np.where(purchase_dates.isna(), "N/A", "Invalid Date"), index=purchase_dates.index, dtype=object)
+    valid = parsed.notna().to_numpy()
+    if valid.any():
+        distinct, positions = np.unique(days[valid].to_numpy(dtype=np.int64), return_inverse=True)
+        labels = np.array([f"{d} days (~{d // 30} months, {d % 30} days)" for d in distinct.tolist()], dtype=object)
+        label[valid] = labels[positions]
+    ages = pd.DataFrame({"age_days": days, "age_months": months, "Age": label}, index=purchase_dates.index)
+
+    if warranty_expiry is not None:
+        expiry = pd.to_datetime(pd.Series(warranty_expiry, index=purchase_dates.index), errors="coerce")
+        days_left = (expiry - today).dt.days.astype("Int64")
+        ages["warranty_days_left"] = days_left
+        ages["Warranty"] = np.select(
+            [expiry.isna(), expiry < today], ["N/A", "Expired"], default="Valid"
+        )
+    return ages
+
+def now():
+    # Exchange and challan timestamps are kept to the second
+    return datetime.now().replace(microsecond=0)
+
+@contextmanager
+def _session_scope(session=None):
+    # Service functions join the caller's unit of work when given a session, so a
+    # page render can run several of them on one connection and one transaction.
+    # Called on their own, they get a private unit of work.
+    if session is not None:
+        yield session
+        return
+    with unit_of_work() as own_session:
+        yield own_session
+
+# --- WARRANTY ---
+WARRANTY_EXPIRING_DAYS = 30
+
+def warranty_expiry_for(model, purchase_date):
+    """Last day of warranty for a model bought on purchase_date, or None if either is unknown."""
+    terms = BATTERY_CATALOG.get(model)
+    if not terms or purchase_date is None or pd.isna(purchase_date):
+        return None
+    return (pd.Timestamp(purchase_date) + pd.DateOffset(months=terms["warranty_months"])).date()
+
+def _warranty_expiries(models, purchase_dates):
+    # Vectorised warranty_expiry_for, one date offset per model
+    months = models.map({model: terms["warranty_months"] for model, terms in BATTERY_CATALOG.items()})
+    purchased = pd.to_datetime(purchase_dates, errors="coerce")
+    expiry = pd.Series(pd.NaT, index=models.index, dtype="datetime64[ns]")
+    known = months.dropna()
+    for term, group in known.groupby(known):
+        expiry[group.index] = purchased[group.index] + pd.DateOffset(months=int(term))
+    return expiry.dt.date.where(expiry.notna(), None)
+
+def _apply_warranty_terms(battery):
+    # Called on every write that sets a battery's model or purchase date
+    battery.warranty_expiry = warranty_expiry_for(battery.model_type, battery.date_of_purchase)
+
+def warranty_status(expiry, today=None):
+    """{"status": "valid"/"expired"/"unknown", "expiry", "days_left"} for a warranty_expiry value."""
+    if expiry is None or pd.isna(expiry):
+        return {"status": "unknown", "expiry": None, "days_left": None}
+    days_left = (expiry - (today or date.today())).days
+    return {"status": "valid" if days_left >= 0 else "expired", "expiry": expiry, "days_left": days_left}
+
+# --- DASHBOARD CACHE ---
+# The dashboard counters are cached for the whole process and dropped whenever a
+# session that actually wrote something commits. Reads never commit changes, so
+# reruns that don't write anything are served without running the counters.
+#
+# Writes from elsewhere - cli.py, another app process, raw SQL - fire no
+# events here. Each read therefore first checks a cheap staleness key (the
+# newest exchange id and the number of batteries, from two index lookups) and
+# reloads when it moved, and no cached result outlives DASHBOARD_CACHE_TTL
+# seconds, which covers changes the key cannot see (a status set by hand).
+
+DASHBOARD_CACHE_TTL = 60
+_dashboard_cache = {"generation": 0, "stats": None, "key": None, "loaded_at": 0.0}
+_dashboard_cache_lock = threading.Lock()
+
+def invalidate_dashboard_cache():
+    with _dashboard_cache_lock:
+        _dashboard_cache["generation"] += 1
+        _dashboard_cache["stats"] = None
+
+@event.listens_for(Session, "after_flush")
+def _mark_session_wrote(session, flush_context):
+    session.info["wrote"] = True
+
+@event.listens_for(Session, "do_orm_execute")
+def _mark_statement_wrote(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        orm_execute_state.session.info["wrote"] = True
+
+@event.listens_for(Session, "after_commit")
+def _invalidate_after_write(session):
+    if session.info.pop("wrote", False):
+        invalidate_dashboard_cache()
+
+@event.listens_for(Session, "after_rollback")
+def _forget_rolled_back_write(session):
+    session.info.pop("wrote", None)
+
+# --- EXCHANGE ARCHIVE ---
+# Closed years of exchanges can be moved out of the exchanges table into one
+# Parquet file per year (archive.py), listed in exchange_archives. History
+# reads only open those files when called with include_archive=True: years
+# outside the date range are skipped, and a page stops at the first file whose
+# exchanges are all older than the page.
+
+ARCHIVE_BATCH_SIZE = 50000
+
+def _archive_files(session, date_from=None, date_to=None):
+    """(path, first_exchange_id, last_exchange_id) of the archived years in the range, newest first."""
+    query = select(ExchangeArchive.file_name, ExchangeArchive.first_exchange_id, ExchangeArchive.last_exchange_id)
+    if date_from is not None:
+        query = query.where(ExchangeArchive.year >= date_from.year)
+    if date_to is not None:
+        query = query.where(ExchangeArchive.year <= date_to.year)
+    directory = get_exchange_archive_dir()
+    return [
+        (os.path.join(directory, name), first_id, last_id)
+        for name, first_id, last_id in session.execute(query.order_by(ExchangeArchive.last_exchange_id.desc()))
+    ]
+
+def _read_archived_exchanges(session, where, page_size=None, cursor=None, date_from=None, date_to=None):
+    """
+    Archived exchanges matching `where`, newest first, with the columns of the
+    exchanges table. `where` is a list of alternatives, each a list of
+    (column, op, value) conditions that all have to hold - pyarrow's filters.
+    """
+    bounds = []
+    if cursor is not None:
+        bounds.append(("id", "<", cursor))
+    if date_from is not None:
+        bounds.append(("date", ">=", datetime.combine(date_from, dt_time.min)))
+    if date_to is not None:
+        bounds.append(("date", "<", datetime.combine(date_to + timedelta(days=1), dt_time.min)))
+    filters = [conditions + bounds for conditions in where]
+    found = pd.DataFrame(columns=[c.name for c in Exchange.__table__.columns])
+    for path, first_id, last_id in _archive_files(session, date_from, date_to):
+        if cursor is not None and first_id >= cursor:
+            continue
+        if page_size and len(found) >= page_size and last_id < found["id"].iloc[-1]:
+            break
+        rows = pd.read_parquet(path, filters=filters)
+        if not rows.empty:
+            found = rows if found.empty else pd.concat([found, rows], ignore_index=True)
+            found = found.sort_values("id", ascending=False, ignore_index=True)
+            if page_size:
+                found = found.head(page_size)
+    return found
+
+def _with_archive(session, exchanges, where, page_size=None, cursor=None, date_from=None, date_to=None):
+    """A newest-first page of exchanges from the table, merged with the archived ones that belong on it."""
+    archived = _read_archived_exchanges(session, where, page_size, cursor, date_from, date_to)
+    if archived.empty:
+        return exchanges
+    archived = archived[list(exchanges.columns)]
+    if exchanges.empty:
+        return archived
+    merged = pd.concat([exchanges, archived], ignore_index=True).sort_values("id", ascending=False, ignore_index=True)
+    return merged.head(page_size) if page_size else merged
+
+def _battery_archive_filter(serial):
+    return [[("old_battery_serial", "==", serial)], [("new_battery_serial", "==", serial)]]
+
+def _customer_archive_filter(phone):
+    return [[("customer_phone", "==", phone)]]
+
+@track_service
+def iter_archived_exchanges(columns=None, batch_size=ARCHIVE_BATCH_SIZE, session=None):
+    """
+    Yields the archived exchanges as DataFrames of up to batch_size rows,
+    oldest year first and in id order within a year.
+    """
+    with _session_scope(session) as session:
+        files = _archive_files(session)
+    for path, _, _ in reversed(files):
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=batch_size, columns=columns):
+            yield batch.to_pandas()
 
 # --- READ OPERATIONS ---
 
-def get_dashboard_stats():
-    session = get_session()
-    try:
-        total_customers = session.query(Customer).count()
-        batteries_replaced = session.query(Battery).filter_by(status='replaced').count()
-        exchanges_done = session.query(Exchange).count()
-        return {
-            "total_customers": total_customers,
-            "batteries_replaced": batteries_replaced,
-            "exchanges_done": exchanges_done
+# A nullable date leading a keyset key is coalesced to a day older than any
+# real one: undated rows come last in a newest-first list, and the key never
+# holds a NULL, which would drop every later row from a tuple comparison.
+# Migration 12 indexes the same expressions. Oldest-first lists (the service
+# queue) use a day later than any real one instead.
+_UNDATED = literal_column("'0001-01-01'")
+_UNDATED_OLDEST_FIRST = literal_column("'9999-12-31'")
+
+def _undated_last(column, oldest_first=False):
+    return func.coalesce(column, _UNDATED_OLDEST_FIRST if oldest_first else _UNDATED)
+
+def _keyset_page(query, key_columns, page_size=None, cursor=None, oldest_first=False):
+    """
+    Newest-first (or `oldest_first`) keyset pagination. `cursor` is the key of
+    the last row on the previous page - a single value for one key column, a
+    tuple for several - so each page is an index seek no matter how deep it is.
+    """
+    after, after_or_at = (operator.gt, operator.ge) if oldest_first else (operator.lt, operator.le)
+    if cursor is not None:
+        if len(key_columns) == 1:
+            query = query.filter(after(key_columns[0], cursor))
+        else:
+            # The row's own date is NULL (NaT in a DataFrame) where the key has the undated day
+            undated = _UNDATED_OLDEST_FIRST if oldest_first else _UNDATED
+            first, *rest = [undated if value is None or value is pd.NaT else value for value in cursor]
+            # (a, b) < (x, y) spelt out with a leading a <= x: SQLite does not
+            # range-scan an expression index from a row-value comparison
+            query = query.filter(
+                after_or_at(key_columns[0], first),
+                or_(after(key_columns[0], first), after(tuple_(*key_columns[1:]), tuple_(*rest))),
+            )
+    query = query.order_by(*[c.asc() if oldest_first else c.desc() for c in key_columns])
+    if page_size:
+        query = query.limit(page_size)
+    return query
+
+def _filter_date_range(query, column, date_from=None, date_to=None):
+    """
+    Inclusive date range on a Date or DateTime column. Written as plain
+    comparisons against the column so the database can range-scan its index.
+    """
+    if isinstance(column.type, DateTime):
+        # Whole days: from midnight on date_from up to (not including) midnight after date_to
+        if date_from is not None:
+            query = query.filter(column >= datetime.combine(date_from, dt_time.min))
+        if date_to is not None:
+            query = query.filter(column < datetime.combine(date_to + timedelta(days=1), dt_time.min))
+        return query
+    if date_from is not None:
+        query = query.filter(column >= date_from)
+    if date_to is not None:
+        query = query.filter(column <= date_to)
+    return query
+
+def _load_dashboard_stats(session=None):
+    with _session_scope(session) as session:
+        # One round trip: the two totals plus battery counts grouped by status and model
+        counters = union_all(
+            select(literal("customers").label("kind"), null().label("status"), null().label("model_type"), func.count().label("total"))
+                .select_from(Customer),
+            select(literal("exchanges"), null(), null(),
+                   func.count() - func.count(case((Exchange.action_taken == STATUS_UPDATE_ACTION, 1))))
+                .select_from(Exchange),
+            select(literal("exchanges"), null(), null(),
+                   func.coalesce(func.sum(ExchangeArchive.rows - ExchangeArchive.status_updates), 0)),
+            select(literal("batteries"), Battery.status, Battery.model_type, func.count())
+                .group_by(Battery.status, Battery.model_type),
+        )
+        stats = {
+            "total_customers": 0,
+            "exchanges_done": 0,
+            "total_batteries": 0,
+            "by_status": {},
+            "by_model": {},
         }
-    finally:
-        session.close()
+        for kind, status, model_type, total in session.execute(counters):
+            if kind == "customers":
+                stats["total_customers"] = total
+            elif kind == "exchanges":
+                # The table plus the years archived out of it
+                stats["exchanges_done"] += total
+            else:
+                status = status or "unknown"
+                model_type = model_type or "Unknown"
+                stats["total_batteries"] += total
+                stats["by_status"][status] = stats["by_status"].get(status, 0) + total
+                stats["by_model"][model_type] = stats["by_model"].get(model_type, 0) + total
+        # Swapped out under warranty (the legacy 'replaced' status, see migration 10)
+        stats["batteries_replaced"] = stats["by_status"].get("returned_faulty/WNA", 0)
+        return stats
 
-def get_batteries_in_service():
-    session = get_session()
-    try:
-        # Return list of objects. Since we query all, they are loaded.
-        # We need to be careful about detachment if we try to refresh them, but for read it's fine.
-        return session.query(Battery).filter(Battery.status.in_(['pending', 'ready_for_pickup'])).all()
-    finally:
-        session.close()
+def _dashboard_key(session=None):
+    with _session_scope(session) as session:
+        return tuple(session.execute(select(
+            select(func.max(Exchange.id)).scalar_subquery(),
+            select(func.count()).select_from(Battery).scalar_subquery(),
+        )).one())
 
-def get_recent_exchanges_df(limit=5):
-    session = get_session()
-    try:
+@track_service
+def get_dashboard_stats(session=None):
+    # The returned dict is shared between reruns - treat it as read-only.
+    key = _dashboard_key(session)
+    with _dashboard_cache_lock:
+        generation = _dashboard_cache["generation"]
+        cached = _dashboard_cache["stats"]
+        fresh = time.monotonic() - _dashboard_cache["loaded_at"] < DASHBOARD_CACHE_TTL
+        if cached is not None and _dashboard_cache["key"] == key and fresh:
+            return cached
+
+    loaded_at = time.monotonic()
+    stats = _load_dashboard_stats(session)
+
+    with _dashboard_cache_lock:
+        # A write that committed while we were reading makes this result stale
+        if _dashboard_cache["generation"] == generation:
+            _dashboard_cache.update(stats=stats, key=key, loaded_at=loaded_at)
+    return stats
+
+SERVICE_QUEUE_STATUSES = ['pending', 'ready_for_pickup']
+# Age since purchase in days: (at least, under); None means no upper bound
+SERVICE_AGE_BUCKETS = {
+    "Under 6 months": (0, 180),
+    "6-12 months": (180, 365),
+    "1-2 years": (365, 730),
+    "Over 2 years": (730, None),
+}
+
+@track_service
+def get_service_queue_df(status=None, loaner=None, age_bucket=None, ticket=None,
+                         page_size=None, cursor=None, session=None):
+    """
+    Batteries in the workshop (pending or ready for pickup), one row each with
+    only the columns the dashboard shows. has_loaner comes back as a plain
+    bool, and age_days, Age, warranty_days_left and Warranty are derived for
+    the whole frame at once by calculate_ages.
+
+    Optional filters: a single status, loaner True/False, an age_bucket name
+    from SERVICE_AGE_BUCKETS ("Unknown" for no purchase date) and part of a
+    ticket ID. Oldest purchase first, undated batteries last: pages are keyed
+    on (date_of_purchase, serial_no), served by the index from migration 15.
+    """
+    statuses = [status] if status else SERVICE_QUEUE_STATUSES
+    with _session_scope(session) as session:
+        query = session.query(
+            Battery.serial_no, Battery.ticket_id, Battery.vehicle_no, Battery.status,
+            Battery.current_owner_phone, Battery.date_of_purchase, Battery.warranty_expiry, Battery.has_loaner,
+            Battery.version
+        ).filter(Battery.status.in_(statuses))
+        if loaner is not None:
+            # NULL has_loaner is treated as no loaner
+            query = query.filter(Battery.has_loaner.is_(True) if loaner else func.coalesce(Battery.has_loaner, False).is_(False))
+        if age_bucket == "Unknown":
+            query = query.filter(Battery.date_of_purchase.is_(None))
+        elif age_bucket:
+            # Age buckets become a purchase-date range, so the filter runs in SQL
+            min_days, max_days = SERVICE_AGE_BUCKETS[age_bucket]
+            query = query.filter(Battery.date_of_purchase <= date.today() - timedelta(days=min_days))
+            if max_days is not None:
+                query = query.filter(Battery.date_of_purchase > date.today() - timedelta(days=max_days))
+        if ticket:
+            query = query.filter(Battery.ticket_id.icontains(ticket, autoescape=True))
+        purchased = _undated_last(Battery.date_of_purchase, oldest_first=True)
+        query = _keyset_page(query, [purchased, Battery.serial_no], page_size, cursor, oldest_first=True).statement
+        df = pd.read_sql(query, session.connection())
+    df["has_loaner"] = df["has_loaner"].fillna(False).astype(bool)
+    ages = calculate_ages(df["date_of_purchase"], df["warranty_expiry"])
+    return df.join(ages[["age_days", "Age", "warranty_days_left", "Warranty"]])
+
+@track_service
+def get_recent_exchanges_df(limit=5, session=None):
+    with _session_scope(session) as session:
         query = session.query(Exchange).order_by(Exchange.id.desc()).limit(limit).statement
-        df = pd.read_sql(query, session.bind)
+        df = pd.read_sql(query, session.connection())
         
-        # Extract Ticket ID from notes if available
-        if 'notes' in df.columns:
-            df['Ticket ID'] = df['notes'].str.extract(r'Ticket: (.*?)\.')
-            
+        df = df.rename(columns={'ticket_id': 'Ticket ID'})
+
         # Drop internal ID column
         if 'id' in df.columns:
             df = df.drop(columns=['id'])
@@ -75,402 +422,1110 @@ def get_recent_exchanges_df(limit=5):
         remaining_cols = [c for c in df.columns if c not in existing_cols]
         
         return df[existing_cols + remaining_cols]
-    finally:
-        session.close()
 
-def get_battery_by_serial(serial):
-    session = get_session()
-    try:
+@track_service
+def get_battery_by_serial(serial, session=None):
+    with _session_scope(session) as session:
         return session.query(Battery).filter_by(serial_no=serial).first()
-    finally:
-        session.close()
 
-def get_battery_details_df(serial):
-    session = get_session()
-    try:
+@track_service
+def get_batteries_expiring_soon(days=WARRANTY_EXPIRING_DAYS, limit=None, today=None, session=None):
+    """
+    Batteries still with their customer whose warranty ends within the next
+    `days` days, soonest first. A range scan on the warranty_expiry index.
+    """
+    today = today or date.today()
+    with _session_scope(session) as session:
+        query = (
+            session.query(
+                Battery.serial_no, Battery.model_type, Battery.warranty_expiry, Battery.current_owner_phone,
+                Customer.name.label("customer_name"), Battery.vehicle_no, Battery.status,
+            )
+            .outerjoin(Customer, Customer.phone == Battery.current_owner_phone)
+            .filter(Battery.current_owner_phone.isnot(None), Battery.status != 'returned_faulty/WNA')
+        )
+        query = _filter_date_range(query, Battery.warranty_expiry, today, today + timedelta(days=days))
+        query = query.order_by(Battery.warranty_expiry, Battery.serial_no)
+        if limit:
+            query = query.limit(limit)
+        df = pd.read_sql(query.statement, session.connection())
+        df["days_left"] = (pd.to_datetime(df["warranty_expiry"]) - pd.Timestamp(today)).dt.days
+        return df
+
+@track_service
+def get_battery_details_df(serial, session=None):
+    with _session_scope(session) as session:
         query = session.query(Battery).filter_by(serial_no=serial).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+        return pd.read_sql(query, session.connection())
 
-def get_battery_exchanges_df(serial):
-    session = get_session()
-    try:
-        query = session.query(Exchange).filter((Exchange.old_battery_serial == serial) | (Exchange.new_battery_serial == serial)).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+@track_service
+def get_battery_exchanges_df(serial, page_size=None, cursor=None, date_from=None, date_to=None,
+                             include_archive=False, session=None):
+    with _session_scope(session) as session:
+        query = session.query(Exchange).filter((Exchange.old_battery_serial == serial) | (Exchange.new_battery_serial == serial))
+        query = _filter_date_range(query, Exchange.date, date_from, date_to)
+        query = _keyset_page(query, [Exchange.id], page_size, cursor).statement
+        exchanges = pd.read_sql(query, session.connection())
+        if include_archive:
+            exchanges = _with_archive(session, exchanges, _battery_archive_filter(serial), page_size, cursor, date_from, date_to)
+        return exchanges
 
-def get_customer_by_phone(phone):
-    session = get_session()
-    try:
+@track_service
+def get_customer_by_phone(phone, session=None):
+    with _session_scope(session) as session:
         return session.query(Customer).filter_by(phone=phone).first()
-    finally:
-        session.close()
 
-def get_customer_details_df(phone):
-    session = get_session()
-    try:
+@track_service
+def get_customer_details_df(phone, session=None):
+    with _session_scope(session) as session:
         query = session.query(Customer).filter_by(phone=phone).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+        return pd.read_sql(query, session.connection())
 
-def get_customer_batteries_df(phone):
-    session = get_session()
-    try:
+@track_service
+def get_customer_batteries_df(phone, session=None):
+    with _session_scope(session) as session:
         query = session.query(Battery).filter_by(current_owner_phone=phone).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+        return pd.read_sql(query, session.connection())
 
-def get_customer_exchanges_df(phone):
-    session = get_session()
-    try:
-        query = session.query(Exchange).filter_by(customer_phone=phone).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+@track_service
+def get_customer_exchanges_df(phone, page_size=None, cursor=None, date_from=None, date_to=None,
+                              include_archive=False, session=None):
+    with _session_scope(session) as session:
+        query = session.query(Exchange).filter_by(customer_phone=phone)
+        query = _filter_date_range(query, Exchange.date, date_from, date_to)
+        query = _keyset_page(query, [Exchange.id], page_size, cursor).statement
+        exchanges = pd.read_sql(query, session.connection())
+        if include_archive:
+            exchanges = _with_archive(session, exchanges, _customer_archive_filter(phone), page_size, cursor, date_from, date_to)
+        return exchanges
 
-def get_ready_for_pickup_items_df(phone):
-    session = get_session()
-    try:
-        query = session.query(Battery.serial_no, Battery.model_type, Battery.status, Battery.ticket_id, Battery.vehicle_no, Battery.date_of_purchase, Battery.has_loaner)\
+@track_service
+def get_ticket_history(ticket_id, include_archive=False, session=None):
+    with _session_scope(session) as session:
+        query = session.query(Exchange).filter_by(ticket_id=ticket_id).order_by(Exchange.id).statement
+        exchanges = pd.read_sql(query, session.connection())
+        if include_archive:
+            exchanges = _with_archive(session, exchanges, [[("ticket_id", "==", ticket_id)]])
+            exchanges = exchanges.sort_values("id", ignore_index=True)
+        return exchanges
+
+# Exchanges that get a receipt at the counter (see receipts.py)
+RECEIPT_ACTIONS = ['NEW_REPLACEMENT_ISSUED']
+
+@track_service
+def get_receipt_rows_df(date_from=None, date_to=None, actions=RECEIPT_ACTIONS, page_size=None, cursor=None, session=None):
+    """
+    One page of exchanges with the customer and replacement battery details a
+    receipt shows, newest first, undated exchanges last. Keyed on (date, id) so
+    a date range is walked in the order of the exchanges date index; `cursor`
+    is (date, id).
+
+    The model and purchase date are the replacement battery's current ones:
+    exchanges do not record them, so a reprint shows any later correction
+    rather than what the original receipt printed.
+    """
+    with _session_scope(session) as session:
+        query = (
+            session.query(
+                Exchange.id, Exchange.date, Customer.name.label("cust_name"), Battery.vehicle_no,
+                Exchange.new_battery_serial.label("new_serial"), Exchange.old_battery_serial.label("old_serial"),
+                Exchange.ticket_id, Battery.model_type.label("new_model"),
+                Battery.date_of_purchase.label("purchase_date"), Exchange.notes,
+            )
+            .outerjoin(Customer, Customer.phone == Exchange.customer_phone)
+            .outerjoin(Battery, Battery.serial_no == Exchange.new_battery_serial)
+            .filter(Exchange.action_taken.in_([a for a in actions if a != STATUS_UPDATE_ACTION]))
+        )
+        dated = _undated_last(Exchange.date)
+        query = _filter_date_range(query, dated, date_from, date_to)
+        query = _keyset_page(query, [dated, Exchange.id], page_size, cursor).statement
+        return pd.read_sql(query, session.connection())
+
+# --- PROFILES (one round trip) ---
+# Each part of a profile is a scalar subquery aggregated to JSON, so the whole
+# profile comes back as one row from one statement.
+
+def _json_object(dialect_name, columns):
+    pairs = []
+    for column in columns:
+        pairs += [literal_column(f"'{column.name}'"), column]
+    if dialect_name == "postgresql":
+        return func.json_build_object(*pairs)
+    return func.json_object(*pairs)
+
+def _json_rows(dialect_name, subquery, order_by=None):
+    # Array of one JSON object per row of the subquery
+    row = _json_object(dialect_name, list(subquery.c))
+    if dialect_name == "postgresql":
+        return select(func.json_agg(aggregate_order_by(row, order_by) if order_by is not None else row))
+    # SQLite before 3.44 has no ORDER BY inside aggregates, and json_group_array
+    # does not promise to keep the subquery's order: callers sort the decoded rows
+    return select(func.json_group_array(row))
+
+def _json_to_df(raw, model):
+    # psycopg2 decodes json itself, SQLite hands back text
+    records = json.loads(raw) if isinstance(raw, str) else raw
+    if isinstance(records, dict):
+        records = [records]
+    columns = [c.name for c in model.__table__.columns]
+    df = pd.DataFrame(records or [], columns=columns)
+    for column in model.__table__.columns:
+        if isinstance(column.type, DateTime):
+            df[column.name] = pd.to_datetime(df[column.name], format="ISO8601")
+        elif isinstance(column.type, Date):
+            df[column.name] = [date.fromisoformat(v[:10]) if isinstance(v, str) else None for v in df[column.name]]
+        elif isinstance(column.type, Boolean):
+            df[column.name] = [None if v is None else bool(v) for v in df[column.name]]
+    return df
+
+def _exchanges_newest_first(raw):
+    # Decoded profile exchanges in page order, whatever order the array came back in
+    return _json_to_df(raw, Exchange).sort_values("id", ascending=False, ignore_index=True)
+
+def _exchanges_subquery(session, where, page_size, cursor, date_from, date_to):
+    query = _filter_date_range(session.query(Exchange).filter(where), Exchange.date, date_from, date_to)
+    return _keyset_page(query, [Exchange.id], page_size, cursor).subquery("recent_exchanges")
+
+@track_service
+def get_customer_profile(phone, page_size=None, cursor=None, date_from=None, date_to=None,
+                         include_archive=False, session=None):
+    """
+    Customer, owned batteries and a keyset page of their exchanges in a single
+    statement. Returns {"customer", "batteries", "exchanges"} DataFrames shaped
+    like get_customer_details_df, get_customer_batteries_df and
+    get_customer_exchanges_df. include_archive adds the archived exchanges
+    that belong on the page, read from their Parquet files.
+    """
+    with _session_scope(session) as session:
+        dialect_name = session.get_bind().dialect.name
+        customer = select(_json_object(dialect_name, list(Customer.__table__.c))).where(Customer.phone == phone)
+        owned = select(Battery).where(Battery.current_owner_phone == phone).subquery("owned")
+        exchanges = _exchanges_subquery(session, Exchange.customer_phone == phone, page_size, cursor, date_from, date_to)
+        row = session.execute(select(
+            customer.scalar_subquery().label("customer"),
+            _json_rows(dialect_name, owned).scalar_subquery().label("batteries"),
+            _json_rows(dialect_name, exchanges, exchanges.c.id.desc()).scalar_subquery().label("exchanges"),
+        )).one()
+        exchanges = _exchanges_newest_first(row.exchanges)
+        if include_archive:
+            exchanges = _with_archive(session, exchanges, _customer_archive_filter(phone), page_size, cursor, date_from, date_to)
+        return {
+            "customer": _json_to_df(row.customer, Customer),
+            "batteries": _json_to_df(row.batteries, Battery),
+            "exchanges": exchanges,
+        }
+
+@track_service
+def get_battery_profile(serial, page_size=None, cursor=None, date_from=None, date_to=None,
+                        include_archive=False, session=None):
+    """
+    Battery details and a keyset page of its exchanges in a single statement.
+    Returns {"battery", "exchanges"} DataFrames shaped like
+    get_battery_details_df and get_battery_exchanges_df. include_archive adds
+    the archived exchanges that belong on the page.
+    """
+    with _session_scope(session) as session:
+        dialect_name = session.get_bind().dialect.name
+        battery = select(_json_object(dialect_name, list(Battery.__table__.c))).where(Battery.serial_no == serial)
+        exchanges = _exchanges_subquery(
+            session, (Exchange.old_battery_serial == serial) | (Exchange.new_battery_serial == serial),
+            page_size, cursor, date_from, date_to
+        )
+        row = session.execute(select(
+            battery.scalar_subquery().label("battery"),
+            _json_rows(dialect_name, exchanges, exchanges.c.id.desc()).scalar_subquery().label("exchanges"),
+        )).one()
+        exchanges = _exchanges_newest_first(row.exchanges)
+        if include_archive:
+            exchanges = _with_archive(session, exchanges, _battery_archive_filter(serial), page_size, cursor, date_from, date_to)
+        return {
+            "battery": _json_to_df(row.battery, Battery),
+            "exchanges": exchanges,
+        }
+
+# --- SEARCH ---
+# Substring search over serials, vehicle numbers, phones and names. Postgres
+# serves ILIKE '%term%' from pg_trgm GIN indexes; SQLite uses the FTS5 trigram
+# index over search_terms (see migrations._m005_search_index). Trigrams need
+# at least three characters to match on.
+
+SEARCH_MIN_CHARS = 3
+SEARCH_LIMIT = 20
+# (kind, field, key column, searched column)
+SEARCH_FIELDS = [
+    ("battery", "serial_no", Battery.serial_no, Battery.serial_no),
+    ("battery", "vehicle_no", Battery.serial_no, Battery.vehicle_no),
+    ("customer", "phone", Customer.phone, Customer.phone),
+    ("customer", "name", Customer.phone, Customer.name),
+]
+_SEARCH_KINDS = {field: kind for kind, field, _, _ in SEARCH_FIELDS}
+
+def _has_search_fts(session):
+    return session.execute(text("SELECT 1 FROM sqlite_master WHERE name = 'search_fts'")).first() is not None
+
+@track_service
+def search_records(term, limit=SEARCH_LIMIT, session=None):
+    """
+    Type-ahead lookup. Returns up to `limit` matches as a DataFrame with kind
+    ("battery"/"customer"), key (serial or phone), field and the matched
+    value; prefix matches first. Terms shorter than SEARCH_MIN_CHARS return
+    no matches.
+    """
+    columns = ["kind", "key", "field", "value"]
+    term = (term or "").strip()
+    if len(term) < SEARCH_MIN_CHARS:
+        return pd.DataFrame(columns=columns)
+
+    escaped = term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+    with _session_scope(session) as session:
+        if session.get_bind().dialect.name == "sqlite" and _has_search_fts(session):
+            # Ranked before the LIMIT, so prefix matches are never cut off by
+            # substring matches (LIKE is case-insensitive in SQLite)
+            rows = session.execute(text(
+                "SELECT search_terms.field, search_terms.ref, search_terms.value FROM search_fts "
+                "JOIN search_terms ON search_terms.id = search_fts.rowid "
+                "WHERE search_fts MATCH :phrase "
+                "ORDER BY search_terms.value NOT LIKE :prefix ESCAPE '\\', length(search_terms.value), search_terms.value "
+                "LIMIT :limit"
+            ), {"phrase": '"' + term.replace('"', '""') + '"', "prefix": escaped + "%", "limit": limit}).all()
+        else:
+            # Also the fallback for SQLite builds without the FTS5 trigram tokenizer.
+            # Every branch keeps its best `limit` rows by the same ranking, so the
+            # overall best `limit` survive the union.
+            branches = []
+            for _, field, key, column in SEARCH_FIELDS:
+                rank = (case((column.ilike(escaped + "%", escape="\\"), 0), else_=1), func.length(column), column)
+                branches.append(
+                    select(literal(field).label("field"), key.label("ref"), column.label("value"),
+                           rank[0].label("prefix_rank"), rank[1].label("value_length"))
+                    .where(column.ilike("%" + escaped + "%", escape="\\"))
+                    .order_by(*rank)
+                    .limit(limit)
+                    .subquery()
+                )
+            ranked = union_all(*[select(b.c.field, b.c.ref, b.c.value, b.c.prefix_rank, b.c.value_length) for b in branches]).subquery()
+            rows = session.execute(
+                select(ranked.c.field, ranked.c.ref, ranked.c.value)
+                .order_by(ranked.c.prefix_rank, ranked.c.value_length, ranked.c.value)
+                .limit(limit)
+            ).all()
+
+    return pd.DataFrame([(_SEARCH_KINDS[field], ref, field, value) for field, ref, value in rows], columns=columns)
+
+@track_service
+def get_ready_for_pickup_items_df(phone, session=None):
+    with _session_scope(session) as session:
+        query = session.query(Battery.serial_no, Battery.model_type, Battery.status, Battery.ticket_id, Battery.vehicle_no, Battery.date_of_purchase, Battery.has_loaner, Battery.version)\
             .filter(Battery.current_owner_phone == phone)\
             .filter(Battery.status.in_(['ready_for_pickup', 'pending']))\
             .statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+        return pd.read_sql(query, session.connection())
 
-def get_pending_factory_stock_df():
-    session = get_session()
-    try:
+@track_service
+def get_pending_factory_stock_df(session=None):
+    with _session_scope(session) as session:
         query = session.query(Battery).filter_by(status='factory_pending').statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+        return pd.read_sql(query, session.connection())
 
-def get_stock_receipt_history_df():
-    session = get_session()
-    try:
-        query = session.query(Exchange.date.label("Received Date"), Exchange.old_battery_serial.label("Serial No"), Exchange.notes.label("Details"))\
-            .filter_by(action_taken='STOCK_RECEIVED')\
-            .order_by(Exchange.id.desc())\
-            .statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+@track_service
+def get_stock_receipt_history_df(page_size=None, cursor=None, date_from=None, date_to=None, session=None):
+    with _session_scope(session) as session:
+        query = session.query(Exchange.id, Exchange.date.label("Received Date"), Exchange.old_battery_serial.label("Serial No"), Exchange.notes.label("Details"))\
+            .filter_by(action_taken='STOCK_RECEIVED')
+        query = _filter_date_range(query, _undated_last(Exchange.date), date_from, date_to)
+        query = _keyset_page(query, [Exchange.id], page_size, cursor).statement
+        return pd.read_sql(query, session.connection())
 
-def get_scrap_batteries_df():
-    session = get_session()
-    try:
-        query = session.query(ScrapBattery).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+@track_service
+def get_scrap_batteries_df(page_size=None, cursor=None, date_from=None, date_to=None, session=None):
+    # cursor: (received_date, serial_no) of the last row on the previous page
+    with _session_scope(session) as session:
+        dated = _undated_last(ScrapBattery.received_date)
+        query = _filter_date_range(session.query(ScrapBattery), dated, date_from, date_to)
+        query = _keyset_page(query, [dated, ScrapBattery.serial_no], page_size, cursor).statement
+        return pd.read_sql(query, session.connection())
 
-def get_challan_batteries_df():
-    session = get_session()
-    try:
-        query = session.query(ChallanBattery).order_by(ChallanBattery.challan_date.desc()).statement
-        return pd.read_sql(query, session.bind)
-    finally:
-        session.close()
+@track_service
+def get_challan_batteries_df(page_size=None, cursor=None, date_from=None, date_to=None, session=None):
+    # cursor: (challan_date, serial_no) of the last row on the previous page
+    with _session_scope(session) as session:
+        dated = _undated_last(ChallanBattery.challan_date)
+        query = _filter_date_range(session.query(ChallanBattery), dated, date_from, date_to)
+        query = _keyset_page(query, [dated, ChallanBattery.serial_no], page_size, cursor).statement
+        return pd.read_sql(query, session.connection())
 
-def move_scrap_to_challan(serial_numbers):
-    session = get_session()
-    try:
-        items = session.query(ScrapBattery).filter(ScrapBattery.serial_no.in_(serial_numbers)).all()
-        if not items:
-            return False
-        
-        for item in items:
-            challan_item = ChallanBattery(
-                serial_no=item.serial_no,
-                model_type=item.model_type,
-                received_date=item.received_date,
-                customer_phone=item.customer_phone,
-                ticket_id=item.ticket_id,
-                notes=item.notes,
-                challan_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
-            session.add(challan_item)
-            session.delete(item)
-        
-        session.commit()
-        return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+# Columns carried over unchanged when a scrap battery moves along scrap -> challan -> audit
+_SCRAP_TRANSFER_COLUMNS = ["serial_no", "model_type", "received_date", "customer_phone", "ticket_id", "notes"]
 
-def clear_challan_to_archive():
-    session = get_session()
-    try:
-        items = session.query(ChallanBattery).all()
-        if not items:
-            return False
-            
-        for item in items:
-            archived = ArchivedScrapBattery(
-                serial_no=item.serial_no,
-                model_type=item.model_type,
-                received_date=item.received_date,
-                customer_phone=item.customer_phone,
-                ticket_id=item.ticket_id,
-                notes=item.notes,
-                challan_date=item.challan_date,
-                final_archived_date=datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            )
-            session.add(archived)
-            session.delete(item)
-            
-        session.commit()
-        return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+def _transfer_rows(session, source, target, copied_columns, stamp_column, stamp, where=None):
+    """
+    Moves rows from one table to another with set-based SQL and returns how many
+    moved. Postgres does it in one statement (DELETE ... RETURNING feeding the
+    INSERT); SQLite uses INSERT ... SELECT followed by a DELETE of the same rows.
+    """
+    target_columns = copied_columns + [stamp_column]
+    if session.get_bind().dialect.name == "postgresql":
+        delete_stmt = source.delete()
+        if where is not None:
+            delete_stmt = delete_stmt.where(where)
+        moved = delete_stmt.returning(*[source.c[c] for c in copied_columns]).cte("moved")
+        insert_stmt = target.insert().from_select(
+            target_columns, select(*[moved.c[c] for c in copied_columns], literal(stamp))
+        )
+        return session.execute(insert_stmt).rowcount
+
+    rows = select(*[source.c[c] for c in copied_columns], literal(stamp))
+    delete_stmt = source.delete()
+    if where is not None:
+        rows = rows.where(where)
+        delete_stmt = delete_stmt.where(where)
+    moved = session.execute(target.insert().from_select(target_columns, rows)).rowcount
+    # The INSERT took SQLite's write lock, so nothing can be added to the source
+    # table between the two statements.
+    session.execute(delete_stmt)
+    return moved
+
+@track_service
+def move_scrap_to_challan(serial_numbers, session=None):
+    if not serial_numbers:
+        return 0
+    scrap = ScrapBattery.__table__
+    with _session_scope(session) as session:
+        return _transfer_rows(
+            session, scrap, ChallanBattery.__table__, _SCRAP_TRANSFER_COLUMNS,
+            "challan_date", now(),
+            where=scrap.c.serial_no.in_(list(serial_numbers))
+        )
+
+@track_service
+def clear_challan_to_archive(session=None):
+    with _session_scope(session) as session:
+        return _transfer_rows(
+            session, ChallanBattery.__table__, ArchivedScrapBattery.__table__,
+            _SCRAP_TRANSFER_COLUMNS + ["challan_date"],
+            "final_archived_date", now()
+        )
 
 # --- WRITE OPERATIONS ---
 
-def update_battery_status(serial, status):
-    session = get_session()
-    try:
-        battery = session.query(Battery).filter_by(serial_no=serial).first()
-        if battery:
-            battery.status = status
-            session.commit()
-            return True
-        return False
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+# Customers and batteries are saved with INSERT ... ON CONFLICT DO UPDATE, one
+# statement per batch of rows: no SELECT first, and two counters saving the same
+# phone or serial at once cannot both take the INSERT branch and collide on the
+# primary key - the second one updates the row the first one wrote.
 
-def process_new_battery_exchange(customer_phone, customer_name, old_serial, new_serial, new_model, ticket_id, vehicle_no, purchase_date, notes):
-    session = get_session()
-    try:
-        # 1. Upsert Customer
-        customer = session.query(Customer).filter_by(phone=customer_phone).first()
-        if customer:
-            customer.name = customer_name
+def _insert_for(session):
+    return pg_insert if session.get_bind().dialect.name == "postgresql" else sqlite_insert
+
+def _upsert(session, table, rows, update, update_if_given=(), computed=None, where=None):
+    # `update` columns take the new value, `update_if_given` ones only when it is
+    # not NULL; `computed` maps more columns to SQL expressions. Existing rows
+    # that fail `where` are left alone; their keys are returned.
+    stmt = _insert_for(session)(table)
+    set_ = {column: stmt.excluded[column] for column in update}
+    set_.update({column: func.coalesce(stmt.excluded[column], table.c[column]) for column in update_if_given})
+    set_.update(computed or {})
+    stmt = stmt.on_conflict_do_update(index_elements=list(table.primary_key.columns), set_=set_, where=where)
+    if where is None:
+        session.execute(stmt, rows)
+        return []
+    key = table.primary_key.columns[0]
+    written = set(session.execute(stmt.returning(key), rows).scalars())
+    return [row[key.name] for row in rows if row[key.name] not in written]
+
+def _upsert_customers(session, customers):
+    """Adds customers (dicts with phone and name) or renames existing ones; created_at is kept."""
+    _upsert(session, Customer.__table__, [{**c, "created_at": date.today()} for c in customers], update=["name"])
+
+def _upsert_scrap(session, rows):
+    table = ScrapBattery.__table__
+    _upsert(session, table, rows, update=[c.name for c in table.c if not c.primary_key])
+
+def _upsert_batteries(session, rows, update, update_if_given=(), to_status=None, resave=False):
+    """
+    Inserts batteries or updates the `update` columns of existing ones. An
+    existing battery keeps its model, so when the purchase date is written its
+    warranty expiry is recomputed in SQL from the stored model. With
+    `to_status`, an existing battery is only updated if ALLOWED_TRANSITIONS
+    lets it move to that status (or, with `resave`, it already has it);
+    otherwise StatusConflictError is raised.
+    """
+    table = Battery.__table__
+    computed = {"version": table.c.version + 1}
+    if "date_of_purchase" in update:
+        purchase_date = "excluded.date_of_purchase"
+    elif "date_of_purchase" in update_if_given:
+        purchase_date = "coalesce(excluded.date_of_purchase, batteries.date_of_purchase)"
+    else:
+        purchase_date = None
+    if purchase_date:
+        computed["warranty_expiry"] = _warranty_expiry_sql(session.get_bind().dialect.name, table.c.model_type, purchase_date)
+    where = None
+    if to_status:
+        where = _may_move_to(table.c.status, to_status, also=[to_status] if resave else [])
+    refused = _upsert(session, table, rows, update, update_if_given, computed, where)
+    if refused:
+        raise _conflict(session, refused[0], to_status)
+
+def _warranty_expiry_sql(dialect_name, model, purchase_date):
+    # warranty_expiry_for as an SQL expression; purchase_date is SQL text
+    return case(
+        *[
+            (model == name, literal_column(warranty_expiry_expr(dialect_name, int(terms["warranty_months"]), purchase_date)))
+            for name, terms in BATTERY_CATALOG.items()
+        ],
+        else_=null()
+    )
+
+# --- STATUS TRANSITIONS ---
+# Battery status -> the statuses it may move to. Counters change a status with
+# a compare-and-swap: a single UPDATE that only matches while the battery is in
+# an allowed source status (and, when the caller passes the version it showed,
+# still at that version), and bumps batteries.version. A change that is not
+# allowed matches nothing and raises StatusConflictError. One that races
+# another counter does wait for it: on Postgres for the other transaction's row
+# lock, after which the UPDATE is re-checked against the committed row, on
+# SQLite for the database write lock. It then matches nothing and raises, rather
+# than overwriting; the wait lasts as long as the other unit of work. A status
+# not listed here may move to any status (see _may_move_to).
+ALLOWED_TRANSITIONS = {
+    'factory_pending': {'in_stock'},
+    'in_stock': {'sold'},
+    'sold': {'pending', 'returned_faulty/WNA'},
+    'active_with_customer': {'pending', 'returned_faulty/WNA'},
+    'pending': {'ready_for_pickup', 'returned_faulty', 'returned_faulty/WNA', 'active_with_customer'},
+    'ready_for_pickup': {'pending', 'returned_faulty', 'returned_faulty/WNA', 'active_with_customer'},
+    'returned_faulty': {'returned_faulty/WNA'},
+    'returned_faulty/WNA': set(),
+}
+
+class StatusConflictError(Exception):
+    """A status change that is not allowed from the battery's current status, or lost a race."""
+
+    def __init__(self, serial, to_status, current_status, changed_meanwhile=False):
+        self.serial = serial
+        self.to_status = to_status
+        self.current_status = current_status
+        if changed_meanwhile:
+            message = f"Battery {serial} was changed at another counter and is now {current_status}. Check it and try again."
+        elif current_status == to_status:
+            message = f"Battery {serial} is already {to_status}."
         else:
-            customer = Customer(phone=customer_phone, name=customer_name, created_at=datetime.now().strftime("%Y-%m-%d"))
-            session.add(customer)
+            message = f"Battery {serial} cannot go from {current_status} to {to_status}."
+        super().__init__(message)
+
+def _sources_of(to_status):
+    return [status for status, targets in ALLOWED_TRANSITIONS.items() if to_status in targets]
+
+def _may_move_to(status, to_status, also=()):
+    # SQL condition on the `status` column. A status missing from
+    # ALLOWED_TRANSITIONS (NULL, or one set by hand) may move anywhere, so such a
+    # battery is never stuck; migration 10 mapped the legacy ones.
+    return or_(
+        status.in_(_sources_of(to_status) + list(also)),
+        status.is_(None),
+        status.notin_(list(ALLOWED_TRANSITIONS)),
+    )
+
+def _conflict(session, serial, to_status, expected_version=None):
+    # Why a compare-and-swap matched nothing; None if the battery does not exist
+    current = session.execute(select(Battery.status, Battery.version).where(Battery.serial_no == serial)).first()
+    if current is None:
+        return None
+    changed = expected_version is not None and current.version != expected_version
+    return StatusConflictError(serial, to_status, current.status, changed_meanwhile=changed)
+
+def _transition(session, serial, to_status, expected_version=None, **values):
+    """
+    Compare-and-swap of one battery's status (plus any `values`). Returns the
+    updated row (model_type, ticket_id, current_owner_phone, version), None if
+    there is no such battery, or raises StatusConflictError.
+    """
+    table = Battery.__table__
+    conditions = [table.c.serial_no == serial, _may_move_to(table.c.status, to_status)]
+    if expected_version is not None:
+        conditions.append(table.c.version == expected_version)
+    row = session.execute(
+        update(table).where(*conditions)
+        .values(status=to_status, version=table.c.version + 1, **values)
+        .returning(table.c.model_type, table.c.ticket_id, table.c.current_owner_phone, table.c.version)
+    ).first()
+    if row is None:
+        conflict = _conflict(session, serial, to_status, expected_version)
+        if conflict:
+            raise conflict
+    return row
+
+# Exchanges logged by update_battery_status. They keep the ledger complete but
+# are not services: the dashboard total, the report rollups and receipts leave
+# them out. The status they set is in exchanges.status, which ledger.py replays;
+# the notes only describe it.
+STATUS_UPDATE_ACTION = 'STATUS_UPDATED'
+STATUS_UPDATE_PREFIX = "Status changed to "
+
+def _service_exchange(action_taken):
+    return or_(action_taken.is_(None), action_taken != STATUS_UPDATE_ACTION)
+
+@track_service
+def update_battery_status(serial, status, expected_version=None, session=None):
+    """
+    Moves a battery to `status` if ALLOWED_TRANSITIONS permits it and, given
+    `expected_version`, nobody changed it since. Returns False for an unknown
+    serial; raises StatusConflictError otherwise.
+    """
+    with _session_scope(session) as session:
+        battery = _transition(session, serial, status, expected_version)
+        if battery is None:
+            return False
+        # Logged so the exchanges ledger holds every status change
+        session.add(Exchange(
+            date=now(),
+            old_battery_serial=serial,
+            new_battery_serial=None,
+            customer_phone=battery.current_owner_phone,
+            action_taken=STATUS_UPDATE_ACTION,
+            ticket_id=battery.ticket_id or None,
+            notes=f"{STATUS_UPDATE_PREFIX}{status}",
+            status=status,
+        ))
+        return True
+
+@track_service
+def process_new_battery_exchange(customer_phone, customer_name, old_serial, new_serial, new_model, ticket_id, vehicle_no, purchase_date, notes, session=None):
+    with _session_scope(session) as session:
+        # 1. Upsert Customer
+        _upsert_customers(session, [{"phone": customer_phone, "name": customer_name}])
         
         # 2. Update Old Battery
-        old_battery = session.query(Battery).filter_by(serial_no=old_serial).first()
+        old_battery = _transition(session, old_serial, 'returned_faulty/WNA', has_loaner=False) # Reset loaner flag if any
         if old_battery:
-            old_battery.status = 'returned_faulty/WNA'
-            old_battery.has_loaner = False # Reset loaner flag if any
-            
-            # Add to Scrap Table
-            scrap = ScrapBattery(
-                serial_no=old_serial,
-                model_type=old_battery.model_type,
-                received_date=datetime.now().strftime("%Y-%m-%d"),
-                customer_phone=customer_phone,
-                ticket_id=ticket_id,
-                notes=f"Replaced with {new_serial}"
-            )
-            session.merge(scrap) # Use merge to handle potential duplicates gracefully
+            # Add to Scrap Table, replacing an earlier entry for the same serial
+            _upsert_scrap(session, [{
+                "serial_no": old_serial,
+                "model_type": old_battery.model_type,
+                "received_date": date.today(),
+                "customer_phone": customer_phone,
+                "ticket_id": ticket_id,
+                "notes": f"Replaced with {new_serial}",
+            }])
         
         # 3. Upsert New Battery
-        p_date_str = purchase_date.strftime("%Y-%m-%d")
-        new_battery = session.query(Battery).filter_by(serial_no=new_serial).first()
-        if new_battery:
-            new_battery.status = 'sold'
-            new_battery.ticket_id = ticket_id
-            new_battery.current_owner_phone = customer_phone
-            new_battery.vehicle_no = vehicle_no
-            new_battery.date_of_purchase = p_date_str
-        else:
-            new_battery = Battery(
-                serial_no=new_serial,
-                model_type=new_model,
-                status='sold',
-                sold_date=datetime.now().strftime("%Y-%m-%d"),
-                date_of_purchase=p_date_str,
-                current_owner_phone=customer_phone,
-                ticket_id=ticket_id,
-                vehicle_no=vehicle_no
-            )
-            session.add(new_battery)
+        _upsert_batteries(session, [{
+            "serial_no": new_serial,
+            "model_type": new_model,
+            "status": 'sold',
+            "sold_date": date.today(),
+            "date_of_purchase": purchase_date,
+            "warranty_expiry": warranty_expiry_for(new_model, purchase_date),
+            "current_owner_phone": customer_phone,
+            "ticket_id": ticket_id,
+            "vehicle_no": vehicle_no,
+        }], update=["status", "ticket_id", "current_owner_phone", "vehicle_no", "date_of_purchase"], to_status='sold')
             
         # 4. Create Exchange Record
         exchange = Exchange(
-            date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            date=now(),
             old_battery_serial=old_serial,
             new_battery_serial=new_serial,
             customer_phone=customer_phone,
             action_taken='NEW_REPLACEMENT_ISSUED',
+            ticket_id=ticket_id or None,
             notes=f"Ticket: {ticket_id}. {notes}"
         )
         session.add(exchange)
         
-        session.commit()
         return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
-def process_service_entry(customer_phone, customer_name, battery_serial, ticket_id, vehicle_no, purchase_date, notes, has_loaner=False):
-    session = get_session()
-    try:
+@track_service
+def process_service_entry(customer_phone, customer_name, battery_serial, ticket_id, vehicle_no, purchase_date, notes, has_loaner=False, session=None):
+    with _session_scope(session) as session:
         # 1. Upsert Customer
-        customer = session.query(Customer).filter_by(phone=customer_phone).first()
-        if customer:
-            customer.name = customer_name
-        else:
-            customer = Customer(phone=customer_phone, name=customer_name, created_at=datetime.now().strftime("%Y-%m-%d"))
-            session.add(customer)
+        _upsert_customers(session, [{"phone": customer_phone, "name": customer_name}])
 
         # 2. Upsert Battery (Pending)
-        p_date_str = purchase_date.strftime("%Y-%m-%d")
-        battery = session.query(Battery).filter_by(serial_no=battery_serial).first()
-        if battery:
-            battery.status = 'pending'
-            battery.current_owner_phone = customer_phone
-            battery.ticket_id = ticket_id
-            battery.vehicle_no = vehicle_no
-            battery.date_of_purchase = p_date_str
-            battery.has_loaner = has_loaner
-        else:
-             battery = Battery(
-                serial_no=battery_serial,
-                status='pending',
-                current_owner_phone=customer_phone,
-                ticket_id=ticket_id,
-                vehicle_no=vehicle_no,
-                date_of_purchase=p_date_str,
-                has_loaner=has_loaner
-            )
-             session.add(battery)
+        _upsert_batteries(session, [{
+            "serial_no": battery_serial,
+            "status": 'pending',
+            "current_owner_phone": customer_phone,
+            "ticket_id": ticket_id,
+            "vehicle_no": vehicle_no,
+            "date_of_purchase": purchase_date,
+            "has_loaner": has_loaner,
+        }], update=["status", "current_owner_phone", "ticket_id", "vehicle_no", "date_of_purchase", "has_loaner"], to_status='pending')
 
         # 3. Exchange Record
         loaner_note = " | Loaner Issued" if has_loaner else ""
         exchange = Exchange(
-            date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            date=now(),
             old_battery_serial=battery_serial,
             new_battery_serial=battery_serial,
             customer_phone=customer_phone,
             action_taken='SERVICE_PENDING',
+            ticket_id=ticket_id or None,
             notes=f"Ticket: {ticket_id}. {notes}{loaner_note}"
         )
         session.add(exchange)
         
-        session.commit()
         return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
-def process_return_to_customer(serial, phone, return_loaner=False):
-    session = get_session()
-    try:
-        battery = session.query(Battery).filter_by(serial_no=serial).first()
+@track_service
+def process_return_to_customer(serial, phone, return_loaner=False, expected_version=None, session=None):
+    """
+    Hands a serviced battery back. Raises StatusConflictError if it is not in
+    service any more, e.g. a second click on the same pickup.
+    """
+    with _session_scope(session) as session:
+        battery = _transition(session, serial, 'active_with_customer', expected_version, has_loaner=False) # Reset flag
         ticket_info = ""
-        if battery:
-            battery.status = 'active_with_customer'
-            battery.has_loaner = False # Reset flag
-            if battery.ticket_id:
-                ticket_info = f"Ticket: {battery.ticket_id}. "
+        ticket_id = battery.ticket_id if battery else None
+        if ticket_id:
+            ticket_info = f"Ticket: {ticket_id}. "
         
         loaner_note = " | Loaner Returned" if return_loaner else ""
         
         exchange = Exchange(
-            date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            date=now(),
             old_battery_serial=serial,
             new_battery_serial=None,
             customer_phone=phone,
             action_taken="RETURNED_TO_CUSTOMER",
+            ticket_id=ticket_id or None,
             notes=f"{ticket_info}Service completed, battery returned.{loaner_note}"
         )
         session.add(exchange)
-        session.commit()
         return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
-def process_stock_reception(serial, model):
-    session = get_session()
-    try:
-        battery = session.query(Battery).filter_by(serial_no=serial).first()
-        if battery:
-            battery.status = 'in_stock'
+@track_service
+def process_stock_reception(serial, model, session=None):
+    with _session_scope(session) as session:
+        battery = _transition(session, serial, 'in_stock')
         
         exchange = Exchange(
-            date=datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            date=now(),
             old_battery_serial=serial,
             new_battery_serial=None,
             customer_phone='EXIDE_FACTORY',
             action_taken='STOCK_RECEIVED',
+            ticket_id=battery.ticket_id if battery else None,
             notes=f"Received stock: {model}"
         )
         session.add(exchange)
-        session.commit()
         return True
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
 
-def upsert_battery(serial, model, status, sold_date, p_date, phone, ticket, vehicle):
-    session = get_session()
-    try:
-        battery = session.query(Battery).filter_by(serial_no=serial).first()
-        if battery:
-            battery.status = status
-            battery.ticket_id = ticket
-            battery.current_owner_phone = phone
-            battery.vehicle_no = vehicle
-            if p_date:
-                battery.date_of_purchase = p_date
-        else:
-            battery = Battery(
-                serial_no=serial,
-                model_type=model,
-                status=status,
-                sold_date=sold_date,
-                date_of_purchase=p_date,
-                current_owner_phone=phone,
-                ticket_id=ticket,
-                vehicle_no=vehicle
-            )
-            session.add(battery)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
-    finally:
-        session.close()
+@track_service
+def process_stock_receptions(serials, session=None):
+    """
+    Receives a batch of factory stock in one transaction: a single
+    compare-and-swap UPDATE for the statuses and a single executemany INSERT
+    for the STOCK_RECEIVED exchanges. Serials that are unknown or not
+    factory_pending (e.g. received meanwhile at another counter) are skipped.
+    Returns the serials that were received.
+    """
+    serials = list(dict.fromkeys(s.strip() for s in serials if s and s.strip()))
+    if not serials:
+        return []
+    with _session_scope(session) as session:
+        batteries = Battery.__table__
+        pending = session.execute(
+            update(batteries)
+            .where(batteries.c.serial_no.in_(serials), _may_move_to(batteries.c.status, 'in_stock'))
+            .values(status='in_stock', version=batteries.c.version + 1)
+            .returning(batteries.c.serial_no, batteries.c.model_type, batteries.c.ticket_id)
+        ).all()
+        if not pending:
+            return []
 
-def add_inventory_stock(serial, model, p_date):
-    session = get_session()
-    try:
+        received = [row.serial_no for row in pending]
+        received_at = now()
+        session.execute(Exchange.__table__.insert(), [
+            {
+                "date": received_at,
+                "old_battery_serial": row.serial_no,
+                "new_battery_serial": None,
+                "customer_phone": 'EXIDE_FACTORY',
+                "action_taken": 'STOCK_RECEIVED',
+                "ticket_id": row.ticket_id or None,
+                "notes": f"Received stock: {row.model_type}",
+            }
+            for row in pending
+        ])
+        return received
+
+@track_service
+def upsert_battery(serial, model, status, sold_date, p_date, phone, ticket, vehicle, session=None):
+    with _session_scope(session) as session:
+        # An existing battery keeps its model and sold date, and its purchase date
+        # unless one is given. Its status only changes along ALLOWED_TRANSITIONS;
+        # saving it again in the status it has edits its details.
+        _upsert_batteries(session, [{
+            "serial_no": serial,
+            "model_type": model,
+            "status": status,
+            "sold_date": sold_date,
+            "date_of_purchase": p_date or None,
+            "warranty_expiry": warranty_expiry_for(model, p_date or None),
+            "current_owner_phone": phone,
+            "ticket_id": ticket,
+            "vehicle_no": vehicle,
+        }], update=["status", "ticket_id", "current_owner_phone", "vehicle_no"], update_if_given=["date_of_purchase"],
+            to_status=status, resave=True)
+
+@track_service
+def add_inventory_stock(serial, model, p_date, session=None):
+    with _session_scope(session) as session:
         battery = Battery(
             serial_no=serial,
             model_type=model,
             status='in_stock',
-            date_of_purchase=p_date.strftime("%Y-%m-%d")
+            date_of_purchase=p_date
         )
+        _apply_warranty_terms(battery)
         session.add(battery)
-        session.commit()
-    except Exception as e:
-        session.rollback()
-        raise e
+
+# --- BULK IMPORT ---
+
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_REQUIRED_COLUMNS = ["serial_no", "model_type"]
+IMPORT_COLUMNS = IMPORT_REQUIRED_COLUMNS + ["date_of_purchase"]
+_IMPORT_COLUMN_ALIASES = {
+    "serial": "serial_no", "serial_number": "serial_no",
+    "model": "model_type", "battery_model": "model_type",
+    "purchase_date": "date_of_purchase", "date": "date_of_purchase",
+}
+# Keeps IN (...) lists well under SQLite's bound-parameter limit
+_LOOKUP_BATCH_SIZE = 500
+
+def _normalise_import_header(name):
+    key = str(name).strip().lower().replace(" ", "_")
+    return _IMPORT_COLUMN_ALIASES.get(key, key)
+
+def _excel_cell_to_text(value):
+    if value is None:
+        return ""
+    if isinstance(value, datetime):
+        return value.strftime("%Y-%m-%d")
+    if isinstance(value, date):
+        return value.isoformat()
+    if isinstance(value, float) and value.is_integer():
+        # Numeric serials come back from Excel as floats
+        return str(int(value))
+    return str(value)
+
+def _iter_import_chunks(file_obj, filename, chunk_size):
+    if filename.lower().endswith((".xlsx", ".xlsm")):
+        from openpyxl import load_workbook
+        workbook = load_workbook(file_obj, read_only=True, data_only=True)
+        try:
+            rows = workbook.active.iter_rows(values_only=True)
+            header = [_normalise_import_header(h) for h in next(rows, ())]
+            chunk = []
+            for row in rows:
+                chunk.append([_excel_cell_to_text(v) for v in row])
+                if len(chunk) >= chunk_size:
+                    yield pd.DataFrame(chunk, columns=header)
+                    chunk = []
+            if chunk:
+                yield pd.DataFrame(chunk, columns=header)
+        finally:
+            workbook.close()
+    else:
+        reader = pd.read_csv(file_obj, dtype=str, keep_default_na=False, chunksize=chunk_size)
+        for chunk in reader:
+            chunk.columns = [_normalise_import_header(c) for c in chunk.columns]
+            yield chunk
+
+def _existing_serials(session, serials):
+    existing = set()
+    for start in range(0, len(serials), _LOOKUP_BATCH_SIZE):
+        batch = serials[start:start + _LOOKUP_BATCH_SIZE]
+        existing.update(session.execute(select(Battery.serial_no).where(Battery.serial_no.in_(batch))).scalars())
+    return existing
+
+def _validate_import_chunk(df, session):
+    missing = [c for c in IMPORT_REQUIRED_COLUMNS if c not in df.columns]
+    if missing:
+        raise ValueError(f"Import file is missing column(s): {', '.join(missing)}")
+    df = df.reindex(columns=IMPORT_COLUMNS, fill_value="")
+
+    serial = df["serial_no"].fillna("").astype(str).str.strip()
+    model = df["model_type"].fillna("").astype(str).str.strip()
+    raw_date = df["date_of_purchase"].fillna("").astype(str).str.strip()
+    parsed_date = pd.to_datetime(raw_date.where(raw_date != ""), format="%Y-%m-%d", errors="coerce")
+
+    # First failing check wins, in this order
+    reason = pd.Series(np.select(
+        [
+            serial == "",
+            ~model.isin(BATTERY_MODELS),
+            (raw_date != "") & parsed_date.isna(),
+            serial.duplicated() & (serial != ""),
+        ],
+        [
+            "Missing serial number",
+            "Unknown battery model",
+            "Invalid purchase date (expected YYYY-MM-DD)",
+            "Duplicate serial in file",
+        ],
+        default="",
+    ), index=df.index)
+
+    candidates = serial[reason == ""]
+    existing = _existing_serials(session, candidates.tolist())
+    if existing:
+        reason[serial.isin(existing) & (reason == "")] = "Serial already exists"
+
+    valid = reason == ""
+    purchase_date = parsed_date.fillna(pd.Timestamp(date.today())).dt.date
+    rows = pd.DataFrame({
+        "serial_no": serial[valid],
+        "model_type": model[valid],
+        "status": "in_stock",
+        "date_of_purchase": purchase_date[valid],
+        "warranty_expiry": _warranty_expiries(model[valid], purchase_date[valid]),
+        "has_loaner": False,
+    })
+    rejects = pd.DataFrame({"serial_no": serial[~valid], "reason": reason[~valid]})
+    return rows, rejects
+
+def _copy_batteries(session, rows):
+    # COPY into a per-connection staging table, then move the rows across with
+    # ON CONFLICT so a serial inserted concurrently is reported instead of
+    # failing the whole chunk.
+    columns = ["serial_no", "model_type", "status", "date_of_purchase", "warranty_expiry", "has_loaner"]
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    for row in rows:
+        writer.writerow([row[c] for c in columns])
+    buffer.seek(0)
+
+    cursor = session.connection().connection.dbapi_connection.cursor()
+    try:
+        cursor.execute(
+            "CREATE TEMP TABLE IF NOT EXISTS battery_import_stage "
+            "(LIKE batteries INCLUDING DEFAULTS) ON COMMIT DELETE ROWS"
+        )
+        copy_sql = f"COPY battery_import_stage ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)"
+        if hasattr(cursor, "copy_expert"):
+            cursor.copy_expert(copy_sql, buffer)
+        else:
+            # psycopg 3
+            with cursor.copy(copy_sql) as copy:
+                copy.write(buffer.getvalue())
+        cursor.execute(
+            f"INSERT INTO batteries ({', '.join(columns)}) "
+            f"SELECT {', '.join(columns)} FROM battery_import_stage "
+            "ON CONFLICT (serial_no) DO NOTHING RETURNING serial_no"
+        )
+        inserted = {r[0] for r in cursor.fetchall()}
     finally:
-        session.close()
+        cursor.close()
+    # Raw DBAPI writes bypass the ORM events that invalidate cached reads
+    session.info["wrote"] = True
+    return inserted
+
+def _insert_batteries_bulk(session, rows):
+    """
+    Inserts validated rows. Returns (inserted count, rejects) where the rejects
+    are serials that appeared between validation and insert, e.g. another
+    counter adding the same battery at the same moment.
+    """
+    records = rows.to_dict("records")
+    if session.get_bind().dialect.name == "postgresql":
+        inserted = _copy_batteries(session, records)
+    else:
+        # With RETURNING, SQLAlchemy batches the rows into multi-row INSERTs
+        # (insertmanyvalues); rows skipped by the conflict clause return nothing
+        stmt = (
+            sqlite_insert(Battery.__table__)
+            .on_conflict_do_nothing(index_elements=["serial_no"])
+            .returning(Battery.__table__.c.serial_no)
+        )
+        inserted = session.scalars(stmt, records).all()
+    lost = rows[~rows["serial_no"].isin(inserted)]
+    return len(inserted), pd.DataFrame({"serial_no": lost["serial_no"], "reason": "Serial already exists"})
+
+@track_service
+def bulk_import_inventory(file_obj, filename, chunk_size=IMPORT_CHUNK_SIZE, on_progress=None):
+    """
+    Streams a CSV or Excel file of serial_no, model_type and an optional
+    date_of_purchase (YYYY-MM-DD) into stock, one chunk per transaction.
+    Bad rows are collected and reported; they never abort the rest of the import.
+    Returns {"rows": total rows read, "inserted": count, "rejects": DataFrame}.
+    """
+    total_rows = 0
+    inserted = 0
+    rejects = []
+    for chunk in _iter_import_chunks(file_obj, filename, chunk_size):
+        # Row numbers as seen in a spreadsheet: the header is row 1
+        chunk.index = range(total_rows + 2, total_rows + 2 + len(chunk))
+        total_rows += len(chunk)
+        with unit_of_work() as session:
+            rows, chunk_rejects = _validate_import_chunk(chunk, session)
+            if not rows.empty:
+                chunk_inserted, lost = _insert_batteries_bulk(session, rows)
+                inserted += chunk_inserted
+                if not lost.empty:
+                    chunk_rejects = pd.concat([chunk_rejects, lost])
+        rejects.append(chunk_rejects.rename_axis("row").reset_index())
+        if on_progress:
+            on_progress(total_rows, inserted)
+
+    rejects_df = pd.concat(rejects, ignore_index=True) if rejects else pd.DataFrame(columns=["row", "serial_no", "reason"])
+    return {"rows": total_rows, "inserted": inserted, "rejects": rejects_df}
+
+@track_service
+def backfill_warranty_expiry(overwrite=False, session=None):
+    """
+    Fills warranty_expiry from the catalog terms for batteries that lack it
+    (all of them with `overwrite`, after a term changed). Returns the rows updated.
+    """
+    with _session_scope(session) as session:
+        updated = fill_warranty_expiry(session.connection(), overwrite)
+        session.info["wrote"] = True
+        return updated
+
+# --- REPORTING ROLLUPS ---
+# exchange_daily_rollup counts exchanges per day, action and battery model (the
+# replacement battery's model, else the one the exchange was about).
+# refresh_rollups() only counts exchanges above the checkpoint's high-water mark
+# on exchanges.id, so staying current costs as much as the new rows, and reports
+# read a few rows per day instead of the ledger. Exchanges are append-only;
+# rebuild_rollups() recounts everything, e.g. after editing the ledger by hand
+# or if a long-running write committed ids below the mark after a refresh.
+
+ROLLUP_NAME = "exchange_daily"
+ROLLUP_BATCH_SIZE = 100000
+
+def _rollup_upsert(dialect_name):
+    table = ExchangeDailyRollup.__table__
+    stmt = (pg_insert if dialect_name == "postgresql" else sqlite_insert)(table)
+    return stmt.on_conflict_do_update(
+        index_elements=[table.c.day, table.c.action_taken, table.c.model_type],
+        set_={"count": table.c.count + stmt.excluded["count"]},
+    )
+
+def _count_exchanges(session, after_id, up_to_id):
+    new_battery, old_battery = aliased(Battery), aliased(Battery)
+    day = func.date(Exchange.date)
+    action = func.coalesce(Exchange.action_taken, "UNKNOWN")
+    model = func.coalesce(new_battery.model_type, old_battery.model_type, "Unknown")
+    rows = session.execute(
+        select(day, action, model, func.count())
+        .select_from(Exchange)
+        .outerjoin(new_battery, new_battery.serial_no == Exchange.new_battery_serial)
+        .outerjoin(old_battery, old_battery.serial_no == Exchange.old_battery_serial)
+        .where(Exchange.id > after_id, Exchange.id <= up_to_id, Exchange.date.isnot(None),
+               _service_exchange(Exchange.action_taken))
+        .group_by(day, action, model)
+    ).all()
+    # SQLite's date() returns text
+    return [
+        {"day": date.fromisoformat(d) if isinstance(d, str) else d, "action_taken": a, "model_type": m, "count": n}
+        for d, a, m, n in rows
+    ]
+
+@track_service
+def refresh_rollups(batch_size=ROLLUP_BATCH_SIZE, session=None):
+    """
+    Adds the exchanges written since the last refresh to the rollups, up to
+    batch_size exchange ids per transaction. Returns the number of exchanges
+    counted.
+    """
+    counted = 0
+    while True:
+        with _session_scope(session) as s:
+            # Read-only until there is something to count: any write would
+            # invalidate the dashboard cache
+            mark_query = select(RollupCheckpoint.last_exchange_id).where(RollupCheckpoint.name == ROLLUP_NAME)
+            mark = s.scalar(mark_query)
+            top = s.scalar(select(func.max(Exchange.id)))
+            if top is None or top <= (mark or 0):
+                return counted
+            if mark is None:
+                s.execute(
+                    _insert_for(s)(RollupCheckpoint.__table__)
+                    .values(name=ROLLUP_NAME, last_exchange_id=0)
+                    .on_conflict_do_nothing(index_elements=["name"])
+                )
+                mark = s.scalar(mark_query)
+            up_to = min(top, mark + batch_size)
+            # Move the mark first: a concurrent refresh waits on this row, then
+            # matches nothing and stops instead of counting the batch twice.
+            claimed = s.execute(
+                update(RollupCheckpoint)
+                .where(RollupCheckpoint.name == ROLLUP_NAME, RollupCheckpoint.last_exchange_id == mark)
+                .values(last_exchange_id=up_to, updated_at=now())
+            ).rowcount
+            if not claimed:
+                return counted
+            rows = _count_exchanges(s, mark, up_to)
+            if rows:
+                s.execute(_rollup_upsert(s.get_bind().dialect.name), rows)
+            counted += sum(row["count"] for row in rows)
+
+@track_service
+def rebuild_rollups(batch_size=ROLLUP_BATCH_SIZE):
+    """
+    Drops the rollups and counts the exchanges table again; days of archived
+    years are kept, as their exchanges are no longer there to count. Returns
+    the number of exchanges counted.
+    """
+    with _session_scope() as session:
+        archived_years = session.scalars(select(ExchangeArchive.year)).all()
+        session.execute(ExchangeDailyRollup.__table__.delete().where(
+            func.extract("year", ExchangeDailyRollup.day).notin_(archived_years)
+        ))
+        session.execute(RollupCheckpoint.__table__.delete().where(RollupCheckpoint.name == ROLLUP_NAME))
+    return refresh_rollups(batch_size)
+
+@track_service
+def get_rollup_df(date_from=None, date_to=None, session=None):
+    """Rollup rows (day, action_taken, model_type, count) for an inclusive day range."""
+    with _session_scope(session) as session:
+        query = _filter_date_range(session.query(ExchangeDailyRollup), ExchangeDailyRollup.day, date_from, date_to)
+        return pd.read_sql(query.order_by(ExchangeDailyRollup.day).statement, session.connection())
+
+@track_service
+def get_rollup_checkpoint(session=None):
+    """
+    {"last_exchange_id", "updated_at"} of the rollups (None before the first
+    refresh) and "latest_exchange_id", the newest exchange there is to count.
+    """
+    with _session_scope(session) as session:
+        row = session.execute(
+            select(RollupCheckpoint.last_exchange_id, RollupCheckpoint.updated_at)
+            .where(RollupCheckpoint.name == ROLLUP_NAME)
+        ).first()
+        checkpoint = dict(row._mapping) if row else {"last_exchange_id": None, "updated_at": None}
+        checkpoint["latest_exchange_id"] = session.scalar(select(func.max(Exchange.id)))
+        return checkpoint
+
+# --- EXPORT ---
+
+EXPORT_TABLES = {
+    "customers": Customer,
+    "batteries": Battery,
+    "exchanges": Exchange,
+    "scrap": ScrapBattery,
+    "challan": ChallanBattery,
+    "archive": ArchivedScrapBattery,
+}
+EXPORT_CHUNK_SIZE = 10000
+
+@track_service
+def export_table_csv(table, file_obj, chunk_size=EXPORT_CHUNK_SIZE, session=None):
+    """
+    Writes one of EXPORT_TABLES to a text file object as CSV in primary-key
+    order, chunk by chunk, so the table is never held in memory at once.
+    Returns the number of rows written.
+    """
+    model = EXPORT_TABLES[table]
+    # stream_results: Postgres hands the rows over through a server-side cursor
+    query = select(model.__table__).order_by(*model.__table__.primary_key.columns).execution_options(stream_results=True)
+    rows = 0
+    with _session_scope(session) as session:
+        for chunk in pd.read_sql(query, session.connection(), chunksize=chunk_size):
+            chunk.to_csv(file_obj, header=rows == 0, index=False)
+            rows += len(chunk)
+    if rows == 0:
+        pd.DataFrame(columns=[c.name for c in model.__table__.columns]).to_csv(file_obj, index=False)
+    return rows
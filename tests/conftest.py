@@ -0,0 +1,39 @@
+import os
+import shutil
+import pytest
+import database
+import services
+
+# Every test gets its own SQLite database (and archive directory) under
+# tmp_path, set through the environment like any other deployment.
+
+BUNDLED_DB = os.path.join(os.path.dirname(os.path.dirname(__file__)), "battery_shop.db")
+
+
+def _use_database(monkeypatch, tmp_path, path):
+    monkeypatch.setenv("DB_URL", f"sqlite:///{path}")
+    monkeypatch.setenv("EXCHANGE_ARCHIVE_DIR", str(tmp_path / "exchange_archive"))
+    database.reset_engine()
+    services.invalidate_dashboard_cache()
+
+
+@pytest.fixture
+def db(monkeypatch, tmp_path):
+    """A fresh, fully migrated database."""
+    _use_database(monkeypatch, tmp_path, tmp_path / "test.db")
+    database.init_db()
+    yield
+    database.reset_engine()
+
+
+@pytest.fixture
+def bundled_db(monkeypatch, tmp_path):
+    """
+    A copy of the bundled battery_shop.db, not migrated yet: the test calls
+    database.init_db(). Yields the copy's path.
+    """
+    path = tmp_path / "battery_shop.db"
+    shutil.copyfile(BUNDLED_DB, path)
+    _use_database(monkeypatch, tmp_path, path)
+    yield path
+    database.reset_engine()
@@ -0,0 +1,69 @@
+import os
+from datetime import date, datetime
+import pytest
+from sqlalchemy import select, update
+import archive
+import ledger
+import services
+from config import get_exchange_archive_dir
+from database import unit_of_work
+from models import Exchange, ExchangeArchive
+
+TODAY = date(2024, 6, 1)
+
+
+@pytest.fixture
+def old_year(db):
+    # S1 serviced, marked ready and handed back in 2021; S2 serviced now
+    services.process_service_entry("9000000001", "Customer", "S1", "T-1", "", date(2020, 5, 1), "")
+    services.update_battery_status("S1", "ready_for_pickup")
+    services.process_return_to_customer("S1", "9000000001")
+    with unit_of_work() as session:
+        session.execute(update(Exchange).values(date=datetime(2021, 3, 1, 10, 0)))
+    services.process_service_entry("9000000002", "Customer", "S2", "T-2", "", date(2024, 5, 1), "")
+    return 2021
+
+def _table_ids():
+    with unit_of_work() as session:
+        return session.scalars(select(Exchange.id).order_by(Exchange.id)).all()
+
+
+def test_archive_round_trip(old_year):
+    before = services.get_battery_exchanges_df("S1")
+    exchanges_done = services.get_dashboard_stats()["exchanges_done"]
+
+    assert archive.archive_closed_years(today=TODAY) == {old_year: 3}
+    assert os.path.exists(os.path.join(get_exchange_archive_dir(), archive.archive_file_name(old_year)))
+    assert _table_ids() == [4]
+
+    assert services.get_battery_exchanges_df("S1").empty
+    archived = services.get_battery_exchanges_df("S1", include_archive=True)
+    assert archived["id"].tolist() == before["id"].tolist() == [3, 2, 1]
+    assert archived["action_taken"].tolist() == before["action_taken"].tolist()
+    assert services.get_ticket_history("T-1", include_archive=True)["id"].tolist() == [1, 2, 3]
+    assert sum(len(batch) for batch in services.iter_archived_exchanges()) == 3
+
+    # The STATUS_UPDATED exchange is archived but still not counted
+    assert services.get_dashboard_stats()["exchanges_done"] == exchanges_done == 3
+    with unit_of_work() as session:
+        manifest = session.get(ExchangeArchive, old_year)
+        assert (manifest.rows, manifest.status_updates, manifest.first_exchange_id, manifest.last_exchange_id) == (3, 1, 1, 3)
+
+def test_archived_years_are_kept_in_rollups_and_ledger(old_year):
+    archive.archive_closed_years(today=TODAY)
+    services.rebuild_rollups()
+    counts = services.get_rollup_df(date(2021, 1, 1), date(2021, 12, 31)).groupby("action_taken")["count"].sum()
+    assert counts.to_dict() == {"RETURNED_TO_CUSTOMER": 1, "SERVICE_PENDING": 1}
+
+    assert ledger.rebuild_ledger_state() == 4
+    assert ledger.diff_ledger()["total"] == 0
+
+def test_archiving_twice(old_year):
+    archive.archive_closed_years(today=TODAY)
+    assert archive.archive_closed_years(today=TODAY) == {}
+    with pytest.raises(RuntimeError, match="already archived"):
+        archive.archive_exchange_year(old_year)
+
+def test_open_years_are_kept(old_year):
+    assert archive.archive_closed_years(keep_years=4, today=TODAY) == {}
+    assert _table_ids() == [1, 2, 3, 4]
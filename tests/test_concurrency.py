@@ -0,0 +1,26 @@
+import argparse
+import threading
+from collections import Counter
+from benchmarks import stress_upserts
+
+
+def test_concurrent_counters(db):
+    # A small run of benchmarks/stress_upserts.py: counters racing on the same
+    # customers and batteries lose no update and hand each battery back once
+    args = argparse.Namespace(workers=4, rounds=5, keys=2)
+    stress_upserts.seed_pickups("T", args.keys)
+    barrier = threading.Barrier(args.workers)
+    errors, outcomes = [], Counter()
+    threads = [
+        threading.Thread(target=stress_upserts.run_worker, args=(worker, args, "T", barrier, errors, outcomes))
+        for worker in range(args.workers)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert stress_upserts.check(args, "T", outcomes) == []
+    assert outcomes["return"] == args.rounds * args.keys
+    assert outcomes["return refused"] == args.rounds * args.keys * (args.workers - 1)
@@ -0,0 +1,35 @@
+import sqlite3
+from datetime import date
+import services
+from config import get_db_url
+
+
+def _outside_write(sql):
+    # Another process writing: no Session events fire in this one
+    with sqlite3.connect(get_db_url().removeprefix("sqlite:///")) as conn:
+        conn.execute(sql)
+    conn.close()
+
+
+def test_cached_until_a_write_commits(db):
+    services.process_service_entry("9000000001", "Customer", "S1", "T-1", "", date(2024, 1, 10), "")
+    stats = services.get_dashboard_stats()
+    assert services.get_dashboard_stats() is stats
+    services.process_service_entry("9000000002", "Customer", "S2", "T-2", "", date(2024, 1, 10), "")
+    assert services.get_dashboard_stats()["exchanges_done"] == 2
+
+def test_writes_from_another_process_are_seen(db):
+    assert services.get_dashboard_stats()["total_batteries"] == 0
+    _outside_write("INSERT INTO batteries (serial_no, status, version) VALUES ('S1', 'in_stock', 1)")
+    assert services.get_dashboard_stats()["total_batteries"] == 1
+    _outside_write("INSERT INTO exchanges (date, action_taken) VALUES ('2024-01-10 10:00:00', 'SERVICE_PENDING')")
+    assert services.get_dashboard_stats()["exchanges_done"] == 1
+
+def test_cache_expires(db, monkeypatch):
+    _outside_write("INSERT INTO batteries (serial_no, status, version) VALUES ('S1', 'in_stock', 1)")
+    assert services.get_dashboard_stats()["by_status"] == {"in_stock": 1}
+    # Invisible to the staleness key: same batteries, no new exchange
+    _outside_write("UPDATE batteries SET status = 'sold'")
+    assert services.get_dashboard_stats()["by_status"] == {"in_stock": 1}
+    monkeypatch.setattr(services, "DASHBOARD_CACHE_TTL", 0)
+    assert services.get_dashboard_stats()["by_status"] == {"sold": 1}
@@ -0,0 +1,56 @@
+import io
+from datetime import date
+import services
+from services import bulk_import_inventory
+
+
+def _import(text, **kwargs):
+    return bulk_import_inventory(io.BytesIO(text.encode()), "stock.csv", **kwargs)
+
+
+def test_bad_rows_are_reported_not_fatal(db):
+    services.add_inventory_stock("OLD1", "Exide Mileage", date(2024, 1, 10))
+    result = _import(
+        "Serial Number,Model,Purchase Date\n"
+        "A1,Exide Mileage,2024-02-01\n"
+        ",Exide Mileage,\n"
+        "A2,No Such Model,\n"
+        "A3,Exide Mileage,01/02/2024\n"
+        "A1,Exide Mileage,\n"
+        "OLD1,Exide Mileage,\n"
+        "A4,Exide Mileage,\n"
+    )
+    assert (result["rows"], result["inserted"]) == (7, 2)
+    # Row numbers as in the spreadsheet, the header being row 1
+    assert result["rejects"].set_index("row")["reason"].to_dict() == {
+        3: "Missing serial number",
+        4: "Unknown battery model",
+        5: "Invalid purchase date (expected YYYY-MM-DD)",
+        6: "Duplicate serial in file",
+        7: "Serial already exists",
+    }
+    a1 = services.get_battery_by_serial("A1")
+    assert (a1.status, a1.date_of_purchase) == ("in_stock", date(2024, 2, 1))
+    assert a1.warranty_expiry == services.warranty_expiry_for("Exide Mileage", date(2024, 2, 1))
+    assert services.get_battery_by_serial("A4").date_of_purchase == date.today()
+
+def test_chunks_are_imported_separately(db):
+    progress = []
+    lines = [f"S{i},Exide Mileage," for i in range(7)] + ["S0,Exide Mileage,"]
+    result = _import("serial_no,model_type,date_of_purchase\n" + "\n".join(lines), chunk_size=3,
+                     on_progress=lambda rows, inserted: progress.append((rows, inserted)))
+    assert progress == [(3, 3), (6, 6), (8, 7)]
+    # A repeat in a later chunk is found in the database, not in the file
+    assert result["rejects"].to_dict("records") == [{"row": 9, "serial_no": "S0", "reason": "Serial already exists"}]
+
+def test_serial_inserted_after_validation(db, monkeypatch):
+    # Another counter adds the battery between the check and the insert
+    validate = services._validate_import_chunk
+    def validate_then_race(df, session):
+        checked = validate(df, session)
+        services.add_inventory_stock("R1", "Exide Mileage", date(2024, 1, 10))
+        return checked
+    monkeypatch.setattr(services, "_validate_import_chunk", validate_then_race)
+    result = _import("serial_no,model_type\nR1,Exide Mileage\nR2,Exide Mileage\n")
+    assert result["inserted"] == 1
+    assert result["rejects"][["serial_no", "reason"]].to_dict("records") == [{"serial_no": "R1", "reason": "Serial already exists"}]
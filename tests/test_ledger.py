@@ -0,0 +1,39 @@
+from datetime import date, datetime
+import pyarrow as pa
+import pyarrow.parquet as pq
+from sqlalchemy import update
+import ledger
+import services
+from archive import ARCHIVE_SCHEMA
+from database import unit_of_work
+from migrations import _add_status_to_archive_file
+from models import Exchange
+
+
+def test_replay_reads_the_status_column(db):
+    services.process_service_entry("9000000001", "Customer", "S1", "T-1", "", date(2024, 1, 10), "")
+    services.update_battery_status("S1", "ready_for_pickup")
+    # The notes are free text; editing them does not change the history
+    with unit_of_work() as session:
+        session.execute(update(Exchange).values(notes="called the customer"))
+    assert ledger.rebuild_ledger_state() == 2
+    assert ledger.diff_ledger()["total"] == 0
+
+def test_older_archive_files_get_the_status(tmp_path):
+    path = str(tmp_path / "exchanges_2021.parquet")
+    legacy = pa.schema([field for field in ARCHIVE_SCHEMA if field.name != "status"])
+    rows = {name: [None, None] for name in legacy.names}
+    rows.update(
+        id=[1, 2],
+        date=[datetime(2021, 3, 1), datetime(2021, 3, 2)],
+        old_battery_serial=["S1", "S1"],
+        action_taken=["SERVICE_PENDING", "STATUS_UPDATED"],
+        notes=["Status changed to nowhere", "Status changed to ready_for_pickup"],
+    )
+    pq.write_table(pa.Table.from_pydict(rows, schema=legacy), path)
+
+    _add_status_to_archive_file(path)
+    _add_status_to_archive_file(path)
+    table = pq.read_table(path)
+    assert table.schema.equals(ARCHIVE_SCHEMA)
+    assert table.column("status").to_pylist() == [None, "ready_for_pickup"]
@@ -0,0 +1,61 @@
+import hashlib
+import sqlite3
+from datetime import date
+import pandas as pd
+import database
+import services
+from conftest import BUNDLED_DB
+from migrations import MIGRATIONS, get_applied_versions, run_migrations
+from services import warranty_expiry_for
+
+# The bundled battery_shop.db predates every migration: no schema_migrations
+# table, dates stored as text and no exchanges.ticket_id.
+
+
+def _digest(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def test_bundled_database_migrates(bundled_db):
+    bundled = _digest(BUNDLED_DB)
+    database.init_db()
+    engine = database.get_db_engine()
+    with engine.connect() as conn:
+        assert get_applied_versions(conn) == {version for version, _, _ in MIGRATIONS}
+    assert run_migrations(engine) == []
+    assert _digest(BUNDLED_DB) == bundled
+
+    with engine.connect() as conn:
+        # The keyset index is on an expression, which inspect() does not reflect
+        indexes = set(conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE tbl_name = 'scrap_batteries'").scalars())
+    assert "ix_scrap_batteries_received_date_undated_serial_no" in indexes
+    assert "ix_scrap_batteries_received_date_serial_no" not in indexes
+
+def test_bundled_data_survives(bundled_db):
+    database.init_db()
+    battery = services.get_battery_by_serial("jhgf")
+    assert (battery.status, battery.date_of_purchase) == ("sold", date(2026, 1, 16))
+    assert battery.warranty_expiry == warranty_expiry_for("Exide Mileage", date(2026, 1, 16))
+    # Ticket ids backfilled from the notes; "Ticket: ." has none
+    tickets = services.get_customer_exchanges_df("9891289889").set_index("id")["ticket_id"]
+    assert tickets[1] == "fthgyuhg"
+    assert tickets[3] == "lkjhg"
+    assert pd.isna(tickets[2])
+    stats = services.get_dashboard_stats()
+    assert (stats["total_customers"], stats["exchanges_done"]) == (1, 6)
+
+def test_legacy_statuses_are_mapped(bundled_db):
+    with sqlite3.connect(bundled_db) as conn:
+        conn.execute("UPDATE batteries SET status = 'replaced' WHERE serial_no = 'jhgf'")
+        conn.execute("UPDATE batteries SET status = NULL WHERE serial_no = 'jhgfcnew'")
+        conn.execute("INSERT INTO batteries (serial_no, model_type, status) VALUES ('LOOSE1', 'Exide Mileage', '')")
+    conn.close()
+    database.init_db()
+    statuses = {serial: services.get_battery_by_serial(serial).status for serial in ["jhgf", "jhgfcnew", "LOOSE1", "qefrggf"]}
+    assert statuses == {
+        "jhgf": "returned_faulty/WNA",
+        "jhgfcnew": "active_with_customer",
+        "LOOSE1": "in_stock",
+        "qefrggf": "sold",
+    }
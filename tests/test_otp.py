@@ -0,0 +1,64 @@
+import pytest
+import otp
+from otp import EXPIRED, FAILED, INVALID, LOCKED, SENT, UNKNOWN, VERIFIED, FakeSMSProvider
+
+PHONE = "9000000001"
+
+
+@pytest.fixture
+def sms(monkeypatch):
+    provider = FakeSMSProvider()
+    monkeypatch.setattr(otp, "_provider", provider)
+    monkeypatch.setattr(otp, "_otps", {})
+    return provider
+
+@pytest.fixture
+def clock(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(otp.time, "monotonic", lambda: now[0])
+    return now
+
+def _code(sms):
+    otp.wait_for_dispatch()
+    return sms.last_message(PHONE).split(" is ")[1].split(".")[0]
+
+
+def test_code_is_sent_and_used_once(sms):
+    token = otp.request_otp(PHONE, "claim")
+    code = _code(sms)
+    assert "warranty claim" in sms.last_message(PHONE)
+    assert otp.delivery_status(token)["status"] == SENT
+    assert otp.check_otp(token, f" {code} ") == VERIFIED
+    assert otp.check_otp(token, code) == UNKNOWN
+
+def test_code_expires(sms, clock):
+    token = otp.request_otp(PHONE, "pickup")
+    code = _code(sms)
+    clock[0] += otp.OTP_TTL_SECONDS - 1
+    assert otp.delivery_status(token)["expires_in"] == 1
+    clock[0] += 1
+    assert otp.delivery_status(token)["status"] == EXPIRED
+    assert otp.check_otp(token, code) == EXPIRED
+
+def test_wrong_codes_lock_the_otp(sms):
+    token = otp.request_otp(PHONE, "claim")
+    code = _code(sms)
+    wrong = "0000" if code != "0000" else "1111"
+    results = [otp.check_otp(token, wrong) for _ in range(otp.OTP_MAX_ATTEMPTS)]
+    assert results == [INVALID] * (otp.OTP_MAX_ATTEMPTS - 1) + [LOCKED]
+    # Even the right code is refused once locked
+    assert otp.check_otp(token, code) == LOCKED
+
+def test_non_ascii_input_is_invalid(sms):
+    token = otp.request_otp(PHONE, "claim")
+    _code(sms)
+    assert otp.check_otp(token, "१२३४") == INVALID
+    assert otp.check_otp(token, None) == INVALID
+
+def test_failed_delivery_is_reported(sms, clock):
+    sms.fail = True
+    token = otp.request_otp(PHONE, "claim")
+    otp.wait_for_dispatch()
+    assert otp.delivery_status(token) == {
+        "status": FAILED, "error": "SMS gateway unavailable", "phone": PHONE, "expires_in": otp.OTP_TTL_SECONDS,
+    }
@@ -0,0 +1,32 @@
+from datetime import date
+import services
+from database import unit_of_work
+from models import ScrapBattery
+
+
+def _pages(fetch, date_column, page_size=3):
+    pages, cursor = [], None
+    while True:
+        page = fetch(page_size=page_size, cursor=cursor)
+        pages.append(page["serial_no"].tolist())
+        if len(page) < page_size:
+            return pages
+        last = page.iloc[-1]
+        cursor = (last[date_column], last["serial_no"])
+
+
+def test_scrap_pages_with_missing_dates(db):
+    with unit_of_work() as session:
+        for i in range(8):
+            session.add(ScrapBattery(serial_no=f"S{i}", received_date=None if i % 2 else date(2024, 1, 1 + i)))
+    pages = _pages(services.get_scrap_batteries_df, "received_date")
+    # Newest first, then the undated rows; a cursor on an undated row still pages on
+    assert pages == [["S6", "S4", "S2"], ["S0", "S7", "S5"], ["S3", "S1"]]
+
+def test_service_queue_oldest_purchase_first(db):
+    for i in range(7):
+        services.process_service_entry(f"900000000{i}", "Customer", f"Q{i}", f"T-{i}", "", None if i % 3 == 0 else date(2023, 1, 10 - i), "")
+    pages = _pages(services.get_service_queue_df, "date_of_purchase")
+    # Oldest purchase first, undated batteries last in serial order
+    assert pages == [["Q5", "Q4", "Q2"], ["Q1", "Q0", "Q3"], ["Q6"]]
+    assert services.get_service_queue_df(status="pending", age_bucket="Unknown")["serial_no"].tolist() == ["Q0", "Q3", "Q6"]
@@ -0,0 +1,30 @@
+import json
+from datetime import date
+import pytest
+import services
+
+
+@pytest.fixture
+def customer(db):
+    for i in range(5):
+        services.process_service_entry("9000000001", "Customer", f"S{i}", f"T-{i}", "", date(2024, 1, 10), "")
+    services.process_return_to_customer("S0", "9000000001")
+
+
+def test_customer_profile_matches_the_separate_reads(customer):
+    profile = services.get_customer_profile("9000000001", page_size=4)
+    assert profile["exchanges"]["id"].tolist() == [6, 5, 4, 3]
+    assert profile["exchanges"]["id"].tolist() == services.get_customer_exchanges_df("9000000001", page_size=4)["id"].tolist()
+    assert services.get_customer_profile("9000000001", page_size=4, cursor=3)["exchanges"]["id"].tolist() == [2, 1]
+    assert sorted(profile["batteries"]["serial_no"]) == ["S0", "S1", "S2", "S3", "S4"]
+    assert profile["customer"]["name"].tolist() == ["Customer"]
+
+def test_battery_profile(customer):
+    profile = services.get_battery_profile("S0")
+    assert profile["exchanges"]["action_taken"].tolist() == ["RETURNED_TO_CUSTOMER", "SERVICE_PENDING"]
+    assert profile["battery"]["status"].tolist() == ["active_with_customer"]
+
+def test_exchanges_sorted_whatever_order_sqlite_aggregates_them(customer):
+    # json_group_array does not promise the subquery's order
+    records = [{"id": i, "date": "2024-01-10 10:00:00"} for i in (2, 5, 1)]
+    assert services._exchanges_newest_first(json.dumps(records))["id"].tolist() == [5, 2, 1]
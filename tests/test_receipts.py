@@ -0,0 +1,41 @@
+import io
+import zipfile
+from datetime import date, datetime
+import pytest
+from sqlalchemy import update
+from streamlit.runtime.download_data_util import convert_data_to_bytes_and_infer_mime
+import services
+from database import unit_of_work
+from models import Exchange
+from receipts import UNDATED, iter_receipts, receipts_file
+
+
+@pytest.fixture
+def replacements(db):
+    # Three replacements, the first one a legacy exchange without a date
+    for i in range(3):
+        services.process_service_entry("9000000001", "Customer", f"OLD{i}", f"T-{i}", "", date(2024, 1, 10), "")
+        services.process_new_battery_exchange("9000000001", "Customer", f"OLD{i}", f"NEW{i}", "Exide Mileage",
+                                              f"T-{i}", "", date(2024, 1, 10), "")
+    with unit_of_work() as session:
+        session.execute(update(Exchange).where(Exchange.new_battery_serial == "NEW0").values(date=None))
+        session.execute(update(Exchange).where(Exchange.new_battery_serial == "NEW1").values(date=datetime(2024, 2, 1, 10)))
+        session.execute(update(Exchange).where(Exchange.new_battery_serial == "NEW2").values(date=datetime(2024, 3, 1, 10)))
+
+
+def test_receipts_page_through_undated_exchanges(replacements):
+    receipts = list(iter_receipts(page_size=1))
+    assert [row.new_serial for row, _ in receipts] == ["NEW2", "NEW1", "NEW0"]
+    assert UNDATED in receipts[-1][1]
+    assert [row.new_serial for row, _ in iter_receipts(date(2024, 2, 1), date(2024, 2, 29))] == ["NEW1"]
+
+@pytest.mark.parametrize("zipped", [False, True])
+def test_receipts_file_is_a_valid_download(replacements, zipped):
+    # What st.download_button does with the callable's result
+    data, _ = convert_data_to_bytes_and_infer_mime(receipts_file(zipped=zipped), RuntimeError("unsupported"))
+    if zipped:
+        names = zipfile.ZipFile(io.BytesIO(data)).namelist()
+        assert len(names) == 3
+        assert any(name.startswith("receipt_undated_") for name in names)
+    else:
+        assert data.decode("utf-8").count('class="receipt"') == 3
@@ -0,0 +1,41 @@
+from datetime import date
+import services
+
+
+def _service_entry(serial, day):
+    services.process_service_entry("9000000001", "Customer", serial, "T-1", "", day, "")
+
+def _counts():
+    df = services.get_rollup_df()
+    return sorted(zip(df["day"].astype(str), df["action_taken"], df["model_type"], df["count"]))
+
+
+def test_refresh_counts_only_new_exchanges(db):
+    assert services.refresh_rollups() == 0
+    assert services.get_rollup_checkpoint()["last_exchange_id"] is None
+    _service_entry("S1", date(2024, 1, 10))
+    _service_entry("S2", date(2024, 1, 10))
+    # Reading the checkpoint counts nothing
+    assert services.get_rollup_checkpoint() == {"last_exchange_id": None, "updated_at": None, "latest_exchange_id": 2}
+    assert services.refresh_rollups() == 2
+    assert services.get_rollup_checkpoint()["last_exchange_id"] == 2
+    assert services.refresh_rollups() == 0
+
+    _service_entry("S3", date(2024, 1, 11))
+    assert services.refresh_rollups() == 1
+    assert services.get_rollup_checkpoint()["last_exchange_id"] == 3
+    # Exchanges are dated when they are logged, not by the purchase date
+    assert [row[1:] for row in _counts()] == [("SERVICE_PENDING", "Unknown", 3)]
+
+def test_batches_and_rebuild_match(db):
+    for i in range(5):
+        _service_entry(f"S{i}", date(2024, 1, 10))
+        services.update_battery_status(f"S{i}", "ready_for_pickup")
+    services.process_return_to_customer("S0", "9000000001")
+    # Counted a few ids at a time, STATUS_UPDATED rows included in the mark
+    assert services.refresh_rollups(batch_size=3) == 6
+    assert services.get_rollup_checkpoint()["last_exchange_id"] == 11
+    incremental = _counts()
+    assert services.rebuild_rollups() == 6
+    assert _counts() == incremental
+    assert sum(count for _, _, _, count in incremental) == services.get_dashboard_stats()["exchanges_done"]
@@ -0,0 +1,49 @@
+from datetime import date
+from sqlalchemy import func, select
+import services
+from database import unit_of_work
+from models import ArchivedScrapBattery, ChallanBattery, ScrapBattery
+
+
+def _serials(model):
+    with unit_of_work() as session:
+        return session.scalars(select(model.serial_no).order_by(model.serial_no)).all()
+
+def _scrap(*serials):
+    with unit_of_work() as session:
+        for serial in serials:
+            session.add(ScrapBattery(serial_no=serial, model_type="Exide Mileage", received_date=date(2024, 1, 10),
+                                     customer_phone="9000000001", ticket_id=f"T-{serial}", notes="Replaced"))
+
+
+def test_scrap_moves_to_challan_then_archive(db):
+    _scrap("S1", "S2", "S3")
+    assert services.move_scrap_to_challan(["S1", "S3", "NOPE"]) == 2
+    assert _serials(ScrapBattery) == ["S2"]
+    assert _serials(ChallanBattery) == ["S1", "S3"]
+    with unit_of_work() as session:
+        moved = session.get(ChallanBattery, "S1")
+        assert (moved.received_date, moved.ticket_id, moved.notes) == (date(2024, 1, 10), "T-S1", "Replaced")
+        assert moved.challan_date is not None
+
+    assert services.clear_challan_to_archive() == 2
+    assert _serials(ChallanBattery) == []
+    with unit_of_work() as session:
+        archived = session.get(ArchivedScrapBattery, "S3")
+        assert archived.ticket_id == "T-S3"
+        assert archived.challan_date is not None and archived.final_archived_date is not None
+    assert services.clear_challan_to_archive() == 0
+
+def test_nothing_to_move(db):
+    _scrap("S1")
+    assert services.move_scrap_to_challan([]) == 0
+    assert services.move_scrap_to_challan(["NOPE"]) == 0
+    with unit_of_work() as session:
+        assert session.scalar(select(func.count()).select_from(ChallanBattery)) == 0
+    assert _serials(ScrapBattery) == ["S1"]
+
+def test_replaced_battery_is_scrapped(db):
+    services.process_service_entry("9000000001", "Customer", "OLD1", "T-1", "", date(2024, 1, 10), "")
+    services.process_new_battery_exchange("9000000001", "Customer", "OLD1", "NEW1", "Exide Mileage", "T-1", "", date(2024, 1, 10), "")
+    assert services.move_scrap_to_challan(["OLD1"]) == 1
+    assert _serials(ChallanBattery) == ["OLD1"]
@@ -0,0 +1,24 @@
+import pytest
+import services
+from database import unit_of_work
+from models import Battery
+
+
+@pytest.fixture(params=["fts", "like"])
+def batteries(db, request, monkeypatch):
+    if request.param == "like":
+        monkeypatch.setattr(services, "_has_search_fts", lambda session: False)
+    with unit_of_work() as session:
+        # Many substring hits ahead of the prefix matches in insertion order
+        session.add_all(Battery(serial_no=f"XX{i:03}ABC", status="in_stock") for i in range(50))
+        session.add_all([Battery(serial_no="ABC12345", status="in_stock"), Battery(serial_no="abc9", status="in_stock")])
+
+
+def test_prefix_matches_come_first(batteries):
+    matches = services.search_records("abc", limit=5)
+    assert matches["value"].tolist()[:2] == ["abc9", "ABC12345"]
+    assert len(matches) == 5
+    assert set(matches["kind"]) == {"battery"}
+
+def test_short_terms_match_nothing(batteries):
+    assert services.search_records("ab").empty
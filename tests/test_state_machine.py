@@ -0,0 +1,89 @@
+from datetime import date
+import pytest
+from sqlalchemy import update
+import services
+from database import unit_of_work
+from models import Battery
+from services import StatusConflictError
+
+
+def _status(serial):
+    return services.get_battery_by_serial(serial).status
+
+def _service_entry(serial, phone="9000000001"):
+    services.process_service_entry(phone, "Customer", serial, "T-1", "DL1AB1234", date(2024, 1, 10), "")
+
+def _set_status(serial, status):
+    # A hand edit, bypassing the state machine
+    with unit_of_work() as session:
+        session.execute(update(Battery).where(Battery.serial_no == serial).values(status=status))
+
+
+def test_service_round_trip(db):
+    _service_entry("S1")
+    assert _status("S1") == "pending"
+    assert services.update_battery_status("S1", "ready_for_pickup")
+    services.process_return_to_customer("S1", "9000000001")
+    assert _status("S1") == "active_with_customer"
+
+def test_second_pickup_is_refused(db):
+    _service_entry("S1")
+    services.process_return_to_customer("S1", "9000000001")
+    with pytest.raises(StatusConflictError) as e:
+        services.process_return_to_customer("S1", "9000000001")
+    assert e.value.current_status == "active_with_customer"
+    assert "already active_with_customer" in str(e.value)
+
+def test_transition_not_allowed(db):
+    services.add_inventory_stock("S1", "Exide Mileage", date(2024, 1, 10))
+    with pytest.raises(StatusConflictError, match="cannot go from in_stock to pending"):
+        services.update_battery_status("S1", "pending")
+    assert _status("S1") == "in_stock"
+
+def test_replaced_battery_is_final(db):
+    _service_entry("OLD1")
+    services.process_new_battery_exchange("9000000001", "Customer", "OLD1", "NEW1", "Exide Mileage", "T-1", "", date(2024, 1, 10), "")
+    assert (_status("OLD1"), _status("NEW1")) == ("returned_faulty/WNA", "sold")
+    with pytest.raises(StatusConflictError):
+        services.update_battery_status("OLD1", "pending")
+
+def test_stale_version_is_refused(db):
+    _service_entry("S1")
+    version = services.get_battery_by_serial("S1").version
+    services.update_battery_status("S1", "ready_for_pickup")
+    with pytest.raises(StatusConflictError, match="changed at another counter"):
+        services.process_return_to_customer("S1", "9000000001", expected_version=version)
+    assert _status("S1") == "ready_for_pickup"
+
+def test_unknown_serial(db):
+    assert services.update_battery_status("NOPE", "pending") is False
+
+@pytest.mark.parametrize("legacy", [None, "replaced_by_hand"])
+def test_status_outside_the_state_machine_can_move(db, legacy):
+    services.add_inventory_stock("S1", "Exide Mileage", date(2024, 1, 10))
+    _set_status("S1", legacy)
+    assert services.update_battery_status("S1", "pending")
+    assert _status("S1") == "pending"
+
+def test_upsert_battery_follows_the_state_machine(db):
+    _service_entry("S1")
+    # Saving it again in its own status edits the details
+    services.upsert_battery("S1", "Exide Mileage", "pending", None, None, "9000000001", "T-2", "DL1AB1234")
+    assert services.get_battery_by_serial("S1").ticket_id == "T-2"
+    with pytest.raises(StatusConflictError, match="cannot go from pending to factory_pending"):
+        services.upsert_battery("S1", "Exide Mileage", "factory_pending", None, None, "9000000001", "T-3", "")
+    assert services.get_battery_by_serial("S1").ticket_id == "T-2"
+
+def test_stock_receptions_skip_batteries_not_pending(db):
+    services.upsert_battery("F1", "Exide Mileage", "factory_pending", None, None, None, "T-1", "")
+    services.upsert_battery("F2", "Exide Mileage", "factory_pending", None, None, None, "T-2", "")
+    assert services.process_stock_receptions(["F1"]) == ["F1"]
+    assert services.process_stock_receptions(["F1", "F2", "NOPE"]) == ["F2"]
+    assert _status("F1") == _status("F2") == "in_stock"
+
+def test_status_updates_are_not_counted_as_exchanges(db):
+    _service_entry("S1")
+    services.update_battery_status("S1", "ready_for_pickup")
+    assert services.get_dashboard_stats()["exchanges_done"] == 1
+    services.refresh_rollups()
+    assert set(services.get_rollup_df()["action_taken"]) == {"SERVICE_PENDING"}